@@ -0,0 +1,222 @@
+# anonymization_cache.py
+"""
+Content-addressed, size-bounded on-disk cache of anonymization results.
+
+The same exports are anonymized over and over (the anonymization tab, batch
+analysis, re-uploads), so results are stored in SQLite keyed by an HMAC of
+the anonymizer's rules version, the kind of call and the original text. The
+original text is never written: an entry holds the anonymized text, the
+report without the original values (their offsets into the original text are
+kept instead, so the caller, who has the original, can restore them) and the
+offset map. Without the HMAC key an entry cannot be linked to a text.
+
+Entries are evicted least recently used first once the cache holds more than
+ANONYMIZATION_CACHE_MAX_BYTES of payload. ANONYMIZATION_CACHE_MAX_BYTES=0
+disables the cache. The HMAC key comes from ANONYMIZATION_CACHE_KEY, or from
+a random key file created next to the database.
+"""
+
+import hashlib
+import hmac
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import closing
+from typing import Any, Dict, Optional
+
+ANONYMIZATION_CACHE_PATH = os.environ.get('ANONYMIZATION_CACHE_PATH', 'anonymization_cache.db')
+ANONYMIZATION_CACHE_MAX_BYTES = int(os.environ.get('ANONYMIZATION_CACHE_MAX_BYTES', str(256 * 1024 * 1024)))
+
+# Length of the generated HMAC key
+_KEY_BYTES = 32
+
+# Fraction of the size limit kept after an eviction, so every put doesn't trigger one
+_EVICT_TO = 0.9
+
+
+def _load_or_create_key(key_path: str) -> bytes:
+    """HMAC key from ANONYMIZATION_CACHE_KEY, else from key_path (created 0600 on first use)"""
+    configured = os.environ.get('ANONYMIZATION_CACHE_KEY')
+    if configured:
+        return configured.encode('utf-8')
+    # The key is written to a temporary file and linked into place, so the key
+    # file never exists half-written; a worker that loses the race reads the winner's key
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(key_path)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(os.urandom(_KEY_BYTES))
+            f.flush()
+            os.fsync(f.fileno())
+        try:
+            os.link(tmp_path, key_path)
+        except FileExistsError:
+            pass
+    finally:
+        os.unlink(tmp_path)
+
+    with open(key_path, 'rb') as f:
+        key = f.read()
+    if len(key) != _KEY_BYTES:
+        raise ValueError(f"Anonymization cache key file {key_path} holds {len(key)} bytes, expected {_KEY_BYTES}")
+    return key
+
+
+class AnonymizationCache:
+    """
+    SQLite cache of anonymization payloads, keyed by HMAC(rules version, kind, text)
+
+    Payloads are JSON-serializable dicts that must not contain original values;
+    ChatAnonymizer builds and restores them.
+    """
+
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS entries (
+            key TEXT PRIMARY KEY,
+            payload TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            last_used REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_entries_last_used ON entries(last_used);
+    """
+
+    def __init__(self, db_path: str = ANONYMIZATION_CACHE_PATH,
+                 max_bytes: int = ANONYMIZATION_CACHE_MAX_BYTES):
+        """
+        Args:
+            db_path: SQLite database file
+            max_bytes: Payload bytes kept before least recently used entries are evicted
+        """
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self._secret = _load_or_create_key(db_path + '.key')
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._stores = 0
+        self._evictions = 0
+
+        with closing(self._connect()) as conn, conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(self._SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        # Short-lived connections are cheap and safe across forked workers; callers
+        # close them with closing(), as the connection's own context manager only commits
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    def key(self, version: str, kind: str, text: str) -> str:
+        """HMAC-SHA256 of the original text, scoped to a rules version and kind of call"""
+        mac = hmac.new(self._secret, digestmod=hashlib.sha256)
+        mac.update(f"{version}\0{kind}\0".encode('utf-8'))
+        mac.update(text.encode('utf-8', 'surrogatepass'))
+        return mac.hexdigest()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Cached payload for key, or None"""
+        try:
+            with closing(self._connect()) as conn, conn:
+                row = conn.execute("SELECT payload FROM entries WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    conn.execute("UPDATE entries SET last_used = ? WHERE key = ?", (time.time(), key))
+        except sqlite3.Error as e:
+            print(f"⚠️ [AnonymizationCache] Lookup failed: {str(e)}")
+            row = None
+
+        with self._lock:
+            if row is None:
+                self._misses += 1
+                return None
+            self._hits += 1
+        return json.loads(row[0])
+
+    def put(self, key: str, payload: Dict[str, Any]):
+        """Store a payload, then evict least recently used entries beyond max_bytes"""
+        data = json.dumps(payload, ensure_ascii=False)
+        size = len(data.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+
+        try:
+            with closing(self._connect()) as conn, conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO entries (key, payload, size, last_used) VALUES (?, ?, ?, ?)",
+                    (key, data, size, time.time())
+                )
+                total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+                evicted = 0
+                if total > self.max_bytes:
+                    evicted = self._evict(conn, total - int(self.max_bytes * _EVICT_TO))
+        except sqlite3.Error as e:
+            print(f"⚠️ [AnonymizationCache] Store failed: {str(e)}")
+            return
+
+        with self._lock:
+            self._stores += 1
+            self._evictions += evicted
+
+    @staticmethod
+    def _evict(conn: sqlite3.Connection, excess: int) -> int:
+        """Delete the least recently used entries until at least excess bytes are freed"""
+        freed = 0
+        keys = []
+        for key, size in conn.execute("SELECT key, size FROM entries ORDER BY last_used"):
+            keys.append((key,))
+            freed += size
+            if freed >= excess:
+                break
+        conn.executemany("DELETE FROM entries WHERE key = ?", keys)
+        return len(keys)
+
+    def clear(self):
+        with closing(self._connect()) as conn, conn:
+            conn.execute("DELETE FROM entries")
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit/miss counters of this process plus the size of the shared store"""
+        try:
+            with closing(self._connect()) as conn, conn:
+                entries, size = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        except sqlite3.Error:
+            entries, size = None, None
+
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                'enabled': True,
+                'path': self.db_path,
+                'max_bytes': self.max_bytes,
+                'entries': entries,
+                'bytes': size,
+                'hits': self._hits,
+                'misses': self._misses,
+                'hit_rate': round(self._hits / lookups, 3) if lookups else None,
+                'stores': self._stores,
+                'evictions': self._evictions,
+            }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache() -> Optional[AnonymizationCache]:
+    """The process-wide cache, or None when disabled or unusable"""
+    global _cache
+    if ANONYMIZATION_CACHE_MAX_BYTES <= 0:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            try:
+                _cache = AnonymizationCache()
+            except (OSError, sqlite3.Error) as e:
+                print(f"⚠️ [AnonymizationCache] Disabled, could not open {ANONYMIZATION_CACHE_PATH}: {str(e)}")
+                _cache = False
+        return _cache or None
+
+
+def stats() -> Dict[str, Any]:
+    cache = get_cache()
+    return cache.stats() if cache else {'enabled': False}
@@ -1,11 +1,404 @@
 import re
 import json
 import hashlib
+import bisect
+import codecs
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
-from typing import Dict, List, Tuple, Optional ,Any
+from typing import Dict, List, Tuple, Optional ,Any, BinaryIO, Iterable, TextIO
 import uuid
 import io
 
+import anonymization_cache
+import regex_guard
+import transcript_tokenizer
+
+# Context window (characters on each side of a match) searched for identifier keywords
+SYSTEM_ID_WINDOW = 100
+
+# Chat headers that start a new chat (the EXACT same patterns as EnhancedChatProcessor)
+CHAT_START_PATTERNS = [
+    r"(?:^|\s)Chat\s+(?:ID\s*:?\s*)?(\d+)(?!\d)",  # Match "Chat 01271153"
+    r"(?:^|\s)Chat\s*#\s*(\d+)(?!\d)",             # Match "Chat #01271153"
+    r"^[A-Z]{2,}\s*[:-]?\s*Chat\s+(\d+)(?!\d)",    # Match "TH: Chat 01271153"
+    r"^[A-Z]{2,}\s*[:-]?\s*Chat\s*#\s*(\d+)(?!\d)" # Match "TH: Chat #01271153"
+]
+CHAT_START_PATTERN = '|'.join(f"(?:{pattern})" for pattern in CHAT_START_PATTERNS)
+
+# Streaming mode: characters/bytes read per step, and the longest chat header expected
+# (a header cut by a read boundary is looked for again in this many trailing characters)
+STREAM_READ_SIZE = 64 * 1024
+STREAM_HEADER_OVERLAP = 256
+
+# Part of the cache key of anonymization results, together with a hash of the patterns.
+# Bump it when replacement logic changes without a pattern change.
+ANONYMIZER_RULES_REVISION = '3'
+
+# Worker processes for parallel multi-chat anonymization (1 disables the pool). Every
+# gunicorn worker starts its own pool, next to its extraction pool, so the default is small:
+# W workers run up to W x (ANONYMIZER_WORKERS + EXTRACTION_WORKERS) extra processes.
+ANONYMIZER_WORKERS = int(os.environ.get('ANONYMIZER_WORKERS', str(min(2, os.cpu_count() or 1))))
+# Files with fewer chats than this are anonymized serially; the pool round trip dominates
+ANONYMIZER_PARALLEL_MIN_CHATS = int(os.environ.get('ANONYMIZER_PARALLEL_MIN_CHATS', '8'))
+
+
+class SystemIdentifierIndex:
+    """
+    Per-text index answering "is this match a system identifier?"
+    
+    Built once per text: newline offsets (line lookup by bisection), the
+    positions of every identifier keyword (Chat/Case/Session/Ticket/Order/
+    Conversation/Transcript/#) and a per-line cache of the PREFIX-NNN and
+    leading-keyword checks. A match whose window holds no keyword is settled by
+    two bisections; otherwise the value's occurrences in the window are checked
+    against value-independent prefix patterns compiled once, instead of
+    compiling six patterns around re.escape(value) for every match.
+    """
+    
+    # Plain `re` on purpose: every pattern here is linear or bounded by the window, and
+    # the regex package folds non-ASCII case differently ('İ'), which would change decisions.
+    # Zero-width so overlapping keywords ("chaticket") are all recorded
+    _KEYWORDS = re.compile(r'(?=chat|case|session|ticket|order|conversation|transcript|#)', re.IGNORECASE)
+    _PREFIX_HEADER = re.compile(r'[A-Z]{2,}-\d+', re.IGNORECASE)
+    _LINE_KEYWORD = re.compile(r'(?:Chat|Case|Session|Ticket|Order|ID|Reference|Transaction)', re.IGNORECASE)
+    _LINE_SEPARATORS = re.compile(r'[\s_#:]*')
+    _DIGIT = re.compile(r'\d')
+    
+    # What may precede the value inside the window (each rule ends with the value, then (?!\d)).
+    # The original rf-strings evaluated '{2,}' as an f-string field, i.e. the literal group
+    # '(2,)'; that is kept so that preservation decisions do not change.
+    _WINDOW_PREFIXES = [
+        re.compile(r'\b(Chat|Case)[\s_#]*\Z', re.IGNORECASE),
+        re.compile(r'\b(Chat|Case)[\s_#]+ID[\s:]*\Z', re.IGNORECASE),
+        re.compile(r'\A[A-Z](2,)[\s:-]*(Chat|Case)[\s_#]*\Z', re.IGNORECASE),
+        re.compile(r'\b(chat|case)\b.*?[A-Z](2,)-\s*\Z', re.IGNORECASE),
+        re.compile(r'\b(?:session|ticket|order|conversation|transcript)[\s_#:]*\Z', re.IGNORECASE),
+        re.compile(r'#[\s]*\Z', re.IGNORECASE),
+    ]
+    
+    def __init__(self, text: str):
+        self.text = text
+        self._newlines = [m.start() for m in re.finditer('\n', text)]
+        self._keyword_starts = [m.start() for m in self._KEYWORDS.finditer(text)]
+        self._lines: Dict[int, Tuple[str, bool, Optional[Tuple[int, int]]]] = {}
+    
+    def _line(self, position: int) -> Tuple[str, bool, Optional[Tuple[int, int]]]:
+        """(stripped line, is PREFIX-NNN header, value start range after a leading keyword)"""
+        k = bisect.bisect_left(self._newlines, position)
+        line_start = self._newlines[k - 1] + 1 if k else 0
+        cached = self._lines.get(line_start)
+        if cached is None:
+            line_end = self._newlines[k] if k < len(self._newlines) else len(self.text)
+            context_line = self.text[line_start:line_end].strip()
+            keyword = self._LINE_KEYWORD.match(context_line)
+            value_range = None
+            if keyword:
+                # The value may start anywhere inside the separator run after the keyword
+                separators = self._LINE_SEPARATORS.match(context_line, keyword.end())
+                value_range = (keyword.end(), separators.end())
+            cached = (context_line, bool(self._PREFIX_HEADER.fullmatch(context_line)), value_range)
+            self._lines[line_start] = cached
+        return cached
+    
+    @staticmethod
+    def _occurrences(haystack: str, value: str, start: int, end: int) -> Optional[List[int]]:
+        """Case-insensitive start offsets of value in haystack[start:end]; None if not exactly decidable"""
+        if value.lower() == value.upper():
+            needle, window = value, haystack
+        else:
+            window = haystack[start:end]
+            if not window.isascii() or not value.isascii():
+                return None  # Unicode case folding: leave it to the regex path
+            needle, window, start, end = value.lower(), window.lower(), 0, len(window)
+            offsets = []
+            found = window.find(needle)
+            while found != -1:
+                offsets.append(found)
+                found = window.find(needle, found + 1)
+            return offsets
+        
+        offsets = []
+        found = window.find(needle, start, end)
+        while found != -1:
+            offsets.append(found - start)
+            found = window.find(needle, found + 1, end)
+        return offsets
+    
+    def _window_rules(self, window: str, value: str) -> bool:
+        offsets = self._occurrences(window, value, 0, len(window))
+        if offsets is None:
+            escaped = re.escape(value)
+            return any(
+                re.search(prefix.pattern[:-2] + escaped + r'(?!\d)', window, re.IGNORECASE)
+                for prefix in self._WINDOW_PREFIXES
+            )
+        
+        for offset in offsets:
+            value_end = offset + len(value)
+            if value_end < len(window) and self._DIGIT.match(window, value_end):
+                continue
+            prefix = window[:offset]
+            if any(rule.search(prefix) for rule in self._WINDOW_PREFIXES):
+                return True
+        return False
+    
+    def _line_rule(self, context_line: str, value_range: Optional[Tuple[int, int]], value: str) -> bool:
+        if value_range is None:
+            return False
+        lowest, highest = value_range
+        offsets = self._occurrences(context_line, value, lowest, min(highest + len(value), len(context_line)))
+        if offsets is None:
+            pattern = self._LINE_KEYWORD.pattern + self._LINE_SEPARATORS.pattern + re.escape(value)
+            return bool(re.match(pattern, context_line, re.IGNORECASE))
+        return any(offset <= highest - lowest for offset in offsets)
+    
+    def is_system_identifier(self, match_position: int, original_value: str) -> bool:
+        context_line, is_prefix_header, value_range = self._line(match_position)
+        
+        # Check if the entire line matches the [PREFIX]-[NUMBER] format
+        if is_prefix_header:
+            return True
+        
+        # Chat/Case numbers and other system identifiers: only possible with a keyword in the window
+        window_start = max(0, match_position - SYSTEM_ID_WINDOW)
+        window_end = match_position + SYSTEM_ID_WINDOW
+        k = bisect.bisect_left(self._keyword_starts, window_start)
+        if k < len(self._keyword_starts) and self._keyword_starts[k] < window_end:
+            if self._window_rules(self.text[window_start:window_end], original_value):
+                return True
+        
+        # Keywords at the start of the same line
+        return self._line_rule(context_line, value_range, original_value)
+
+
+class OffsetMap:
+    """
+    Span map from an anonymized text back to the text it was anonymized from
+    
+    Each span is (start, end, original_start, original_end): anonymized[start:end]
+    replaced original[original_start:original_end]. Text between spans is
+    unchanged, so every other position maps by the shift of the span before it.
+    """
+    
+    def __init__(self, spans: Optional[List[Tuple[int, int, int, int]]] = None):
+        self.spans = spans or []
+        self._starts = [span[0] for span in self.spans]
+    
+    def __len__(self):
+        return len(self.spans)
+    
+    def _to_original(self, position: int, is_end: bool) -> int:
+        index = bisect.bisect_left(self._starts, position) - 1
+        if index < 0:
+            return position
+        start, end, original_start, original_end = self.spans[index]
+        if position < end:
+            # Inside a replacement: widen to the whole original value
+            return original_end if is_end else original_start
+        return original_end + (position - end)
+    
+    def to_original(self, position: int) -> int:
+        """Original offset of an anonymized position (inside a replacement: its start)"""
+        return self._to_original(position, False)
+    
+    def original_span(self, start: int, end: int) -> Tuple[int, int]:
+        """Original (start, end) of anonymized[start:end], widened to whole replacements"""
+        return self._to_original(start, False), self._to_original(end, True)
+    
+    def compose(self, replacements: List[Tuple[int, int, int]]) -> 'OffsetMap':
+        """
+        Map for the text after one more pass of replacements
+        
+        Args:
+            replacements: (start, end, replacement_length) in this map's anonymized
+                coordinates, non-overlapping
+        
+        Returns:
+            A new map from the resulting text to the same original text. Spans that
+            overlap (an earlier replacement partly re-matched) merge into one.
+        """
+        # (start, end, length change) of every edited region, in current coordinates
+        regions = sorted(
+            [(start, end, 0) for start, end, _, _ in self.spans] +
+            [(start, end, length - (end - start)) for start, end, length in replacements]
+        )
+        spans = []
+        shift = 0
+        merged = None
+        for region in regions + [None]:
+            if region is not None and merged is not None and region[0] < merged[1]:
+                merged = (merged[0], max(merged[1], region[1]), merged[2] + region[2])
+                continue
+            if merged is not None:
+                start, end, delta = merged
+                original_start, original_end = self.original_span(start, end)
+                spans.append((start + shift, end + shift + delta, original_start, original_end))
+                shift += delta
+            merged = region
+        return OffsetMap(spans)
+
+
+class DigitRuns:
+    """
+    Digit-only words (\\b[0-9]+\\b) of the most recent text, found in one linear scan
+    
+    Shared by every digit-run rule, so the runs are tokenized once per version of
+    the text instead of once per pattern; a pass that replaced nothing reuses them.
+    """
+    
+    _RUN = re.compile(r'\b[0-9]+\b')
+    
+    def __init__(self):
+        self._text = None
+        self._runs: List[Tuple[int, int]] = []
+    
+    def of(self, text: str) -> List[Tuple[int, int]]:
+        if self._text is not text and self._text != text:
+            self._runs = [match.span() for match in self._RUN.finditer(text)]
+            self._text = text
+        return self._runs
+
+
+class DigitRunRule:
+    """
+    Linear-time equivalent of a pattern whose matches start at a digit run
+    
+    Runs are classified by length and leading digit; only the survivors are
+    confirmed with the original pattern anchored at the run, so every match
+    attempt is bounded and the results are exactly those of pattern.finditer().
+    """
+    
+    def __init__(self, pattern: str, digit_runs: DigitRuns, lengths, leading: str = '',
+                 plus_prefix: bool = False):
+        self.pattern = pattern
+        self._anchored = re.compile(pattern, re.IGNORECASE)
+        self._digit_runs = digit_runs
+        self._lengths = lengths
+        self._leading = leading
+        # The pattern may also start on a '+' directly in front of the run
+        self._plus_prefix = plus_prefix
+    
+    def finditer(self, text: str):
+        last_end = 0
+        for start, end in self._digit_runs.of(text):
+            if start < last_end or (end - start) not in self._lengths:
+                continue
+            if self._leading and text[start] not in self._leading:
+                continue
+            
+            candidates = (start,)
+            if self._plus_prefix and start > last_end and text[start - 1] == '+':
+                candidates = (start - 1, start)
+            for candidate in candidates:
+                match = self._anchored.match(text, candidate)
+                if match:
+                    last_end = match.end()
+                    yield match
+                    break
+
+
+class KeywordContextRule:
+    """
+    Digit run of a given length followed, later on the same line, by a keyword
+    
+    Replaces a `\\b([0-9]{6})\\b(?=.*(?:keywords))` lookahead, which rescans to the
+    end of the line for every candidate, with a walk over the keyword positions.
+    """
+    
+    def __init__(self, pattern: str, digit_runs: DigitRuns, length: int, keywords: str):
+        self.pattern = pattern
+        self._token = re.compile(rf'\b([0-9]{{{length}}})\b')
+        self._digit_runs = digit_runs
+        self._length = length
+        # Zero-width so overlapping keywords are all recorded
+        self._keywords = re.compile(rf'(?=(?:{keywords}))', re.IGNORECASE)
+    
+    def finditer(self, text: str):
+        keyword_starts = [match.start() for match in self._keywords.finditer(text)]
+        k = 0
+        line_end = -1
+        for start, end in self._digit_runs.of(text):
+            if end - start != self._length:
+                continue
+            if end > line_end:
+                line_end = text.find('\n', end)
+                if line_end == -1:
+                    line_end = len(text)
+            while k < len(keyword_starts) and keyword_starts[k] < end:
+                k += 1
+            if k < len(keyword_starts) and keyword_starts[k] < line_end:
+                yield self._token.match(text, start)
+
+
+class EmailRule:
+    """
+    Linear-time equivalent of the e-mail pattern, anchored on '@' positions
+    
+    Trying the pattern at every word boundary rescans the same local part again
+    and again ("a.b.c.d..." without an '@' is quadratic). Here the domain is
+    checked once per '@' and the local part is walked back once, then the
+    original pattern confirms the match at the first word boundary found.
+    """
+    
+    def __init__(self, pattern: str, local_chars: str, domain: str):
+        self.pattern = pattern
+        # Plain `re`: only ever anchored, and linear there. The regex package backtracks
+        # quadratically on the domain part ("a.a.a...") where re does not.
+        self._anchored = re.compile(pattern, re.IGNORECASE)
+        self._local_char = re.compile(local_chars, re.IGNORECASE)
+        self._domain = re.compile(domain, re.IGNORECASE)
+        self._boundary = re.compile(r'\b')
+    
+    def finditer(self, text: str):
+        last_end = 0
+        at = text.find('@')
+        while at != -1:
+            if at > last_end and self._domain.match(text, at + 1):
+                start = at
+                while start > last_end and self._local_char.match(text, start - 1):
+                    start -= 1
+                for candidate in range(start, at):
+                    if self._boundary.match(text, candidate):
+                        match = self._anchored.match(text, candidate)
+                        if match:
+                            last_end = match.end()
+                            yield match
+                            break
+            at = text.find('@', max(at + 1, last_end))
+
+
+def linear_time_rules() -> Dict[str, Any]:
+    """
+    Linear-time stand-ins for the anonymizer patterns that backtrack or rescan
+    
+    Keyed by the exact pattern string each rule is equivalent to: if a pattern
+    in ChatAnonymizer._initialize_patterns is edited, it no longer matches a key
+    and is simply compiled as a regex again.
+    """
+    digit_runs = DigitRuns()
+    rules = [
+        DigitRunRule(r'\b(?<![A-Z]{2}-)(?:\+?[1-9][0-9]{0,3}[-.\s]?)?[0-9]{7,15}\b', digit_runs,
+                     lengths=set(range(1, 5)) | set(range(7, 20)), plus_prefix=True),
+        EmailRule(r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b',
+                  local_chars=r'[A-Za-z0-9._%+-]', domain=r'[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b'),
+        KeywordContextRule(r'\b([0-9]{6})\b(?=.*(?:OTP|otp|code|verification))', digit_runs,
+                           length=6, keywords='OTP|otp|code|verification'),
+        DigitRunRule(r'\b(?<![A-Z]{2}-)(?<!Chat[\s_#])(?<!Case[\s_#])[0-9]{9,12}\b', digit_runs,
+                     lengths=range(9, 13)),
+        DigitRunRule(r'\b(?<![A-Z]{2}-)(?<!Chat[\s_#])(?<!ID[\s:])(?<!#)[0-9]{8,20}\b', digit_runs,
+                     lengths=range(8, 21)),
+        DigitRunRule(r'\b4[0-9]{12}(?:[0-9]{3})?\b', digit_runs, lengths=(13, 16), leading='4'),
+        DigitRunRule(r'\b5[1-5][0-9]{14}\b', digit_runs, lengths=(16,), leading='5'),
+        DigitRunRule(r'\b3[47][0-9]{13}\b', digit_runs, lengths=(15,), leading='3'),
+    ]
+    return {rule.pattern: rule for rule in rules}
+
+
 class ChatAnonymizer:
     """
     Anonymize sensitive information in chat transcripts using Python regex patterns
@@ -32,6 +425,32 @@ class ChatAnonymizer:
         
         # Patterns for different types of sensitive information
         self.patterns = self._initialize_patterns()
+        self._compiled_patterns = self._compile_patterns(self.patterns)
+        
+        # Identifies the rule set in anonymization cache keys
+        self.rules_version = hashlib.sha256(
+            (ANONYMIZER_RULES_REVISION + json.dumps(self.patterns, sort_keys=True)).encode()
+        ).hexdigest()[:12]
+    
+    @staticmethod
+    def _compile_patterns(patterns: Dict[str, List[str]]) -> Dict[str, List[Any]]:
+        """
+        Compile every pattern once, keeping type and pattern priority order
+        
+        Patterns with a linear-time equivalent (digit runs, keyword context,
+        e-mail) get that rule instead; all of them expose finditer().
+        
+        Plain `re` on purpose, not regex_guard: a guarded scan that runs out of
+        time skips the rest of its chunk, which here would leave values in clear
+        text, and the regex package treats case folding ('İ', 'ı') and word
+        boundaries next to combining marks differently. Every pattern left is
+        linear (bounded quantifiers only; see benchmark_anonymizer()).
+        """
+        rules = linear_time_rules()
+        return {
+            data_type: [rules.get(pattern) or re.compile(pattern, re.IGNORECASE) for pattern in type_patterns]
+            for data_type, type_patterns in patterns.items()
+        }
     
     def _initialize_patterns(self):
         """
@@ -105,42 +524,7 @@ class ChatAnonymizer:
         UPDATED: Now recognizes if a number is part of a [PREFIX]-[NUMBER] header.
     
         """
-        # Get the full line where the matched number was found
-        line_start = text.rfind('\n', 0, match_position) + 1
-        line_end = text.find('\n', match_position)
-        if line_end == -1:
-            line_end = len(text)
-        context_line = text[line_start:line_end].strip()
-
-        # NEW: Check if the entire line matches the [PREFIX]-[NUMBER] format
-        if re.fullmatch(r'[A-Z]{2,}-\d+', context_line, re.IGNORECASE):
-            return True
-
-        # PRIORITY 1: Check for chat or case numbers specifically
-        id_patterns = [
-            rf'\b(Chat|Case)[\s_#]*{re.escape(original_value)}(?!\d)',
-            rf'\b(Chat|Case)[\s_#]+ID[\s:]*{re.escape(original_value)}(?!\d)',
-            rf'^[A-Z]{2,}[\s:-]*(Chat|Case)[\s_#]*{re.escape(original_value)}(?!\d)',
-            rf'\b(chat|case)\b.*?[A-Z]{2,}-\s*{re.escape(original_value)}(?!\d)'
-        ]
-        for pattern in id_patterns:
-            if re.search(pattern, text[max(0, match_position-100):match_position+100], re.IGNORECASE):
-                return True
-
-        # PRIORITY 2: Check for other system identifiers
-        preserve_patterns = [
-            r'\b(?:session|ticket|order|conversation|transcript)[\s_#:]*' + re.escape(original_value) + r'(?!\d)',
-            r'#[\s]*' + re.escape(original_value) + r'(?!\d)',
-        ]
-        for pattern in preserve_patterns:
-            if re.search(pattern, text[max(0, match_position-100):match_position+100], re.IGNORECASE):
-                return True
-
-        # PRIORITY 3: Check for keywords on the same line
-        if re.match(r'^(?:Chat|Case|Session|Ticket|Order|ID|Reference|Transaction)[\s_#:]*' + re.escape(original_value), context_line, re.IGNORECASE):
-            return True
-                
-        return False
+        return SystemIdentifierIndex(text).is_system_identifier(match_position, original_value)
 
     def _generate_replacement(self, data_type: str, original_value: str) -> str:
         """Generate consistent replacement for sensitive data"""
@@ -170,20 +554,50 @@ class ChatAnonymizer:
     def anonymize_text(self, text: str) -> Tuple[str, Dict]:
         """
         Anonymize sensitive information in text
+        
+        Each precompiled pattern scans the text once, in priority order, and its
+        replacements are written as a list of segments joined once per pattern
+        (instead of rebuilding the whole string for every match). Later patterns
+        still see earlier replacements, so results are unchanged.
+        """
+        anonymized_text, anonymization_report, _ = self.anonymize_with_offsets(text)
+        return anonymized_text, anonymization_report
+    
+    def anonymize_with_offsets(self, text: str) -> Tuple[str, Dict, OffsetMap]:
+        """
+        Anonymize text once and keep the offset map back to the original
+        
+        Views derived from the chat (processed content, previews, the formatted
+        transcript) should be built from the anonymized text instead of being
+        anonymized again; the map traces any position in them back to the raw chat.
+        
+        Returns:
+            Anonymized text, report (as anonymize_text), OffsetMap
         """
         anonymized_text = text
+        offsets = OffsetMap()
         anonymization_report = {
             'total_replacements': 0,
             'replacements_by_type': {},
             'patterns_found': []
         }
         
+        # Keyword and line offsets of the original text, shared by every identifier check
+        identifiers = SystemIdentifierIndex(text)
+        
         # Process each type of sensitive information
-        for data_type, patterns in self.patterns.items():
+        for data_type, patterns in self._compiled_patterns.items():
             type_replacements = 0
             
             for pattern in patterns:
-                matches = list(re.finditer(pattern, anonymized_text, re.IGNORECASE))
+                matches = list(pattern.finditer(anonymized_text))
+                if not matches:
+                    continue
+                
+                # Segments of the new text, collected right to left
+                segments = []
+                replaced = []
+                position = len(anonymized_text)
                 
                 for match in reversed(matches):  # Reverse to maintain string positions
                     original_value = match.group(0)
@@ -194,7 +608,7 @@ class ChatAnonymizer:
                         continue
                     
                     # FIXED: Pass original_value to the system identifier check
-                    if self._is_system_identifier(text, match_position, original_value):
+                    if identifiers.is_system_identifier(match_position, original_value):
                         print(f"Preserving system identifier: '{original_value}'")
                         continue
                     
@@ -207,21 +621,95 @@ class ChatAnonymizer:
                     
                     # Replace in text
                     start, end = match.span()
-                    anonymized_text = anonymized_text[:start] + replacement + anonymized_text[end:]
+                    segments.append(anonymized_text[end:position])
+                    segments.append(replacement)
+                    replaced.append((start, end, len(replacement)))
+                    position = start
                     
                     type_replacements += 1
                     anonymization_report['patterns_found'].append({
                         'type': data_type,
                         'original': original_value,
                         'replacement': replacement,
-                        'position': start
+                        'position': start,
+                        'original_span': offsets.original_span(start, end)
                     })
+                
+                segments.append(anonymized_text[:position])
+                anonymized_text = ''.join(reversed(segments))
+                if replaced:
+                    offsets = offsets.compose(replaced[::-1])
             
             if type_replacements > 0:
                 anonymization_report['replacements_by_type'][data_type] = type_replacements
                 anonymization_report['total_replacements'] += type_replacements
         
-        return anonymized_text, anonymization_report
+        return anonymized_text, anonymization_report, offsets
+    
+    def anonymize_cached(self, text: str) -> Tuple[str, Dict, OffsetMap]:
+        """
+        anonymize_with_offsets() from a fresh pseudonym numbering, through the anonymization cache
+        
+        The counters and map are reset first, so the result depends on the text
+        alone; on a cache hit they are rebuilt as if the text had been anonymized.
+        """
+        self._reset_state()
+        cache = anonymization_cache.get_cache()
+        cache_key = cache.key(self.rules_version, 'text', text) if cache else None
+        payload = cache.get(cache_key) if cache else None
+        if payload is not None:
+            anonymized_text, report, offsets = self._restore_payload(text, payload)
+            self._replay_report(report)
+            return anonymized_text, report, offsets
+        
+        anonymized_text, report, offsets = self.anonymize_with_offsets(text)
+        if cache:
+            payload = self._cache_payload(text, anonymized_text, report, offsets)
+            if payload is not None:
+                cache.put(cache_key, payload)
+        return anonymized_text, report, offsets
+    
+    def _reset_state(self):
+        self.replacement_counters = {key: 0 for key in self.replacement_counters}
+        self.anonymization_map = {}
+    
+    @staticmethod
+    def _cache_payload(text: str, anonymized_text: str, report: Dict,
+                       offsets: Optional[OffsetMap] = None) -> Optional[Dict]:
+        """
+        Cache entry for a result, holding no original values
+        
+        Each found value keeps its span in the original text instead. Returns None
+        if a value can't be restored that way (it overlapped an earlier replacement).
+        """
+        patterns_found = []
+        for entry in report['patterns_found']:
+            start, end = entry['original_span']
+            if text[start:end] != entry['original']:
+                return None
+            patterns_found.append({key: value for key, value in entry.items() if key != 'original'})
+        
+        payload = {'anonymized': anonymized_text, 'report': dict(report, patterns_found=patterns_found)}
+        if offsets is not None:
+            payload['offsets'] = offsets.spans
+        return payload
+    
+    @staticmethod
+    def _restore_payload(text: str, payload: Dict) -> Tuple[str, Dict, Optional[OffsetMap]]:
+        """Result of a cache entry, with the original values read back from text"""
+        patterns_found = []
+        for entry in payload['report']['patterns_found']:
+            start, end = entry['original_span']
+            patterns_found.append(dict(entry, original=text[start:end], original_span=(start, end)))
+        offsets = OffsetMap([tuple(span) for span in payload['offsets']]) if 'offsets' in payload else None
+        return payload['anonymized'], dict(payload['report'], patterns_found=patterns_found), offsets
+    
+    def _replay_report(self, report: Dict):
+        """Update the counters and map as anonymizing produced report would have"""
+        for entry in report['patterns_found']:
+            if entry['original'] not in self.anonymization_map:
+                self.anonymization_map[entry['original']] = entry['replacement']
+                self.replacement_counters[entry['type']] += 1
     
     def _split_text_into_chats(self, text: str) -> List[Dict[str, Any]]:
         """
@@ -234,19 +722,10 @@ class ChatAnonymizer:
         MIN_LINES = 3
         MIN_CHARS = 50
         
-        # Use the EXACT same patterns as EnhancedChatProcessor
-        chat_start_patterns = [
-            r"(?:^|\s)Chat\s+(?:ID\s*:?\s*)?(\d+)(?!\d)",  # Match "Chat 01271153"
-            r"(?:^|\s)Chat\s*#\s*(\d+)(?!\d)",             # Match "Chat #01271153"
-            r"^[A-Z]{2,}\s*[:-]?\s*Chat\s+(\d+)(?!\d)",    # Match "TH: Chat 01271153"
-            r"^[A-Z]{2,}\s*[:-]?\s*Chat\s*#\s*(\d+)(?!\d)" # Match "TH: Chat #01271153"
-        ]
-        
-        # Create combined pattern
-        combined_pattern = '|'.join(f"(?:{pattern})" for pattern in chat_start_patterns)
+        combined_pattern = CHAT_START_PATTERN
         
         # Split by chat number patterns
-        segments = re.split(f"({combined_pattern})", text, flags=re.IGNORECASE | re.MULTILINE)
+        segments = regex_guard.split(f"({combined_pattern})", text, flags=re.IGNORECASE | re.MULTILINE)
         
         # Filter out empty segments
         segments = [segment for segment in segments if segment and not segment.isspace()]
@@ -258,7 +737,7 @@ class ChatAnonymizer:
         
         for i, segment in enumerate(segments):
             # Check if segment is a chat boundary
-            if re.match(combined_pattern, segment, re.IGNORECASE):
+            if regex_guard.match(combined_pattern, segment, re.IGNORECASE):
                 # Process previous chat if it exists and meets minimum requirements
                 if current_chat.strip():
                     lines = [line for line in current_chat.split('\n') if line.strip()]
@@ -313,7 +792,7 @@ class ChatAnonymizer:
         ]
         
         for pattern in patterns:
-            match = re.search(pattern, chat_text, re.IGNORECASE)
+            match = regex_guard.search(pattern, chat_text, re.IGNORECASE)
             if match:
                 chat_id = match.group(1)
                 
@@ -344,7 +823,7 @@ class ChatAnonymizer:
         ]
 
         for pattern in timestamp_patterns:
-            match = re.search(pattern, chat_text, re.IGNORECASE)
+            match = regex_guard.search(pattern, chat_text, re.IGNORECASE)
             if match:
                 try:
                     timestamp_str = match.group(1).strip()
@@ -364,80 +843,27 @@ class ChatAnonymizer:
     
     def _clean_and_process_chat(self, chat_text: str) -> str:
         """Clean and format chat content using the same logic as EnhancedChatProcessor"""
-        lines = chat_text.split('\n')
-        processed_lines = []
-        has_valid_content = False
-        speaker_patterns = {
-            'customer': [
-                r'^(?:Customer|Client|Visitor|User|Guest)',
-                r'^\(\d+[ms]\)\s*(?:Customer|Client|Visitor|User|Guest)',
-                r'^.*?(?:Customer|Client|Visitor|User|Guest)\s*:'
-            ],
-            'agent': [
-                r'^(?:Agent|Support|Assistant|Representative|Bot|Chatbot|Pepper)',
-                r'^\(\d+[ms]\)\s*(?:Agent|Support|Assistant|Representative|Bot|Chatbot|Pepper)',
-                r'^.*?(?:Agent|Support|Assistant|Representative|Bot|Chatbot|Pepper)\s*:'
-            ]
-        }
-
-        skip_patterns = [
-            r'^\s*\{ChatWindowButton:',
-            r'^\s*Page \d+ of \d+',
-            r'^\s*Report generated',
-            r'^\s*[-=*_]{3,}\s*$'
-        ]
-
-        skip_pattern = '|'.join(skip_patterns)
-        has_conversation = False
-
-        for line in lines:
-            line = line.strip()
-            if not line:
-                continue
-
-            if re.match(skip_pattern, line, re.IGNORECASE):
-                continue
-
-            is_message = False
-            # Check for customer messages
-            for pattern in speaker_patterns['customer']:
-                if re.match(pattern, line, re.IGNORECASE):
-                    is_message = True
-                    has_valid_content = True
-                    has_conversation = True
-                    line = re.sub(r'^\(\d+[ms]\)\s*', '', line)
-                    line = re.sub(r'^.*?(?:Customer|Client|Visitor|User|Guest)\s*:', 'Customer:', line, flags=re.IGNORECASE)
-                    break
-
-            if not is_message:
-                for pattern in speaker_patterns['agent']:
-                    if re.match(pattern, line, re.IGNORECASE):
-                        is_message = True
-                        has_valid_content = True
-                        has_conversation = True
-                        line = re.sub(r'^\(\d+[ms]\)\s*', '', line)
-                        if re.match(r'^.*?(Bot|Chatbot|Pepper)\s*:', line, re.IGNORECASE):
-                            line = re.sub(r'^.*?(Bot|Chatbot|Pepper)\s*:', r'\1:', line, flags=re.IGNORECASE)
-                        else:
-                            line = re.sub(r'^.*?(?:Agent|Support|Assistant|Representative)\s*:', 'Agent:', line, flags=re.IGNORECASE)
-                        break
-
-            if is_message:
-                processed_lines.append(line)
-            elif line.strip():
-                processed_lines.append(line)
-
-        if has_valid_content and has_conversation:
-            return '\n'.join(processed_lines)
-        return ''
-    
-    def anonymize_multiple_chats(self, file_content: str) -> Dict:
+        return transcript_tokenizer.render_processed(transcript_tokenizer.tokenize(chat_text))
+    
+    def anonymize_multiple_chats(self, file_content: str, parallel: Optional[bool] = None,
+                                 consistent_map: bool = True) -> Dict:
         """
         Anonymize multiple chats from a file using the proven batch analysis logic
+        
+        Args:
+            file_content: Text of the whole export
+            parallel: Spread the chats over the process pool. Defaults to True when
+                the file has at least ANONYMIZER_PARALLEL_MIN_CHATS chats and more
+                than one worker is configured.
+            consistent_map: In parallel mode, number pseudonyms across the whole file
+                exactly as serial mode does (same value, same pseudonym, in every
+                chat). False numbers each chat independently and skips the second pass.
+        
+        Returns:
+            Combined result with per-chat reports
         """
         # Reset counters for new file
-        self.replacement_counters = {key: 0 for key in self.replacement_counters}
-        self.anonymization_map = {}
+        self._reset_state()
         
         # Use the same chat splitting logic as batch analysis
         individual_chats = self._split_text_into_chats(file_content)
@@ -461,11 +887,39 @@ class ChatAnonymizer:
             'patterns_found': []
         }
         
-        for chat in individual_chats:
-            print(f"Anonymizing chat: {chat['id']}")
-            
-            # Anonymize this chat
-            anonymized_text, report = self.anonymize_text(chat['content'])
+        if parallel is None:
+            parallel = ANONYMIZER_WORKERS > 1 and len(individual_chats) >= ANONYMIZER_PARALLEL_MIN_CHATS
+        
+        contents = [chat['content'] for chat in individual_chats]
+        outcomes = None
+        
+        # The whole file is one cache entry: pseudonyms are numbered across its chats
+        cache = anonymization_cache.get_cache()
+        cache_key = cache.key(self.rules_version, 'chats', file_content) if cache else None
+        cached = cache.get(cache_key) if cache else None
+        if cached is not None and len(cached['chats']) == len(contents):
+            outcomes = [self._restore_payload(content, entry)[:2] for content, entry in zip(contents, cached['chats'])]
+            for _, report in outcomes:
+                self._replay_report(report)
+        else:
+            cached = None
+        
+        if parallel and outcomes is None:
+            try:
+                outcomes = self._anonymize_chats_parallel(contents, consistent_map)
+            except (BrokenProcessPool, OSError) as pool_error:
+                print(f"⚠️ [Anonymizer] Process pool unavailable ({pool_error}), anonymizing serially")
+                shutdown_anonymization_pool()
+                self._reset_state()
+        
+        for index, chat in enumerate(individual_chats):
+            if outcomes is None:
+                print(f"Anonymizing chat: {chat['id']}")
+                
+                # Anonymize this chat
+                anonymized_text, report = self.anonymize_text(chat['content'])
+            else:
+                anonymized_text, report = outcomes[index]
             
             anonymized_chats.append({
                 'original_id': chat['id'],
@@ -489,6 +943,14 @@ class ChatAnonymizer:
         
         combined_report['total_replacements'] = total_replacements
         
+        if cache and cached is None:
+            payloads = [
+                self._cache_payload(chat['original_content'], chat['anonymized_content'], chat['anonymization_report'])
+                for chat in anonymized_chats
+            ]
+            if all(payload is not None for payload in payloads):
+                cache.put(cache_key, {'chats': payloads})
+        
         # Create combined anonymized content preserving original chat structure
         combined_anonymized = '\n\n'.join([
             chat['anonymized_content']
@@ -508,15 +970,190 @@ class ChatAnonymizer:
         
         return result
     
+    def _anonymize_chats_parallel(self, contents: List[str], consistent_map: bool) -> List[Tuple[str, Dict]]:
+        """
+        Anonymize chats on the process pool, results in input order
+        
+        Pseudonym numbers depend on the order in which values are first seen, so
+        with consistent_map the work is done in two passes:
+        
+        1. Every chat is anonymized independently (numbered from zero). Its report
+           lists the values found in processing order.
+        2. Walking those reports in chat order, values are numbered here exactly as
+           the serial loop would. Each chat whose pass-1 pseudonyms differ is then
+           anonymized again, seeded with its share of the map, so it never has to
+           number anything itself.
+        
+        A chat whose second pass finds a different sequence of values (a
+        pseudonym's own digits changed what a later pattern matched) is redone
+        serially from that chat on, so the output always equals serial mode.
+        """
+        pool = get_anonymization_pool()
+        chunksize = max(1, len(contents) // (ANONYMIZER_WORKERS * 4))
+        first_pass = list(pool.map(_anonymize_in_worker, contents, chunksize=chunksize))
+        if not consistent_map:
+            return first_pass
+        
+        # Number the values in serial order, remembering the state before each chat
+        counters_before = []
+        new_values = []
+        seeds = []
+        for anonymized_text, report in first_pass:
+            counters_before.append(dict(self.replacement_counters))
+            added = []
+            for found in report['patterns_found']:
+                original = found['original']
+                if original not in self.anonymization_map:
+                    self.anonymization_map[original] = self._generate_replacement(found['type'], original)
+                    added.append(original)
+            new_values.append(added)
+            seeds.append({found['original']: self.anonymization_map[found['original']]
+                          for found in report['patterns_found']})
+        
+        # Redo only the chats whose pass-1 numbering differs from the global one
+        redo = [
+            index for index, (anonymized_text, report) in enumerate(first_pass)
+            if any(found['replacement'] != seeds[index][found['original']] for found in report['patterns_found'])
+        ]
+        outcomes = list(first_pass)
+        second_pass = pool.map(_anonymize_in_worker, [contents[i] for i in redo], [seeds[i] for i in redo],
+                               chunksize=max(1, len(redo) // (ANONYMIZER_WORKERS * 4)))
+        for index, outcome in zip(redo, second_pass):
+            outcomes[index] = outcome
+        
+        for index, (anonymized_text, report) in enumerate(outcomes):
+            originals = [found['original'] for found in report['patterns_found']]
+            if originals != [found['original'] for found in first_pass[index][1]['patterns_found']]:
+                print(f"⚠️ [Anonymizer] Chat {index} matched differently once renumbered, finishing serially")
+                for added in new_values[index:]:
+                    for original in added:
+                        del self.anonymization_map[original]
+                self.replacement_counters = counters_before[index]
+                outcomes[index:] = [self.anonymize_text(content) for content in contents[index:]]
+                break
+        
+        return outcomes
+    
+    def anonymize_stream(self, chunks: Iterable[str], output: TextIO) -> Dict:
+        """
+        Anonymize an export of any size chat by chat, writing to output as it goes
+        
+        Text is buffered only until the next chat header is known to be complete;
+        everything before that header is split, anonymized and written out, so
+        memory stays at about one chat plus one read. The output is the same as
+        anonymize_multiple_chats(text)['anonymized_transcript'].
+        
+        Args:
+            chunks: Decoded text in pieces of any size
+            output: Text file the anonymized chats are written to
+        
+        Returns:
+            Summary report (counts only, no per-match list)
+        """
+        self._reset_state()
+        header = regex_guard.compile(CHAT_START_PATTERN, re.IGNORECASE | re.MULTILINE)
+        
+        summary = {
+            'chat_count': 0,
+            'original_length': 0,
+            'anonymized_length': 0,
+            'anonymization_report': {'total_replacements': 0, 'replacements_by_type': {}},
+            'timestamp': datetime.now().isoformat(),
+            'anonymization_id': str(uuid.uuid4())[:8]
+        }
+        report_totals = summary['anonymization_report']
+        
+        def flush(region: str):
+            for chat in self._split_text_into_chats(region):
+                anonymized_text, report = self.anonymize_text(chat['content'])
+                if summary['chat_count']:
+                    output.write('\n\n')
+                    summary['anonymized_length'] += 2
+                output.write(anonymized_text)
+                summary['anonymized_length'] += len(anonymized_text)
+                summary['chat_count'] += 1
+                report_totals['total_replacements'] += report['total_replacements']
+                for data_type, count in report['replacements_by_type'].items():
+                    report_totals['replacements_by_type'][data_type] = \
+                        report_totals['replacements_by_type'].get(data_type, 0) + count
+        
+        buffer = ''
+        scan_from = 0
+        for chunk in chunks:
+            summary['original_length'] += len(chunk)
+            buffer += chunk
+            
+            # A header is final once something follows it; one touching the end may still grow
+            cut = 0
+            for match in header.finditer(buffer, scan_from):
+                if match.end() >= len(buffer):
+                    break
+                if match.start() > 0:
+                    cut = match.start()
+                scan_from = match.end()
+            scan_from = max(scan_from, len(buffer) - STREAM_HEADER_OVERLAP)
+            
+            if cut:
+                flush(buffer[:cut])
+                buffer = buffer[cut:]
+                scan_from -= cut
+        
+        if buffer:
+            flush(buffer)
+        
+        if not summary['chat_count']:
+            summary['error'] = 'No chats found in the uploaded file'
+        print(f"🔒 [Anonymizer] Streamed {summary['chat_count']} chats, "
+              f"{report_totals['total_replacements']} replacements, {summary['original_length']} characters")
+        return summary
+    
+    def anonymize_binary_stream(self, stream: BinaryIO, output: TextIO,
+                                encodings: Tuple[str, ...] = ('utf-8-sig', 'latin-1')) -> Dict:
+        """
+        Decode an uploaded file incrementally and anonymize it with anonymize_stream()
+        
+        Each encoding is tried in turn; if decoding fails part way, the upload and
+        the output are rewound and the next encoding starts over.
+        
+        Args:
+            stream: Seekable binary file (e.g. a Werkzeug upload stream)
+            output: Seekable text file for the anonymized chats
+            encodings: Encodings to try, in order
+        
+        Returns:
+            Summary report from anonymize_stream(), plus the encoding used
+        """
+        for encoding in encodings:
+            decoder = codecs.getincrementaldecoder(encoding)()
+            stream.seek(0)
+            output.seek(0)
+            output.truncate()
+            
+            def decoded_chunks():
+                while True:
+                    data = stream.read(STREAM_READ_SIZE)
+                    if not data:
+                        tail = decoder.decode(b'', final=True)
+                        if tail:
+                            yield tail
+                        return
+                    yield decoder.decode(data)
+            
+            try:
+                summary = self.anonymize_stream(decoded_chunks(), output)
+            except UnicodeDecodeError as e:
+                print(f"❌ Failed to decode with {encoding}: {str(e)}")
+                continue
+            summary['encoding'] = encoding
+            return summary
+        
+        raise ValueError("Unable to decode the uploaded file with any supported encoding")
+    
     def anonymize_chat_transcript(self, transcript: str) -> Dict:
         """
         Anonymize a complete chat transcript (single chat)
         """
-        # Reset counters for new transcript
-        self.replacement_counters = {key: 0 for key in self.replacement_counters}
-        self.anonymization_map = {}
-        
-        anonymized_text, report = self.anonymize_text(transcript)
+        anonymized_text, report, _ = self.anonymize_cached(transcript)
         
         result = {
             'original_length': len(transcript),
@@ -574,6 +1211,47 @@ class ChatAnonymizer:
         
         return "\n".join(summary_lines)
 
+# ================ PROCESS POOL ================
+# One warm pool per process: each worker builds its ChatAnonymizer (and compiles
+# every pattern) once in the initializer, then serves chats for the process lifetime.
+
+_worker_anonymizer: Optional[ChatAnonymizer] = None
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def _init_worker():
+    global _worker_anonymizer
+    _worker_anonymizer = ChatAnonymizer()
+
+
+def _anonymize_in_worker(content: str, seed_map: Optional[Dict[str, str]] = None) -> Tuple[str, Dict]:
+    """Anonymize one chat in a pool worker, numbering from zero or from a pre-assigned map"""
+    anonymizer = _worker_anonymizer
+    anonymizer.replacement_counters = {key: 0 for key in anonymizer.replacement_counters}
+    anonymizer.anonymization_map = dict(seed_map) if seed_map else {}
+    return anonymizer.anonymize_text(content)
+
+
+def get_anonymization_pool() -> ProcessPoolExecutor:
+    """The shared, lazily started anonymization pool"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=ANONYMIZER_WORKERS, initializer=_init_worker)
+            print(f"🧵 [Anonymizer] Started process pool with {ANONYMIZER_WORKERS} workers")
+        return _pool
+
+
+def shutdown_anonymization_pool():
+    """Stop the pool (it is restarted on next use)"""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+
 # Test function to verify it works with your chat format
 def test_anonymizer():
     """Test with Vietnamese chat format"""
@@ -609,5 +1287,65 @@ Chat Started: Wednesday, March 05, 2025, 16:07:05 (+0800)
     
     return result
 
+# (input, expected output) pairs whose results once changed by accident
+REGRESSION_CASES = [
+    # `re` folds 'İ' into [A-Z] under IGNORECASE; the regex package does not
+    ('Passport İ5764955 please', 'Passport ID02FA53BB please'),
+    # A combining mark (U+0301) right before a digit run is a word boundary for `re` only
+    ('Ref e\u03015764955 x', 'Ref e\u0301+XX-XXX-XXX-0001 x'),
+]
+
+def check_regressions() -> bool:
+    """Run REGRESSION_CASES through a fresh anonymizer; True if all of them pass"""
+    passed = True
+    for text, expected in REGRESSION_CASES:
+        anonymized, _ = ChatAnonymizer().anonymize_text(text)
+        ok = anonymized == expected
+        passed = passed and ok
+        print(f"{'✅' if ok else '❌'} {text!r} -> {anonymized!r}" + ('' if ok else f" (expected {expected!r})"))
+    return passed
+
+def benchmark_anonymizer(sizes: Tuple[int, ...] = (50_000, 100_000, 200_000)) -> Dict[str, List[float]]:
+    """
+    Time anonymize_text on pathological inputs of growing size
+    
+    Every pattern must stay linear: doubling the input should roughly double
+    the time. A growth factor near 4 per doubling means something backtracks
+    or rescans again.
+    
+    Returns:
+        Seconds per input kind, one entry per size
+    """
+    generators = {
+        'long digit run': lambda n: '1' * n,
+        '6-digit numbers, keyword at line end': lambda n: '123456 ' * (n // 7) + 'code',
+        '6-digit numbers, no keyword': lambda n: '123456 ' * (n // 7),
+        'dotted words without @': lambda n: 'a.' * (n // 2),
+        'long domain after @': lambda n: 'a@' + 'a.' * (n // 2),
+        'digit groups with separators': lambda n: '12-' * (n // 3),
+        'short prefixes before numbers': lambda n: '+12 1234 ' * (n // 9),
+    }
+    
+    timings = {}
+    for name, generate in generators.items():
+        timings[name] = []
+        for size in sizes:
+            text = generate(size)
+            started = time.perf_counter()
+            ChatAnonymizer().anonymize_text(text)
+            timings[name].append(time.perf_counter() - started)
+        
+        growth = [later / earlier for earlier, later in zip(timings[name], timings[name][1:]) if earlier > 0]
+        worst = max(growth) if growth else 0.0
+        flag = "✅" if worst < 3 else "⚠️"
+        print(f"{flag} {name}: " + ", ".join(f"{t:.3f}s" for t in timings[name]) + f" (worst growth x{worst:.1f})")
+    
+    return timings
+
 if __name__ == "__main__":
-    test_anonymizer()
+    if '--benchmark' in sys.argv:
+        benchmark_anonymizer()
+    elif '--check' in sys.argv:
+        sys.exit(0 if check_regressions() else 1)
+    else:
+        test_anonymizer()
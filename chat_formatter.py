@@ -0,0 +1 @@
+chat_formatter,py
\ No newline at end of file
@@ -4,7 +4,13 @@ import concurrent.futures
 from knowledge_base import KnowledgeBase
 from chat_formatter import format_transcript_for_ai
 import re
-from typing import Optional, Dict, Tuple
+import hashlib
+import threading
+from collections import Counter, OrderedDict, deque
+from functools import lru_cache
+from typing import Optional, Dict, Tuple, List
+
+import regex_guard
 
 # Import utilities from utils.py
 from utils import (
@@ -17,80 +23,378 @@ from utils import (
     load_evaluation_rules
 )
 
+# FIXED: Use the OFFICIAL 59 chat reason categories from QA_prompt.md
+# 🔄 FUTURE UPDATES: When new categories are added, just add them to this list below
+# Keep lowercase, use hyphens (not underscores), and add a comment with the date
+OFFICIAL_CATEGORIES = [
+    # Application & Account Setup (1-8)
+    'application - status', 'archiving request', 'automated close', 
+    'backoffice internal request', 'banned country non-residency check',
+    'cash bonus', 'client exit', 'close account',
+    
+    # Finance & Deposits (9-17)
+    'credit card issue', 'crypto trading', 'duplicate case',
+    'education/tools', 'escalated to legal & compliance', 
+    'feedback responses', 'finance - deposit', 'finance - general',
+    'finance - withdrawal',
+    
+    # General Account & Support (18-21)
+    'general account admin', 'general query', 'gold rebate', 
+    'ib/partners',
+    
+    # Technical Issues (22-27)
+    'incident / outage', 'instrument depreciation emails',
+    'leverage change', 'login issues - my account', 
+    'login issues - sca', 'login issues - trading account',
+    
+    # Marketing & Programs (28-31)
+    'marketing', 'mark up increase', 'negative balance adjustment',
+    'pepperstone pro q\'s',
+    
+    # Platforms (32-36)
+    'platform - ctrader', 'platform - mac', 'platform - mt4/mt5',
+    'platform - pepperstone app', 'platform - pepperstone webtrader',
+    
+    # Promotions & Regulation (37-39)
+    'promotions', 'regulation/licensing', 'sales lead',
+    
+    # Social & Trading (40-44)
+    'social - no response required', 'social - separate case created',
+    'social trading/third-party', 'sophisticated investor', 'spams',
+    
+    # Statements & Support (45-50)
+    'statements', 'support internal request', 'swap-free', 'tax',
+    'thai bank book', 'trade investigation',
+    
+    # Trading Conditions (51-55)
+    'trading - conditions/instruments', 'trading - issues',
+    'tradingview', 'trading - vps', 'unarchiving',
+    
+    # Website Issues (56-59)
+    'website (authenticated) - my account', 
+    'website (unauthenticated) - my account',
+    'website - main site', 'website - sca'
+    
+    # ✨ ADD NEW CATEGORIES BELOW THIS LINE ✨
+    # Example format:
+    # # New Category Group (60-62) - Added YYYY-MM-DD
+    # 'new category name',
+    # 'another category',
+]
+
+# Multiple patterns for different chat formats, in priority order
+CATEGORY_PATTERNS = [
+    r'\*\*Chat reason:\s*(.+?)\*\*',        # **Chat reason: General Query**
+    r'Chat reason:\s*(.+?)(?:\n|$)',         # Chat reason: General Query
+    r'Category:\s*(.+?)(?:\n|$)',            # Category: General Query
+    r'Reason for chat:\s*(.+?)(?:\n|$)',     # Reason for chat: ...
+    r'Issue type:\s*(.+?)(?:\n|$)',          # Issue type: ...
+    r'Topic:\s*(.+?)(?:\n|$)',               # Topic: ...
+    r'Subject:\s*(.+?)(?:\n|$)',             # Subject: ...
+    r'Type:\s*(.+?)(?:\n|$)',                # Type: ...
+]
+
+# Number of transcripts whose category result is memoized (retries hit the cache)
+CATEGORY_CACHE_SIZE = 2048
+
+# Fuzzy category resolution: a tag within int(len * ratio) edits (capped) of an
+# official category counts as that category ("Finance-Withdrawl"). Failing that, a
+# tag whose words all belong to exactly one official category resolves to it if they
+# cover at least CATEGORY_WORD_COVERAGE of that category's words ("Platform MT5" ->
+# 'platform - mt4/mt5', 2 of 3 words); "MT5" or "Thai" alone stay unresolved.
+CATEGORY_FUZZY_RATIO = 0.15
+CATEGORY_MAX_DISTANCE = 3
+CATEGORY_WORD_COVERAGE = 0.6
+
+_CATEGORY_NORMALIZE_REGEX = re.compile(r'[\W_]+')
+_CATEGORY_WORD_REGEX = re.compile(r'[^\W_]+')
+
+
+def normalize_category_key(category: str) -> str:
+    """Lowercase alphanumerics only: 'Finance - Withdrawal' -> 'financewithdrawal'"""
+    return _CATEGORY_NORMALIZE_REGEX.sub('', category.lower())
+
+
+def _bigrams(word: str) -> List[str]:
+    return [word[i:i + 2] for i in range(len(word) - 1)]
+
+
+def levenshtein(a: str, b: str, max_distance: Optional[int] = None) -> int:
+    """
+    Edit distance between a and b
+
+    With max_distance only a diagonal band of the DP table is computed, and
+    max_distance + 1 is returned as soon as the distance must exceed it.
+    """
+    if a == b:
+        return 0
+    if len(a) < len(b):
+        a, b = b, a
+    if max_distance is None:
+        max_distance = len(a)
+    too_far = max_distance + 1
+    if len(a) - len(b) > max_distance:
+        return too_far
+
+    previous = [j if j <= max_distance else too_far for j in range(len(b) + 1)]
+    for i in range(1, len(a) + 1):
+        char_a = a[i - 1]
+        current = [too_far] * (len(b) + 1)
+        current[0] = row_min = i if i <= max_distance else too_far
+        for j in range(max(1, i - max_distance), min(len(b), i + max_distance) + 1):
+            cost = previous[j - 1] + (char_a != b[j - 1])
+            if previous[j] + 1 < cost:
+                cost = previous[j] + 1
+            if current[j - 1] + 1 < cost:
+                cost = current[j - 1] + 1
+            current[j] = cost
+            if cost < row_min:
+                row_min = cost
+        if row_min > max_distance:
+            return too_far
+        previous = current
+    return min(previous[-1], too_far)
+
+
+class NGramIndex:
+    """
+    Bigram signature index for nearest-neighbour lookup under edit distance
+
+    One edit destroys at most two bigrams, so a word within k edits of the
+    query must share at least max(len) - 1 - 2k bigrams with it. Only words of
+    a compatible length that pass this count get a (banded) Levenshtein.
+    """
+
+    def __init__(self, words: List[str]):
+        self._words = list(words)
+        grams_per_word = [Counter(_bigrams(word)) for word in self._words]
+        # bigram -> [(word_id, occurrences in that word)]
+        self._postings: Dict[str, List[Tuple[int, int]]] = {}
+        self._by_length: Dict[int, List[int]] = {}
+        for word_id, (word, grams) in enumerate(zip(self._words, grams_per_word)):
+            self._by_length.setdefault(len(word), []).append(word_id)
+            for gram, count in grams.items():
+                self._postings.setdefault(gram, []).append((word_id, count))
+
+    def nearest(self, word: str, max_distance: int) -> Tuple[Optional[str], Optional[int]]:
+        """Closest word within max_distance (ties: earliest indexed), or (None, None)"""
+        shared: Dict[int, int] = {}
+        for gram, count in Counter(_bigrams(word)).items():
+            for word_id, word_count in self._postings.get(gram, ()):
+                shared[word_id] = shared.get(word_id, 0) + (count if count < word_count else word_count)
+
+        candidates = []
+        for length in range(len(word) - max_distance, len(word) + max_distance + 1):
+            for word_id in self._by_length.get(length, ()):
+                if shared.get(word_id, 0) >= max(length, len(word)) - 1 - 2 * max_distance:
+                    candidates.append(word_id)
+
+        best_id, best_distance = None, max_distance + 1
+        for word_id in sorted(candidates):
+            distance = levenshtein(word, self._words[word_id], best_distance - 1)
+            if distance < best_distance:
+                best_id, best_distance = word_id, distance
+                if distance == 0:
+                    break
+        if best_id is None:
+            return None, None
+        return self._words[best_id], best_distance
+
+
+class AhoCorasick:
+    """Minimal Aho-Corasick automaton: does a text contain any of the keywords?"""
+
+    def __init__(self, keywords: List[str]):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._terminal: List[bool] = [False]
+
+        for keyword in keywords:
+            state = 0
+            for char in keyword:
+                next_state = self._goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto[state][char] = next_state
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._terminal.append(False)
+                state = next_state
+            self._terminal[state] = True
+
+        # Breadth-first failure links; a state is terminal if any suffix of it is a keyword
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                self._terminal[next_state] = self._terminal[next_state] or self._terminal[self._fail[next_state]]
+
+    def contains_any(self, text: str) -> bool:
+        state = 0
+        for char in text:
+            while state and char not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(char, 0)
+            if self._terminal[state]:
+                return True
+        return False
+
+
+class CategoryMatcher:
+    """
+    Precompiled category extraction and validation, built once per process
+
+    Header patterns are compiled once and tried in priority order. (A single
+    alternation of all eight was measured ~15x slower: re only skips ahead with
+    a fast literal search when a pattern starts with a literal.) Official
+    categories are checked with a hash set (exact), an Aho-Corasick automaton
+    (official category inside the tag) and a set of all their substrings (tag
+    inside an official category).
+    """
+
+    _STRIP_MARKUP = re.compile(r'[*{}]')
+    _STRIP_SPECIAL = re.compile(r'[^\w\s\-&/()]')
+
+    def __init__(self, valid_categories: List[str], patterns: List[str]):
+        self.valid_categories = list(valid_categories)
+        self.patterns = list(patterns)
+
+        self._header_regexes = [regex_guard.compile(pattern, re.IGNORECASE | re.MULTILINE) for pattern in self.patterns]
+        self._exact = set(self.valid_categories)
+        self._containment = AhoCorasick(self.valid_categories)
+        self._substrings = {
+            valid_cat[start:end]
+            for valid_cat in self.valid_categories
+            for start in range(len(valid_cat) + 1)
+            for end in range(start, len(valid_cat) + 1)
+        }
+
+        # Normalized key -> official category, indexed for fuzzy lookup
+        self._canonical = {}
+        for valid_cat in self.valid_categories:
+            self._canonical.setdefault(normalize_category_key(valid_cat), valid_cat)
+        self._fuzzy_index = NGramIndex(list(self._canonical))
+        # Word -> official categories containing it ('mt5' -> {'platform - mt4/mt5'})
+        self._word_index: Dict[str, set] = {}
+        self._category_words: Dict[str, set] = {}
+        for valid_cat in self.valid_categories:
+            self._category_words[valid_cat] = set(_CATEGORY_WORD_REGEX.findall(valid_cat))
+            for word in self._category_words[valid_cat]:
+                self._word_index.setdefault(word, set()).add(valid_cat)
+
+        self._cache: "OrderedDict[bytes, tuple]" = OrderedDict()
+        self._cache_lock = threading.Lock()
+
+    def extract_category(self, transcript: str) -> Optional[str]:
+        """First pattern (in priority order) whose first match yields a meaningful category"""
+        for regex in self._header_regexes:
+            match = regex.search(transcript)
+            if match is None:
+                continue
+            category = self._STRIP_MARKUP.sub('', match.group(1).strip()).strip()
+            category = self._STRIP_SPECIAL.sub('', category)  # Remove special chars except common ones
+            category = category.strip()
+            if len(category) > 2:  # Ensure it's meaningful
+                return category
+        return None
+
+    def is_valid_category(self, category: Optional[str]) -> bool:
+        """Exact, partial (either direction) or near-miss match with an official category"""
+        if not category:
+            return False
+        category_lower = category.lower().strip()
+        return (category_lower in self._exact
+                or category_lower in self._substrings
+                or self._containment.contains_any(category_lower)
+                or self.resolve_category(category)[0] is not None)
+
+    @lru_cache(maxsize=4096)
+    def resolve_category(self, category: Optional[str]) -> Tuple[Optional[str], Optional[int]]:
+        """
+        Nearest official category to a raw tag
+        
+        Near misses of the whole tag are tried first; then a tag whose words
+        all appear in a single official category and cover most of its words
+        (CATEGORY_WORD_COVERAGE, "Platform MT5") resolves to it. Words matching
+        several categories ("Platform") or too few of one ("MT5") stay unresolved.
+        
+        Args:
+            category: Raw category tag, e.g. "Finance-Withdrawl"
+            
+        Returns:
+            (official category, edit distance) or (None, None) if nothing is close enough
+        """
+        if not category:
+            return None, None
+        key = normalize_category_key(category)
+        if not key:
+            return None, None
+        if key in self._canonical:
+            return self._canonical[key], 0
+        max_distance = min(int(len(key) * CATEGORY_FUZZY_RATIO), CATEGORY_MAX_DISTANCE)
+        nearest, distance = self._fuzzy_index.nearest(key, max_distance)
+        if nearest is not None:
+            return self._canonical[nearest], distance
+
+        words = set(_CATEGORY_WORD_REGEX.findall(category.lower()))
+        candidates = None
+        for word in words:
+            containing = self._word_index.get(word, set())
+            candidates = containing if candidates is None else candidates & containing
+            if not candidates:
+                return None, None
+        if candidates is None or len(candidates) != 1:
+            return None, None
+        official = next(iter(candidates))
+        if len(words) < CATEGORY_WORD_COVERAGE * len(self._category_words[official]):
+            return None, None
+        return official, levenshtein(key, normalize_category_key(official))
+
+    def normalize_categories(self, categories: List[Optional[str]]) -> Dict[str, Tuple[Optional[str], Optional[int]]]:
+        """Bulk resolve_category for historical batches: {raw tag: (official category, distance)}"""
+        return {category: self.resolve_category(category) for category in set(categories) if category}
+
+    def classify(self, transcript: str) -> tuple:
+        """(category, scoring_strategy, should_boost_score), memoized by transcript digest"""
+        digest = hashlib.blake2b(transcript.encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+        with self._cache_lock:
+            cached = self._cache.get(digest)
+            if cached is not None:
+                self._cache.move_to_end(digest)
+                return cached
+
+        extracted_category = self.extract_category(transcript)
+        if not extracted_category:
+            # No category found at all
+            result = (None, "zero", False)
+        elif self.is_valid_category(extracted_category):
+            # Valid category - boost score
+            result = (extracted_category, "boost", True)
+        else:
+            # Found category but it's not in the official list - penalize
+            result = (extracted_category, "penalize", False)
+
+        with self._cache_lock:
+            self._cache[digest] = result
+            if len(self._cache) > CATEGORY_CACHE_SIZE:
+                self._cache.popitem(last=False)
+        return result
+
+
+CATEGORY_MATCHER = CategoryMatcher(OFFICIAL_CATEGORIES, CATEGORY_PATTERNS)
+
+
 class ChatCategoryExtractor:
-    """Handles category extraction from chat transcripts"""
+    """Handles category extraction from chat transcripts (uses the shared CATEGORY_MATCHER)"""
     
     def __init__(self):
-        # FIXED: Use the OFFICIAL 59 chat reason categories from QA_prompt.md
-        # 🔄 FUTURE UPDATES: When new categories are added, just add them to this list below
-        # Keep lowercase, use hyphens (not underscores), and add a comment with the date
-        self.valid_categories = [
-            # Application & Account Setup (1-8)
-            'application - status', 'archiving request', 'automated close', 
-            'backoffice internal request', 'banned country non-residency check',
-            'cash bonus', 'client exit', 'close account',
-            
-            # Finance & Deposits (9-17)
-            'credit card issue', 'crypto trading', 'duplicate case',
-            'education/tools', 'escalated to legal & compliance', 
-            'feedback responses', 'finance - deposit', 'finance - general',
-            'finance - withdrawal',
-            
-            # General Account & Support (18-21)
-            'general account admin', 'general query', 'gold rebate', 
-            'ib/partners',
-            
-            # Technical Issues (22-27)
-            'incident / outage', 'instrument depreciation emails',
-            'leverage change', 'login issues - my account', 
-            'login issues - sca', 'login issues - trading account',
-            
-            # Marketing & Programs (28-31)
-            'marketing', 'mark up increase', 'negative balance adjustment',
-            'pepperstone pro q\'s',
-            
-            # Platforms (32-36)
-            'platform - ctrader', 'platform - mac', 'platform - mt4/mt5',
-            'platform - pepperstone app', 'platform - pepperstone webtrader',
-            
-            # Promotions & Regulation (37-39)
-            'promotions', 'regulation/licensing', 'sales lead',
-            
-            # Social & Trading (40-44)
-            'social - no response required', 'social - separate case created',
-            'social trading/third-party', 'sophisticated investor', 'spams',
-            
-            # Statements & Support (45-50)
-            'statements', 'support internal request', 'swap-free', 'tax',
-            'thai bank book', 'trade investigation',
-            
-            # Trading Conditions (51-55)
-            'trading - conditions/instruments', 'trading - issues',
-            'tradingview', 'trading - vps', 'unarchiving',
-            
-            # Website Issues (56-59)
-            'website (authenticated) - my account', 
-            'website (unauthenticated) - my account',
-            'website - main site', 'website - sca'
-            
-            # ✨ ADD NEW CATEGORIES BELOW THIS LINE ✨
-            # Example format:
-            # # New Category Group (60-62) - Added YYYY-MM-DD
-            # 'new category name',
-            # 'another category',
-        ]
-        
-        # Multiple patterns for different chat formats
-        self.category_patterns = [
-            r'\*\*Chat reason:\s*(.+?)\*\*',        # **Chat reason: General Query**
-            r'Chat reason:\s*(.+?)(?:\n|$)',         # Chat reason: General Query
-            r'Category:\s*(.+?)(?:\n|$)',            # Category: General Query
-            r'Reason for chat:\s*(.+?)(?:\n|$)',     # Reason for chat: ...
-            r'Issue type:\s*(.+?)(?:\n|$)',          # Issue type: ...
-            r'Topic:\s*(.+?)(?:\n|$)',               # Topic: ...
-            r'Subject:\s*(.+?)(?:\n|$)',             # Subject: ...
-            r'Type:\s*(.+?)(?:\n|$)',                # Type: ...
-        ]
+        self.valid_categories = CATEGORY_MATCHER.valid_categories
+        self.category_patterns = CATEGORY_MATCHER.patterns
     
     def extract_category(self, transcript: str) -> Optional[str]:
         """
@@ -102,19 +406,7 @@ class ChatCategoryExtractor:
         Returns:
             Category string if found, None otherwise
         """
-        for pattern in self.category_patterns:
-            match = re.search(pattern, transcript, re.IGNORECASE | re.MULTILINE)
-            if match:
-                category = match.group(1).strip()
-                # Clean up common artifacts
-                category = re.sub(r'[*{}]', '', category).strip()
-                category = re.sub(r'[^\w\s\-&/()]', '', category)  # Remove special chars except common ones
-                category = category.strip()
-                
-                if len(category) > 2:  # Ensure it's meaningful
-                    return category
-        
-        return None
+        return CATEGORY_MATCHER.extract_category(transcript)
     
     def is_valid_category(self, category: Optional[str]) -> bool:
         """
@@ -126,22 +418,19 @@ class ChatCategoryExtractor:
         Returns:
             True if category is valid (matches official list)
         """
-        if not category:
-            return False
-        
-        # Normalize for comparison
-        category_lower = category.lower().strip()
-        
-        # Check for exact or partial match with official categories
-        for valid_cat in self.valid_categories:
-            # Exact match
-            if category_lower == valid_cat:
-                return True
-            # Partial match (category contains valid category or vice versa)
-            if valid_cat in category_lower or category_lower in valid_cat:
-                return True
+        return CATEGORY_MATCHER.is_valid_category(category)
+    
+    def resolve_category(self, category: Optional[str]) -> Tuple[Optional[str], Optional[int]]:
+        """
+        Resolve a raw tag to its nearest official category
         
-        return False
+        Args:
+            category: Extracted category or None
+            
+        Returns:
+            (official category, edit distance) or (None, None)
+        """
+        return CATEGORY_MATCHER.resolve_category(category)
     
     def should_boost_tagging_score(self, category: Optional[str]) -> bool:
         """
@@ -156,6 +445,88 @@ class ChatCategoryExtractor:
         return self.is_valid_category(category)
 
 
+# Knowledge Base context selection: how many relevant pairs to inject and the
+# approximate token budget (~4 characters per token) for the whole KB block
+KB_CONTEXT_TOP_K = 8
+KB_CONTEXT_TOKEN_BUDGET = 1500
+CHARS_PER_TOKEN = 4
+
+
+def _customer_text(formatted_transcript: str) -> str:
+    """Collect the customer's messages from a formatted transcript"""
+    messages = []
+    for line in formatted_transcript.split('\n'):
+        if line.startswith('Customer:'):
+            messages.append(line[len('Customer:'):].strip())
+    return ' '.join(messages)
+
+
+def select_relevant_kb_pairs(formatted_transcript: str, kb, category: Optional[str] = None,
+                             top_k: int = KB_CONTEXT_TOP_K,
+                             token_budget: int = KB_CONTEXT_TOKEN_BUDGET,
+                             raw_transcript: Optional[str] = None) -> List[Dict]:
+    """
+    Pick the KB Q&A pairs most relevant to this chat, within a token budget
+
+    Args:
+        formatted_transcript: Transcript as produced by format_transcript_for_ai
+        kb: KnowledgeBase instance
+        category: Extracted chat category, used to bias the query
+        top_k: Maximum number of pairs to return
+        token_budget: Approximate token budget for the rendered pairs
+        raw_transcript: Used as the query when no customer lines were recognized
+
+    Returns:
+        List of QA pairs ordered by relevance
+    """
+    query = _kb_query(formatted_transcript, category, raw_transcript)
+    return _apply_kb_token_budget(kb.search(query, top_k=top_k), token_budget)
+
+
+def select_relevant_kb_pairs_many(transcripts: List[str], kb,
+                                  top_k: int = KB_CONTEXT_TOP_K,
+                                  token_budget: int = KB_CONTEXT_TOKEN_BUDGET,
+                                  formatted_transcripts: Optional[List[Optional[str]]] = None) -> List[List[Dict]]:
+    """
+    Batch version of select_relevant_kb_pairs for raw transcripts
+
+    All chats are matched against the KB in one KnowledgeBase.search_many call
+    (a single sparse BM25F matrix product) instead of one search per chat; the
+    ranking is the same as select_relevant_kb_pairs(). formatted_transcripts can
+    carry each chat's view for the model where it is already rendered (None entries
+    are formatted here).
+
+    Returns:
+        One list of QA pairs per transcript, in input order
+    """
+    queries = []
+    for transcript, formatted in zip(transcripts, formatted_transcripts or [None] * len(transcripts)):
+        category, _, _ = extract_chat_category(transcript)
+        queries.append(_kb_query(formatted or format_transcript_for_ai(transcript), category, transcript))
+    return [_apply_kb_token_budget(pairs, token_budget) for pairs in kb.search_many(queries, top_k=top_k)]
+
+
+def _kb_query(formatted_transcript: str, category: Optional[str], raw_transcript: Optional[str] = None) -> str:
+    query = _customer_text(formatted_transcript) or formatted_transcript or raw_transcript or ""
+    if category:
+        query = f"{category} {query}"
+    return query
+
+
+def _apply_kb_token_budget(qa_pairs: List[Dict], token_budget: int) -> List[Dict]:
+    """Keep pairs in relevance order until the approximate token budget is used up"""
+    selected = []
+    used_chars = 0
+    char_budget = token_budget * CHARS_PER_TOKEN
+    for qa_pair in qa_pairs:
+        entry_chars = len(qa_pair.get('question', '')) + len(qa_pair.get('answer', '')) + len(qa_pair.get('category', '')) + 20
+        if selected and used_chars + entry_chars > char_budget:
+            break
+        selected.append(qa_pair)
+        used_chars += entry_chars
+    return selected
+
+
 def extract_chat_category(transcript: str) -> tuple:
     """
     Extract chat category from transcript and determine scoring strategy
@@ -163,41 +534,37 @@ def extract_chat_category(transcript: str) -> tuple:
     
     Returns: (category, scoring_strategy, should_boost_score)
     """
-    extractor = ChatCategoryExtractor()
-    
-    # Extract category using patterns
-    extracted_category = extractor.extract_category(transcript)
-    
-    if not extracted_category:
-        # No category found at all
-        return None, "zero", False
-    
-    # Check if it's a valid official category
-    if extractor.is_valid_category(extracted_category):
-        # Valid category - boost score
-        return extracted_category, "boost", True
-    else:
-        # Found category but it's not in the official list - penalize
-        return extracted_category, "penalize", False
+    return CATEGORY_MATCHER.classify(transcript)
 
 
 # Function to analyze a transcript with cultural considerations
-def analyze_chat_transcript(transcript, rules, kb, target_language="en", prompt_template_path="QA_prompt.md", model_provider="anthropic", model_name=None):
+def analyze_chat_transcript(transcript, rules, kb, target_language="en", prompt_template_path="QA_prompt.md", model_provider="anthropic", model_name=None, prompt_template=None, kb_pairs=None, formatted_transcript=None):
     """
     Analyze a chat transcript using AI models with enhanced category detection
     FIXED: Now correctly validates against official 59 categories
+
+    prompt_template can be passed in (e.g. from a ConfigSnapshot) to skip
+    re-reading prompt_template_path on every call. kb_pairs can carry KB
+    entries preselected for this chat (see select_relevant_kb_pairs_many), and
+    formatted_transcript its view for the model when the caller already rendered
+    it (an extracted chat's 'formatted_transcript').
     """
     try:
         # === FORMAT TRANSCRIPT ===
-        formatted_transcript = format_transcript_for_ai(transcript)
+        if formatted_transcript is None:
+            formatted_transcript = format_transcript_for_ai(transcript)
         
         # === EXTRACT AND VALIDATE CATEGORY ===
         extracted_category, scoring_strategy, should_boost_tagging = extract_chat_category(transcript)
         
+        category_canonical, category_match_distance = CATEGORY_MATCHER.resolve_category(extracted_category)
+        
         # Enhanced logging with validation details
         if extracted_category:
             if scoring_strategy == "boost":
                 print(f"📋 [Category] Found VALID official category: '{extracted_category}' → Boost score 85-95")
+                if category_match_distance:
+                    print(f"    ↳ Closest official category: '{category_canonical}' (distance {category_match_distance})")
             elif scoring_strategy == "penalize":
                 print(f"📋 [Category] Found INVALID category: '{extracted_category}' → Penalize score 20-40")
                 print(f"    ⚠️ This category is NOT in the official 59-category list!")
@@ -232,8 +599,9 @@ def analyze_chat_transcript(transcript, rules, kb, target_language="en", prompt_
             for level in rules["scoring_system"]["quality_levels"]:
                 scoring_info += f"- {level['name']} ({level['range']['min']}-{level['range']['max']}): {level['description']}\n"
 
-        # Load prompt template
-        prompt_template = load_prompt_template(prompt_template_path)
+        # Load prompt template (unless the caller already holds it)
+        if prompt_template is None:
+            prompt_template = load_prompt_template(prompt_template_path)
         if not prompt_template:
             print(f"Error: Could not load prompt template from {prompt_template_path}")
             return None
@@ -245,14 +613,22 @@ def analyze_chat_transcript(transcript, rules, kb, target_language="en", prompt_
         kb_context += "For questions not covered in the KB, the agent should use their expertise appropriately. "
         kb_context += "Focus on identifying contradictions with KB rather than expecting exact matches.\n\n"
 
-        kb_qa_pairs = kb.qa_pairs.get("qa_pairs", [])
+        # Only inject the KB entries relevant to what the customer asked about
+        if kb_pairs is not None:
+            kb_qa_pairs = kb_pairs
+        else:
+            kb_qa_pairs = select_relevant_kb_pairs(formatted_transcript, kb, extracted_category,
+                                                   raw_transcript=transcript)
         if kb_qa_pairs:
-            for i, qa_pair in enumerate(kb_qa_pairs[:20]):  # Limit to 20 entries
+            for qa_pair in kb_qa_pairs:
                 kb_context += f"Q: {qa_pair.get('question', '')}\n"
                 kb_context += f"A: {qa_pair.get('answer', '')}\n"
                 kb_context += f"Category: {qa_pair.get('category', 'General')}\n\n"
+        elif kb.qa_pairs.get("qa_pairs"):
+            kb_context += "No knowledge base entries match the topics in this chat. Evaluate based on general accuracy and procedures.\n"
         else:
             kb_context += "The knowledge base is currently empty. Evaluate based on general accuracy and procedures.\n"
+        print(f"📚 [KB] Injecting {len(kb_qa_pairs)} relevant knowledge base entries")
 
         # === CATEGORY-AWARE SCORING INSTRUCTIONS ===
         category_context = ""
@@ -452,6 +828,9 @@ def analyze_chat_transcript(transcript, rules, kb, target_language="en", prompt_
         analysis["category_scoring_strategy"] = scoring_strategy
         analysis["category_boost_applied"] = should_boost_tagging
         analysis["category_is_valid_official"] = scoring_strategy == "boost"  # NEW: Clear indicator
+        analysis["category_canonical"] = category_canonical
+        analysis["category_match_distance"] = category_match_distance
+        analysis["kb_entries_used"] = [qa_pair.get('question', '') for qa_pair in kb_qa_pairs]
 
         return analysis
 
@@ -9,13 +9,17 @@ The user never sees the anonymized data - it all happens behind the scenes.
 
 import os
 import sys
-from typing import Dict, List, Optional, Any
+from typing import Dict, Iterator, List, Optional, Any
 from datetime import datetime
 
 # Import original functions
 from chat_qa import analyze_chat_transcript as original_analyze_chat_transcript
+from chat_qa import select_relevant_kb_pairs_many
 from chat_anonymizer import ChatAnonymizer
 
+# Set on chat dicts whose content was already anonymized, so later stages don't repeat it
+ANONYMIZED_FLAG = 'anonymized'
+
 def analyze_chat_transcript(
     transcript: str,
     evaluation_rules: Dict,
@@ -23,7 +27,10 @@ def analyze_chat_transcript(
     target_language: str = "en",
     prompt_template_path: str = "QA_prompt.md",
     model_provider: str = "anthropic",
-    model_name: str = "claude-3-7-sonnet-20250219"
+    model_name: str = "claude-3-7-sonnet-20250219",
+    prompt_template: Optional[str] = None,
+    already_anonymized: bool = False,
+    formatted_transcript: Optional[str] = None
 ) -> Dict:
     """
     Drop-in replacement for the original analyze_chat_transcript function.
@@ -31,27 +38,42 @@ def analyze_chat_transcript(
     Automatically anonymizes sensitive data before LLM analysis, but returns
     the exact same output format as the original function.
     
-    The anonymization is completely invisible to the caller.
+    The anonymization is completely invisible to the caller. Pass
+    already_anonymized=True when the caller anonymized the transcript itself
+    (e.g. for a preview) to skip the second pass; formatted_transcript can then
+    carry its view for the model (a chat's 'formatted_transcript') to skip parsing it again.
     """
     
     print("🔒 [Auto-Anonymization] Processing chat transcript...")
     
+    # Step 1: Anonymize the transcript silently. If that fails, the chat is not
+    # sent at all: the original text must never reach the model.
     try:
-        # Step 1: Anonymize the transcript silently
-        anonymizer = ChatAnonymizer()
-        anonymized_transcript, anonymization_report = anonymizer.anonymize_text(transcript)
-        
-        # Log anonymization (but don't expose to user)
-        replacements = anonymization_report.get('total_replacements', 0)
-        if replacements > 0:
-            print(f"🔒 [Auto-Anonymization] Removed {replacements} sensitive items before analysis")
-            
-            # Log what types were anonymized (for debugging)
-            for data_type, count in anonymization_report.get('replacements_by_type', {}).items():
-                print(f"    - {data_type}: {count}")
+        if already_anonymized:
+            anonymized_transcript = transcript
+            print("🔒 [Auto-Anonymization] Transcript already anonymized, skipping")
         else:
-            print("🔒 [Auto-Anonymization] No sensitive data detected")
-        
+            anonymizer = ChatAnonymizer()
+            anonymized_transcript, anonymization_report, _ = anonymizer.anonymize_cached(transcript)
+            
+            # Log anonymization (but don't expose to user)
+            replacements = anonymization_report.get('total_replacements', 0)
+            if replacements > 0:
+                print(f"🔒 [Auto-Anonymization] Removed {replacements} sensitive items before analysis")
+                
+                # Log what types were anonymized (for debugging)
+                for data_type, count in anonymization_report.get('replacements_by_type', {}).items():
+                    print(f"    - {data_type}: {count}")
+            else:
+                print("🔒 [Auto-Anonymization] No sensitive data detected")
+    except Exception as e:
+        print(f"❌ [Auto-Anonymization] Error during anonymization, chat not analyzed: {str(e)}")
+        return {
+            'error': f'Anonymization failed, chat was not sent for analysis: {str(e)}',
+            'weighted_overall_score': 0
+        }
+    
+    try:
         # Step 2: Call the original function with anonymized data
         print("🤖 [QA Analysis] Starting analysis with cleaned data...")
         
@@ -62,7 +84,9 @@ def analyze_chat_transcript(
             target_language=target_language,
             prompt_template_path=prompt_template_path,
             model_provider=model_provider,
-            model_name=model_name
+            model_name=model_name,
+            prompt_template=prompt_template,
+            formatted_transcript=formatted_transcript if already_anonymized else None
         )
         
         print("✅ [QA Analysis] Analysis completed successfully")
@@ -72,29 +96,11 @@ def analyze_chat_transcript(
         return result
         
     except Exception as e:
-        print(f"❌ [Auto-Anonymization] Error during processing: {str(e)}")
-        
-        # Fallback: If anonymization fails, try with original text
-        print("⚠️ [Fallback] Attempting analysis with original text...")
-        try:
-            result = original_analyze_chat_transcript(
-                transcript,  # Use original text as fallback
-                evaluation_rules,
-                knowledge_base,
-                target_language=target_language,
-                prompt_template_path=prompt_template_path,
-                model_provider=model_provider,
-                model_name=model_name
-            )
-            print("✅ [Fallback] Analysis completed with original text")
-            return result
-            
-        except Exception as fallback_error:
-            print(f"❌ [Fallback] Failed: {str(fallback_error)}")
-            return {
-                'error': f'Analysis failed: {str(fallback_error)}',
-                'weighted_overall_score': 0
-            }
+        print(f"❌ [QA Analysis] Failed: {str(e)}")
+        return {
+            'error': f'Analysis failed: {str(e)}',
+            'weighted_overall_score': 0
+        }
 
 def analyze_multiple_chats_with_anonymization(
     chats: List[Dict[str, Any]],
@@ -103,12 +109,14 @@ def analyze_multiple_chats_with_anonymization(
     target_language: str = "en",
     prompt_template_path: str = "QA_prompt.md",
     model_provider: str = "anthropic",
-    model_name: str = "claude-3-7-sonnet-20250219"
+    model_name: str = "claude-3-7-sonnet-20250219",
+    prompt_template: Optional[str] = None
 ) -> List[Dict]:
     """
     Batch process multiple chats with automatic anonymization.
     
     Each chat gets anonymized individually before analysis.
+    Relevant KB entries for all chats are selected up front in one batch query.
     Returns the same format as if you called the original function on each chat.
     """
     
@@ -118,6 +126,8 @@ def analyze_multiple_chats_with_anonymization(
     anonymizer = ChatAnonymizer()
     total_anonymized_items = 0
     
+    # Step 1: Anonymize every chat
+    prepared = []
     for i, chat in enumerate(chats):
         try:
             chat_id = chat.get('id', f'Chat_{i+1}')
@@ -129,14 +139,39 @@ def analyze_multiple_chats_with_anonymization(
             
             print(f"🔒 [Chat {i+1}/{len(chats)}] Processing {chat_id}...")
             
-            # Anonymize this chat
-            anonymized_content, anonymization_report = anonymizer.anonymize_text(content)
-            replacements = anonymization_report.get('total_replacements', 0)
-            total_anonymized_items += replacements
+            # Anonymize this chat, unless the processor already did (and rendered it for the model)
+            formatted_transcript = None
+            if chat.get(ANONYMIZED_FLAG):
+                anonymized_content = content
+                formatted_transcript = chat.get('formatted_transcript')
+            else:
+                anonymized_content, anonymization_report = anonymizer.anonymize_text(content)
+                replacements = anonymization_report.get('total_replacements', 0)
+                total_anonymized_items += replacements
+                
+                if replacements > 0:
+                    print(f"    Removed {replacements} sensitive items")
             
-            if replacements > 0:
-                print(f"    Removed {replacements} sensitive items")
+            prepared.append((i, chat, chat_id, anonymized_content, formatted_transcript))
             
+        except Exception as e:
+            print(f"❌ [Chat {i+1}] Error: {str(e)}")
+            continue
+    
+    # Step 2: Match all chats against the KB at once
+    try:
+        kb_selections = select_relevant_kb_pairs_many(
+            [anonymized_content for _, _, _, anonymized_content, _ in prepared],
+            knowledge_base,
+            formatted_transcripts=[formatted_transcript for *_, formatted_transcript in prepared]
+        )
+    except Exception as e:
+        print(f"⚠️ [KB] Batch KB matching failed, falling back to per-chat search: {str(e)}")
+        kb_selections = [None] * len(prepared)
+    
+    # Step 3: Analyze each anonymized chat
+    for (i, chat, chat_id, anonymized_content, formatted_transcript), kb_pairs in zip(prepared, kb_selections):
+        try:
             # Analyze the anonymized content
             result = original_analyze_chat_transcript(
                 anonymized_content,
@@ -145,7 +180,10 @@ def analyze_multiple_chats_with_anonymization(
                 target_language=target_language,
                 prompt_template_path=prompt_template_path,
                 model_provider=model_provider,
-                model_name=model_name
+                model_name=model_name,
+                prompt_template=prompt_template,
+                kb_pairs=kb_pairs,
+                formatted_transcript=formatted_transcript
             )
             
             if result:
@@ -185,6 +223,8 @@ class EnhancedChatProcessorWithAutoAnonymization:
         # Import the original processor
         from enhanced_chat_processor import EnhancedChatProcessor
         self.base_processor = EnhancedChatProcessor()
+        # The views are rendered here, from the anonymized text only
+        self.base_processor.render_views = False
         self.anonymizer = ChatAnonymizer()
         print("🔒 [Auto-Anonymization] Enhanced processor initialized")
     
@@ -196,7 +236,7 @@ class EnhancedChatProcessorWithAutoAnonymization:
         The caller doesn't need to know about the anonymization.
         """
         
-        print(f"📄 [File Processing] Extracting chats from {getattr(file_obj, 'name', 'uploaded file')}")
+        print(f"📄 [File Processing] Extracting chats from {getattr(file_obj, 'filename', None) or getattr(file_obj, 'name', 'uploaded file')}")
         
         # Step 1: Extract chats using original processor
         chats = self.base_processor.extract_chats_from_file(file_obj)
@@ -214,25 +254,8 @@ class EnhancedChatProcessorWithAutoAnonymization:
         total_replacements = 0
         
         for i, chat in enumerate(chats):
-            try:
-                # Anonymize main content
-                if 'content' in chat and chat['content']:
-                    anonymized_content, report1 = self.anonymizer.anonymize_text(chat['content'])
-                    chat['content'] = anonymized_content
-                    total_replacements += report1.get('total_replacements', 0)
-                
-                # Anonymize processed content
-                if 'processed_content' in chat and chat['processed_content']:
-                    anonymized_processed, report2 = self.anonymizer.anonymize_text(chat['processed_content'])
-                    chat['processed_content'] = anonymized_processed
-                    total_replacements += report2.get('total_replacements', 0)
-                
-                anonymized_chats.append(chat)
-                
-            except Exception as e:
-                print(f"⚠️ [Chat {i+1}] Anonymization failed: {str(e)}")
-                # Keep original chat if anonymization fails
-                anonymized_chats.append(chat)
+            total_replacements += self._anonymize_chat(chat, i)
+            anonymized_chats.append(chat)
         
         if total_replacements > 0:
             print(f"🔒 [Auto-Anonymization] Cleaned {total_replacements} sensitive items from {len(chats)} chats")
@@ -241,6 +264,47 @@ class EnhancedChatProcessorWithAutoAnonymization:
         
         return anonymized_chats
 
+    def extract_chats_from_files(self, file_objs, parallel: Optional[bool] = None):
+        """
+        Extract and anonymize chats from several files, one process pool task per file
+        
+        Returns (filename, chats, error) per file in upload order, like
+        enhanced_chat_processor.extract_chats_from_files().
+        """
+        from enhanced_chat_processor import extract_chats_from_files
+        return extract_chats_from_files(self, file_objs, parallel)
+    
+    def iter_chats_from_file(self, file_obj, filename: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+        """
+        Yield chats from file as the base processor finds them, each one anonymized
+        
+        Streaming counterpart of extract_chats_from_file(); extraction errors are
+        raised to the caller.
+        """
+        for i, chat in enumerate(self.base_processor.iter_chats_from_file(file_obj, filename=filename)):
+            self._anonymize_chat(chat, i)
+            yield chat
+    
+    def _anonymize_chat(self, chat: Dict[str, Any], index: int) -> int:
+        """Anonymize one extracted chat in place; returns the number of replacements"""
+        # The raw content is anonymized once (or looked up in the anonymization cache,
+        # numbering pseudonyms per chat); processed_content and formatted_transcript are
+        # rendered from one parse of the anonymized text rather than anonymized a second time.
+        try:
+            if 'content' in chat and chat['content']:
+                anonymized_content, report, offsets = self.anonymizer.anonymize_cached(chat['content'])
+                chat['content'] = anonymized_content
+                chat.update(self.base_processor.render_chat_views(anonymized_content))
+                # Traces positions in the anonymized views back to the raw chat
+                chat['anonymization_offsets'] = offsets
+                chat[ANONYMIZED_FLAG] = True
+                return report.get('total_replacements', 0)
+        except Exception as e:
+            # The chat stays unflagged, so analysis anonymizes it again (and refuses it if that fails too)
+            print(f"⚠️ [Chat {index+1}] Anonymization failed: {str(e)}")
+            chat.update(self.base_processor.render_chat_views(chat['content']))
+        return 0
+
 # Utility function for easy migration
 def migrate_from_original_chat_qa():
     """
@@ -0,0 +1,295 @@
+# chunked_upload.py
+"""
+Resumable, chunked uploads of large exports.
+
+A 500 MB export sent as one multipart POST over a slow VPN link fails as a
+whole and has to start again from zero. Clients instead create an upload
+(file name and total size) and PUT the file in numbered chunks of
+CHUNKED_UPLOAD_CHUNK_MB, each with a checksum of its bytes. Chunks are
+written in place into <id>.part under CHUNKED_UPLOAD_DIR, so the file is
+assembled on disk as it arrives. After a dropped connection the client asks
+for the upload's status and resumes at the chunk it returns; a chunk sent
+twice (its response was lost) is accepted again if its checksum matches.
+
+Uploads belong to the owner token given when they were created. A complete
+upload is opened as a file for batch extraction and deleted afterwards.
+Uploads not touched for CHUNKED_UPLOAD_TTL seconds are purged.
+"""
+
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+import uuid
+import zlib
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, BinaryIO, Dict, Tuple
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+CHUNKED_UPLOAD_DIR = os.environ.get('CHUNKED_UPLOAD_DIR', 'temp_uploads')
+CHUNKED_UPLOAD_CHUNK_MB = int(os.environ.get('CHUNKED_UPLOAD_CHUNK_MB', '8'))
+CHUNKED_UPLOAD_MAX_MB = int(os.environ.get('CHUNKED_UPLOAD_MAX_MB', '2048'))
+CHUNKED_UPLOAD_TTL = int(os.environ.get('CHUNKED_UPLOAD_TTL', str(24 * 3600)))
+
+# Ids are generated here; anything else is rejected before it reaches the file system
+_ID_PATTERN = re.compile(r'^upload_[0-9a-f]{32}$')
+_PURGE_INTERVAL = 60
+
+# Supported chunk checksums, sent as "<algorithm>:<hex digest>"
+CHECKSUMS = {
+    'sha256': lambda data: hashlib.sha256(data).hexdigest(),
+    'crc32': lambda data: f"{zlib.crc32(data):08x}",
+}
+
+
+class UploadError(Exception):
+    """A request the upload store refuses, with the HTTP status to answer it with"""
+
+    def __init__(self, message: str, status: int = 400):
+        super().__init__(message)
+        self.status = status
+
+
+class UploadStore:
+    """
+    Directory of partially received uploads, written chunk by chunk
+    """
+
+    def __init__(self, directory: str = CHUNKED_UPLOAD_DIR,
+                 chunk_size: int = CHUNKED_UPLOAD_CHUNK_MB * 1024 * 1024,
+                 max_size: int = CHUNKED_UPLOAD_MAX_MB * 1024 * 1024,
+                 ttl: int = CHUNKED_UPLOAD_TTL):
+        """
+        Args:
+            directory: Where .part files and their .json metadata are kept
+            chunk_size: Size of every chunk but the last
+            max_size: Largest upload accepted
+            ttl: Seconds an upload may stay untouched before it is purged
+        """
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.chunk_size = chunk_size
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._last_purge = 0.0
+
+    # ----------------------------------------------------------------- files
+
+    def _part_path(self, upload_id: str) -> Path:
+        return self.directory / f"{upload_id}.part"
+
+    def _meta_path(self, upload_id: str) -> Path:
+        return self.directory / f"{upload_id}.json"
+
+    def _save_meta(self, meta: Dict[str, Any]):
+        """Write to a private temp file in the same directory, then rename over the metadata"""
+        meta['updated'] = time.time()
+        fd, tmp_path = tempfile.mkstemp(prefix='.upload_', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(meta, f)
+            os.replace(tmp_path, self._meta_path(meta['upload_id']))
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def _load_meta(self, upload_id: str, owner: str) -> Dict[str, Any]:
+        if not upload_id or not _ID_PATTERN.match(upload_id):
+            raise UploadError("Unknown upload", 404)
+        try:
+            with open(self._meta_path(upload_id), 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            raise UploadError("Unknown upload", 404)
+        if meta.get('owner') != owner or time.time() - meta['updated'] > self.ttl:
+            raise UploadError("Unknown upload", 404)
+        return meta
+
+    @contextmanager
+    def _locked(self, upload_id: str):
+        """The open .part file, locked against concurrent chunks of the same upload"""
+        try:
+            part = open(self._part_path(upload_id), 'r+b')
+        except OSError:
+            raise UploadError("Unknown upload", 404)
+        with part:
+            # Every call opens its own file description, so flock also excludes other
+            # threads of this process, and only chunks of the same upload wait for each
+            # other. Without flock, the store-wide thread lock is the fallback.
+            if fcntl is not None:
+                fcntl.flock(part.fileno(), fcntl.LOCK_EX)
+                yield part
+            else:
+                with self._lock:
+                    yield part
+
+    def _status(self, meta: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            'upload_id': meta['upload_id'],
+            'filename': meta['filename'],
+            'size': meta['size'],
+            'chunk_size': meta['chunk_size'],
+            'offset': meta['offset'],
+            'next_chunk': len(meta['checksums']),
+            'chunk_count': max(1, -(-meta['size'] // meta['chunk_size'])),
+            'complete': meta['offset'] == meta['size'],
+        }
+
+    # ------------------------------------------------------------------- API
+
+    def create(self, filename: str, size: int, owner: str) -> Dict[str, Any]:
+        """
+        Start an upload
+
+        Args:
+            filename: Name of the file, whose extension later selects the extractor
+            size: Total size in bytes
+            owner: Token of the session the upload belongs to
+
+        Returns:
+            Status of the new upload (see status())
+        """
+        if not filename:
+            raise UploadError("A file name is required")
+        if not isinstance(size, int) or isinstance(size, bool) or size <= 0:
+            raise UploadError("size must be a positive number of bytes")
+        if size > self.max_size:
+            raise UploadError(f"File exceeds the {self.max_size // (1024 * 1024)}MB upload limit", 413)
+
+        self._maybe_purge()
+        upload_id = f"upload_{uuid.uuid4().hex}"
+        self._part_path(upload_id).touch()
+        meta = {
+            'upload_id': upload_id,
+            'owner': owner,
+            'filename': filename,
+            'size': size,
+            'chunk_size': self.chunk_size,
+            'offset': 0,
+            'checksums': [],
+            'created': time.time(),
+        }
+        self._save_meta(meta)
+        print(f"📦 [Upload] Started {upload_id} for {filename} ({size} bytes)")
+        return self._status(meta)
+
+    def status(self, upload_id: str, owner: str) -> Dict[str, Any]:
+        """
+        Where an upload stands: 'offset' bytes received, 'next_chunk' to send, 'complete'
+        """
+        return self._status(self._load_meta(upload_id, owner))
+
+    def write_chunk(self, upload_id: str, owner: str, index: int, data: bytes, checksum: str) -> Dict[str, Any]:
+        """
+        Verify a chunk against its checksum and write it in place
+
+        Args:
+            upload_id: Id returned by create()
+            owner: Token the upload was created with
+            index: Chunk number, starting at 0; chunks are accepted in order
+            data: The chunk's bytes
+            checksum: "<algorithm>:<hex digest>" of data, algorithm being one of CHECKSUMS
+
+        Returns:
+            Status of the upload after the chunk
+        """
+        algorithm, _, digest = (checksum or '').strip().lower().partition(':')
+        if algorithm not in CHECKSUMS or not digest:
+            raise UploadError(f"Checksum must be one of {', '.join(f'{name}:<hex>' for name in CHECKSUMS)}")
+        if CHECKSUMS[algorithm](data) != digest:
+            raise UploadError(f"Checksum mismatch for chunk {index}, send it again", 422)
+        checksum = f"{algorithm}:{digest}"
+
+        with self._locked(upload_id) as part:
+            meta = self._load_meta(upload_id, owner)
+            received = meta['checksums']
+
+            if index < len(received):
+                # A retry of a chunk whose response was lost
+                if received[index] != checksum:
+                    raise UploadError(f"Chunk {index} was already received with different content", 409)
+                return self._status(meta)
+            if index != len(received):
+                raise UploadError(f"Expected chunk {len(received)}, got chunk {index}", 409)
+
+            start = index * meta['chunk_size']
+            expected = min(meta['chunk_size'], meta['size'] - start)
+            if len(data) != expected:
+                raise UploadError(f"Chunk {index} must be {expected} bytes, got {len(data)}")
+
+            part.seek(start)
+            part.write(data)
+            part.truncate()
+            part.flush()
+            os.fsync(part.fileno())
+
+            meta['offset'] = start + len(data)
+            received.append(checksum)
+            self._save_meta(meta)
+            status = self._status(meta)
+
+        if status['complete']:
+            print(f"✅ [Upload] {upload_id} complete ({meta['size']} bytes, {len(received)} chunks)")
+        return status
+
+    def open(self, upload_id: str, owner: str) -> Tuple[str, BinaryIO]:
+        """
+        Open a complete upload for reading
+
+        Returns:
+            (filename, binary file object); the caller closes it and then delete()s the upload
+        """
+        meta = self._load_meta(upload_id, owner)
+        if meta['offset'] != meta['size']:
+            raise UploadError(f"Upload of {meta['filename']} is incomplete "
+                              f"({meta['offset']} of {meta['size']} bytes)", 409)
+        return meta['filename'], open(self._part_path(upload_id), 'rb')
+
+    def delete(self, upload_id: str, owner: str):
+        """Remove an upload; unknown ids are ignored"""
+        try:
+            self._load_meta(upload_id, owner)
+        except UploadError:
+            return
+        for path in (self._part_path(upload_id), self._meta_path(upload_id)):
+            try:
+                path.unlink()
+            except OSError:
+                pass
+
+    def purge_expired(self) -> int:
+        """Delete every upload untouched for longer than the TTL; returns the number removed"""
+        cutoff = time.time() - self.ttl
+        removed = 0
+        for meta_path in self.directory.glob('upload_*.json'):
+            upload_id = meta_path.stem
+            if not _ID_PATTERN.match(upload_id):
+                continue
+            try:
+                if meta_path.stat().st_mtime >= cutoff:
+                    continue
+                meta_path.unlink()
+                self._part_path(upload_id).unlink()
+                removed += 1
+            except OSError:
+                pass
+        if removed:
+            print(f"🧹 [Upload] Purged {removed} expired upload(s)")
+        return removed
+
+    def _maybe_purge(self):
+        with self._lock:
+            if time.monotonic() - self._last_purge < _PURGE_INTERVAL:
+                return
+            self._last_purge = time.monotonic()
+        self.purge_expired()
@@ -0,0 +1,179 @@
+"""
+config_registry.py
+
+Versioned, hot-reloadable configuration for the QA Engine.
+
+The evaluation rules, scoring system, prompt template and knowledge base are
+loaded into an immutable ConfigSnapshot identified by a content hash. Each
+worker process owns a ConfigRegistry that cheaply stat()s the source files
+(at most once per check interval) and, when any of them changed, builds a new
+snapshot and swaps it in with a single reference assignment. Requests that
+already hold the previous snapshot keep using it until they finish, so no
+worker ever sees a half-loaded configuration and no restart is required.
+
+The knowledge base is only re-read when needed: its storage backend exposes a
+change counter, and when another worker has written to it a new KnowledgeBase
+is built and goes into the next snapshot, like every other file. A snapshot's
+knowledge base is never modified after it was built.
+"""
+
+import hashlib
+import os
+import threading
+import time
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Any, Dict, Mapping, Optional, Tuple
+
+from knowledge_base import KnowledgeBase
+import utils
+
+# How often (seconds) a worker re-stats the config files. Override with
+# CONFIG_CHECK_INTERVAL; 0 checks on every access.
+DEFAULT_CHECK_INTERVAL = float(os.environ.get('CONFIG_CHECK_INTERVAL', '2'))
+
+
+def _freeze(value: Any) -> Any:
+    """Read-only deep copy of parsed JSON: dicts become mapping proxies, lists tuples"""
+    if isinstance(value, dict):
+        return MappingProxyType({key: _freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+@dataclass(frozen=True)
+class ConfigSnapshot:
+    """
+    Immutable view of every configuration file at one point in time
+
+    rules (which includes the scoring system under 'scoring_system') is deep-frozen,
+    so no request can change the snapshot under its version hash.
+    """
+    version: str
+    rules: Mapping
+    kb: KnowledgeBase
+    prompt_template: Optional[str]
+    loaded_at: float
+    file_hashes: MappingProxyType
+
+    def as_metadata(self) -> Dict[str, str]:
+        """Short description of the snapshot, suitable for storing on results"""
+        return {
+            'config_version': self.version,
+            'config_loaded_at': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.loaded_at))
+        }
+
+
+class ConfigRegistry:
+    """
+    Per-process registry of configuration snapshots with stat-based hot reload
+    """
+
+    def __init__(self,
+                 rules_path: str = "evaluation_rules.json",
+                 scoring_path: str = "scoring_system.json",
+                 prompt_path: str = "QA_prompt.md",
+                 kb_path: str = "qa_knowledge_base.json",
+                 check_interval: float = DEFAULT_CHECK_INTERVAL):
+        self.rules_path = rules_path
+        self.scoring_path = scoring_path
+        self.prompt_path = prompt_path
+        self.kb_path = kb_path
+        self.check_interval = check_interval
+
+        self._lock = threading.Lock()
+        self._last_check = 0.0
+        self._stamps = {}
+        self._snapshot = None
+        self._kb = KnowledgeBase(kb_path)
+
+        self.reload(force=True)
+
+    @property
+    def watched_paths(self) -> Tuple[str, ...]:
+        return (self.rules_path, self.scoring_path, self.prompt_path)
+
+    def _stat_stamps(self) -> Dict[str, Any]:
+        """Cheap change detection: (mtime_ns, size) per watched file plus the KB change counter"""
+        stamps = {}
+        for path in self.watched_paths:
+            try:
+                st = os.stat(path)
+                stamps[path] = (st.st_mtime_ns, st.st_size)
+            except OSError:
+                stamps[path] = None
+        stamps['kb'] = self._kb.storage.change_counter()
+        return stamps
+
+    @staticmethod
+    def _hash_file(path: str) -> str:
+        try:
+            with open(path, 'rb') as f:
+                return hashlib.sha256(f.read()).hexdigest()
+        except OSError:
+            return 'missing'
+
+    def _build_snapshot(self) -> Optional[ConfigSnapshot]:
+        """Load every file and assemble a new snapshot (None if rules are unusable)"""
+        rules = utils.load_evaluation_rules(self.rules_path, self.scoring_path)
+        if rules is None:
+            return None
+
+        self._kb = self._kb.refreshed()
+        file_hashes = {path: self._hash_file(path) for path in self.watched_paths}
+        file_hashes[self.kb_path] = self._kb.content_hash()
+        version = hashlib.sha256(
+            '|'.join(f"{path}:{digest}" for path, digest in sorted(file_hashes.items())).encode()
+        ).hexdigest()[:12]
+
+        return ConfigSnapshot(
+            version=version,
+            rules=_freeze(rules),
+            kb=self._kb,
+            prompt_template=utils.load_prompt_template(self.prompt_path),
+            loaded_at=time.time(),
+            file_hashes=MappingProxyType(file_hashes)
+        )
+
+    def reload(self, force: bool = False) -> ConfigSnapshot:
+        """
+        Rebuild the snapshot if any watched file changed on disk
+
+        Args:
+            force: Rebuild even if no change was detected
+
+        Returns:
+            The current snapshot (new or unchanged)
+        """
+        with self._lock:
+            stamps = self._stat_stamps()
+            self._last_check = time.monotonic()
+
+            if not force and stamps == self._stamps and self._snapshot is not None:
+                return self._snapshot
+
+            snapshot = self._build_snapshot()
+            if snapshot is None:
+                if self._snapshot is None:
+                    raise RuntimeError("Unable to load initial configuration (evaluation rules missing)")
+                # Keep serving the last good snapshot if a file is mid-edit or broken
+                print("⚠️ [Config] Reload failed, keeping previous configuration")
+                return self._snapshot
+
+            self._stamps = stamps
+            if self._snapshot is None or snapshot.version != self._snapshot.version:
+                previous = self._snapshot.version if self._snapshot else None
+                print(f"🔄 [Config] Loaded configuration version {snapshot.version} (previous: {previous})")
+                self._snapshot = snapshot
+            return self._snapshot
+
+    def current(self) -> ConfigSnapshot:
+        """Return the current snapshot, re-checking file stamps at most once per interval"""
+        if time.monotonic() - self._last_check >= self.check_interval:
+            return self.reload()
+        return self._snapshot
+
+    @property
+    def version(self) -> str:
+        return self.current().version
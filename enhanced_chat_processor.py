@@ -1,14 +1,26 @@
 import re
 import io
 import os
+import codecs
 import hashlib
 import datetime
-from typing import List, Dict, Any, Optional
+import itertools
+import shutil
+import tarfile
+import threading
+import zipfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import List, Dict, Any, Iterable, Iterator, Optional, Tuple
 import time
 import tempfile
 import glob
 import unicodedata
 
+import regex_guard
+import transcript_tokenizer
+
 # Try to import file handling libraries
 try:
     import pandas as pd
@@ -25,9 +37,64 @@ try:
 except ImportError:
     docx = None
 
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
+# Every header format that can start a new conversation
+CONVERSATION_START_PATTERNS = [
+    r'\b[A-Z]{2,}-\d+\b', # For MS-00148928
+    r"Chat\s*#?\s*\d+",
+    r"Chat\s*:\s*\d+",
+    r"Chat\s+ID\s*:?\s*\d+",
+    r"[A-Z]{2,}\s*[:-]?\s*Chat\s*#?\s*\d+",
+    r"Case\s+ID\s+CT\d+",
+    r"Case\s+\d+",
+    r"Case\s*#\s*\d+",
+    r"Case\s*:\s*\d+",
+]
+CONVERSATION_START_PATTERN = '|'.join(f"(?:{p})" for p in CONVERSATION_START_PATTERNS)
+
+# Minimum size of a conversation worth analyzing
+MIN_CONVERSATION_LINES = 3
+MIN_CONVERSATION_CHARS = 50
+
+# Uploads are read in blocks of this many bytes, and a header cut by a block boundary
+# is looked for again in this many trailing characters
+READ_BLOCK_SIZE = 64 * 1024
+HEADER_OVERLAP = 256
+
+# CSV files are read (and XLSX rows joined) this many rows at a time
+CSV_CHUNK_ROWS = int(os.environ.get('CSV_CHUNK_ROWS', '10000'))
+# One-chat-per-row mode for CSV and XLSX: when the transcript column(s) (comma-separated)
+# are present, every row is one chat, identified by the ID column, and no header splitting is done
+CSV_TRANSCRIPT_COLUMNS = [col.strip() for col in os.environ.get('CSV_TRANSCRIPT_COLUMNS', '').split(',') if col.strip()]
+CSV_ID_COLUMN = os.environ.get('CSV_ID_COLUMN', '').strip()
+
+# Batch uploads may also be ZIP or tar archives of transcript files. Members are read
+# one at a time; at most ARCHIVE_MAX_MEMBERS members of at most ARCHIVE_MAX_MEMBER_MB
+# (uncompressed) each are extracted.
+SUPPORTED_EXTENSIONS = ('txt', 'csv', 'pdf', 'docx', 'xlsx')
+ARCHIVE_EXTENSIONS = ('.zip', '.tar', '.tar.gz', '.tgz')
+ARCHIVE_MAX_MEMBERS = int(os.environ.get('ARCHIVE_MAX_MEMBERS', '1000'))
+ARCHIVE_MAX_MEMBER_MB = int(os.environ.get('ARCHIVE_MAX_MEMBER_MB', '256'))
+
+# Worker processes extracting the files of one upload in parallel (1 disables the pool).
+# Small by default: every gunicorn worker starts its own pool (see ANONYMIZER_WORKERS).
+EXTRACTION_WORKERS = int(os.environ.get('EXTRACTION_WORKERS', str(min(2, os.cpu_count() or 1))))
+# Uploads with fewer files than this are extracted in the request process
+EXTRACTION_PARALLEL_MIN_FILES = int(os.environ.get('EXTRACTION_PARALLEL_MIN_FILES', '2'))
+# PDFs with more pages than this are extracted in page ranges of this size, in parallel
+PDF_PAGES_PER_TASK = int(os.environ.get('PDF_PAGES_PER_TASK', '100'))
+
 class EnhancedChatProcessor:
     """Enhanced processor for extracting and parsing chat transcripts from various file formats"""
 
+    # Whether extracted chats carry their rendered views (see render_chat_views). Turned
+    # off by wrappers that rewrite each chat's content first and render the views themselves.
+    render_views = True
+
     def extract_chats_from_file(self, uploaded_file):
         """
         Extract chats from uploaded file based on file type
@@ -36,195 +103,302 @@ class EnhancedChatProcessor:
         uploaded_file: The uploaded file object (BytesIO with .name attribute or file-like object)
         
         Returns:
-        List of chat dictionaries
+        List of chat dictionaries (empty if the file could not be read)
         """
         try:
-            # Handle both file path strings and file objects
-            if hasattr(uploaded_file, 'name'):
-                filename = uploaded_file.name
-            elif hasattr(uploaded_file, 'filename'):
-                filename = uploaded_file.filename
-            else:
-                raise ValueError("File object must have 'name' or 'filename' attribute")
-                
-            file_extension = filename.split('.')[-1].lower()
-            print(f"Processing file: {filename}, Type: {file_extension}")
-            
-            # Always reset file pointer to beginning
-            if hasattr(uploaded_file, 'seek'):
-                uploaded_file.seek(0)
-            
-            if file_extension == 'txt':
-                return self._extract_from_txt(uploaded_file)
-            elif file_extension == 'csv':
-                if pd is None:
-                    raise ImportError("pandas library is required for CSV processing. Install with: pip install pandas")
-                return self._extract_from_csv(uploaded_file)
-            elif file_extension == 'pdf':
-                if PyPDF2 is None:
-                    raise ImportError("PyPDF2 library is required for PDF processing. Install with: pip install PyPDF2")
-                return self._extract_from_pdf(uploaded_file)
-            elif file_extension == 'docx':
-                if docx is None:
-                    raise ImportError("python-docx library is required for DOCX processing. Install with: pip install python-docx")
-                return self._extract_from_docx(uploaded_file)
-            else:
-                raise ValueError(f"Unsupported file format: {file_extension}")
+            return list(self.iter_chats_from_file(uploaded_file))
         except Exception as e:
             import traceback
             print(f"Error in extract_chats_from_file: {str(e)}")
             print(traceback.format_exc())
             return []
 
-    def _extract_from_txt(self, uploaded_file):
-        """Extract chats from a text file"""
-        try:
-            # Reset file pointer to beginning
-            if hasattr(uploaded_file, 'seek'):
-                uploaded_file.seek(0)
-            
-            # Handle different file object types
-            if hasattr(uploaded_file, 'read'):
-                # For BytesIO objects or file-like objects
-                content_bytes = uploaded_file.read()
-                if isinstance(content_bytes, bytes):
-                    content = content_bytes.decode('utf-8')
-                else:
-                    content = content_bytes
-            else:
-                raise ValueError("File object must have a 'read' method")
-                
-            return self._split_text_into_chats(content)
-        except Exception as e:
-            print(f"Error extracting from TXT: {str(e)}")
-            return []
+    def extract_chats_from_files(self, uploaded_files, parallel: Optional[bool] = None):
+        """
+        Extract chats from several uploaded files, one process pool task per file
+        
+        See extract_chats_from_files() at module level.
+        """
+        return extract_chats_from_files(self, uploaded_files, parallel)
 
-    def _extract_from_csv(self, uploaded_file):
-        """Extract chats from a CSV file"""
-        try:
-            # Reset file pointer to beginning
-            if hasattr(uploaded_file, 'seek'):
-                uploaded_file.seek(0)
+    def iter_chats_from_file(self, uploaded_file, filename: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+        """
+        Yield chats from an uploaded file as they are found
+        
+        The file is consumed as a stream (a spooled upload is never copied into
+        memory as a whole for .txt and .pdf), so only the chat being assembled is
+        held. Errors are raised to the caller.
+        
+        Args:
+        uploaded_file: File-like object with a .filename (e.g. werkzeug FileStorage) or .name
+        filename: Name to use instead (its extension selects the extractor)
+        """
+        # Handle both file path strings and file objects
+        filename = filename or getattr(uploaded_file, 'filename', None) or getattr(uploaded_file, 'name', None)
+        if not filename:
+            raise ValueError("File object must have 'name' or 'filename' attribute")
             
-            # Read CSV into pandas DataFrame
-            # Handle both BytesIO and file-like objects
-            if hasattr(uploaded_file, 'getvalue'):
-                # For BytesIO objects
-                csv_content = uploaded_file.getvalue()
-                if isinstance(csv_content, bytes):
-                    csv_content = csv_content.decode('utf-8')
-                df = pd.read_csv(io.StringIO(csv_content))
-            else:
-                # For other file-like objects
-                df = pd.read_csv(uploaded_file)
-
-            # Check for common columns that might contain chat content
-            content_columns = [col for col in df.columns if any(
-                term in col.lower() for term in ['chat', 'message', 'content', 'text', 'transcript']
-            )]
-
-            if not content_columns:
-                # If no obvious content column, use the first column containing text data
-                for col in df.columns:
-                    if df[col].dtype == 'object':
-                        content_columns = [col]
-                        break
-
-            # If still no content column found, use all columns
-            if not content_columns:
-                print("Warning: Couldn't identify chat content columns. Using all columns.")
-                content_columns = df.columns.tolist()
+        file_extension = filename.split('.')[-1].lower()
+        print(f"Processing file: {filename}, Type: {file_extension}")
+        
+        # Always reset file pointer to beginning
+        if hasattr(uploaded_file, 'seek'):
+            uploaded_file.seek(0)
+        
+        if file_extension == 'txt':
+            return self._extract_from_txt(uploaded_file)
+        elif file_extension == 'csv':
+            if pd is None:
+                raise ImportError("pandas library is required for CSV processing. Install with: pip install pandas")
+            return self._extract_from_csv(uploaded_file)
+        elif file_extension == 'pdf':
+            if PyPDF2 is None:
+                raise ImportError("PyPDF2 library is required for PDF processing. Install with: pip install PyPDF2")
+            return self._extract_from_pdf(uploaded_file)
+        elif file_extension == 'docx':
+            if docx is None:
+                raise ImportError("python-docx library is required for DOCX processing. Install with: pip install python-docx")
+            return self._extract_from_docx(uploaded_file)
+        elif file_extension == 'xlsx':
+            if openpyxl is None:
+                raise ImportError("openpyxl library is required for XLSX processing. Install with: pip install openpyxl")
+            return self._extract_from_xlsx(uploaded_file)
+        else:
+            raise ValueError(f"Unsupported file format: {file_extension}")
+
+    @staticmethod
+    def _read_text_blocks(uploaded_file) -> Iterator[str]:
+        """Decode a binary (or text) stream as UTF-8, one block at a time"""
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        while True:
+            block = uploaded_file.read(READ_BLOCK_SIZE)
+            if not block:
+                break
+            yield decoder.decode(block) if isinstance(block, bytes) else block
+        tail = decoder.decode(b'', final=True)
+        if tail:
+            yield tail
+
+    def _extract_from_txt(self, uploaded_file) -> Iterator[Dict[str, Any]]:
+        """Extract chats from a text file"""
+        if not hasattr(uploaded_file, 'read'):
+            raise ValueError("File object must have a 'read' method")
+        return self._iter_chats_from_blocks(self._read_text_blocks(uploaded_file))
 
-            # Join all content into a single string
-            content = ""
+    def _extract_from_csv(self, uploaded_file) -> Iterator[Dict[str, Any]]:
+        """
+        Extract chats from a CSV file, CSV_CHUNK_ROWS rows at a time
+        
+        With CSV_TRANSCRIPT_COLUMNS configured and present, every row is one chat
+        (see _iter_chats_from_csv_rows). Otherwise the content columns are joined
+        into text, chunk by chunk, and split into chats by their headers.
+        """
+        # pandas reads binary and text file-like objects directly; no in-memory copy of the upload
+        columns = pd.read_csv(uploaded_file, encoding='utf-8', nrows=0).columns.tolist()
+        uploaded_file.seek(0)
+        
+        if CSV_TRANSCRIPT_COLUMNS:
+            missing = [col for col in CSV_TRANSCRIPT_COLUMNS + [CSV_ID_COLUMN] if col and col not in columns]
+            if not missing:
+                return self._iter_chats_from_csv_rows(uploaded_file)
+            print(f"⚠️ [Extraction] CSV lacks column(s) {missing}, splitting it by chat headers instead")
+        
+        chunks = pd.read_csv(uploaded_file, encoding='utf-8', chunksize=CSV_CHUNK_ROWS)
+        first_chunk = next(chunks, None)
+        if first_chunk is None:
+            return iter(())
+        
+        # Check for common columns that might contain chat content
+        content_columns = [col for col in columns if any(
+            term in col.lower() for term in ['chat', 'message', 'content', 'text', 'transcript']
+        )]
+
+        if not content_columns:
+            # If no obvious content column, use the first column containing text data
+            for col in columns:
+                if first_chunk[col].dtype == 'object':
+                    content_columns = [col]
+                    break
+
+        # If still no content column found, use all columns
+        if not content_columns:
+            print("Warning: Couldn't identify chat content columns. Using all columns.")
+            content_columns = columns
+
+        return self._iter_chats_from_blocks(
+            self._csv_text_blocks(itertools.chain([first_chunk], chunks), content_columns)
+        )
+
+    @staticmethod
+    def _csv_text_blocks(chunks: Iterable[Any], content_columns: List[str]) -> Iterator[str]:
+        """Join the content columns of each chunk into text, without per-row Python loops"""
+        def as_text(column):
+            # Missing values read as 'nan', the text str() gives them
+            return column.astype(str).fillna('nan')
+
+        if len(content_columns) == 1:
+            # Use entire CSV as one text, one value per line
+            main_col = content_columns[0]
+            for i, chunk in enumerate(chunks):
+                if len(chunk):
+                    yield ("\n" if i else "") + as_text(chunk[main_col]).str.cat(sep="\n")
+        else:
+            # Try to format as a dialogue, a blank line after each row
+            for chunk in chunks:
+                labelled = [f"{col}: " + as_text(chunk[col]) for col in content_columns]
+                yield (labelled[0].str.cat(labelled[1:], sep="\n") + "\n\n").str.cat()
+
+    def _iter_chats_from_csv_rows(self, uploaded_file) -> Iterator[Dict[str, Any]]:
+        """
+        One chat per row: the CSV_TRANSCRIPT_COLUMNS joined by newlines, identified by CSV_ID_COLUMN
+        
+        Rows with an empty transcript are skipped. Without an ID column (or value),
+        the row number is used.
+        """
+        usecols = CSV_TRANSCRIPT_COLUMNS + ([CSV_ID_COLUMN] if CSV_ID_COLUMN else [])
+        chunks = pd.read_csv(uploaded_file, encoding='utf-8', usecols=usecols, dtype=str,
+                             keep_default_na=False, chunksize=CSV_CHUNK_ROWS)
+        row_number = 0
+        for chunk in chunks:
+            transcripts = chunk[CSV_TRANSCRIPT_COLUMNS[0]].str.cat(
+                [chunk[col] for col in CSV_TRANSCRIPT_COLUMNS[1:]], sep="\n"
+            ).str.strip()
+            ids = chunk[CSV_ID_COLUMN].str.strip() if CSV_ID_COLUMN else itertools.repeat('')
+            for raw_id, content in zip(ids, transcripts):
+                row_number += 1
+                if content:
+                    yield self._build_row_chat(raw_id, content, row_number)
+
+    def _build_row_chat(self, raw_id: str, content: str, row_number: int) -> Dict[str, Any]:
+        """Chat of one spreadsheet row in one-chat-per-row mode"""
+        _, conversation_type = self._extract_conversation_id_and_type(raw_id)
+        return {
+            'id': raw_id or f"Row_{row_number}",
+            'type': conversation_type,
+            'content': content,
+            'timestamp': self._extract_timestamp(content) or datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            **self._chat_views(content)
+        }
 
-            if len(content_columns) == 1:
-                # Use entire CSV as one chat
-                main_col = content_columns[0]
-                content = "\n".join(df[main_col].astype(str).tolist())
-            else:
-                # Try to format as a dialogue
-                for _, row in df.iterrows():
-                    for col in content_columns:
-                        content += f"{col}: {row[col]}\n"
-                    content += "\n"
+    def _extract_from_xlsx(self, uploaded_file) -> Iterator[Dict[str, Any]]:
+        """
+        Extract chats from the first worksheet of an Excel workbook
+        
+        The workbook is opened in openpyxl's read-only mode, which streams rows
+        from the file instead of loading every cell. The first row is the header;
+        columns are chosen as for CSV files, including one-chat-per-row mode.
+        """
+        workbook = openpyxl.load_workbook(uploaded_file, read_only=True, data_only=True)
+        return self._iter_chats_from_xlsx(workbook)
 
-            return self._split_text_into_chats(content)
+    def _iter_chats_from_xlsx(self, workbook) -> Iterator[Dict[str, Any]]:
+        def cell_text(value) -> str:
+            return '' if value is None else str(value)
 
-        except Exception as e:
-            print(f"Error extracting from CSV: {str(e)}")
-            return []
-    
-    def _extract_from_pdf(self, uploaded_file):
-        """Extract chats from a PDF file"""
         try:
-            # Reset file pointer to beginning
-            if hasattr(uploaded_file, 'seek'):
-                uploaded_file.seek(0)
+            rows = workbook.worksheets[0].iter_rows(values_only=True)
+            header = next(rows, None)
+            if header is None:
+                return
+            columns = [cell_text(value).strip() for value in header]
+            
+            if CSV_TRANSCRIPT_COLUMNS:
+                missing = [col for col in CSV_TRANSCRIPT_COLUMNS + [CSV_ID_COLUMN] if col and col not in columns]
+                if not missing:
+                    transcript_indexes = [columns.index(col) for col in CSV_TRANSCRIPT_COLUMNS]
+                    id_index = columns.index(CSV_ID_COLUMN) if CSV_ID_COLUMN else None
+                    for row_number, row in enumerate(rows, 1):
+                        content = "\n".join(cell_text(row[i]) for i in transcript_indexes if i < len(row)).strip()
+                        raw_id = cell_text(row[id_index]).strip() if id_index is not None and id_index < len(row) else ''
+                        if content:
+                            yield self._build_row_chat(raw_id, content, row_number)
+                    return
+                print(f"⚠️ [Extraction] Worksheet lacks column(s) {missing}, splitting it by chat headers instead")
             
-            # Handle different file object types
-            if hasattr(uploaded_file, 'getvalue'):
-                # For BytesIO objects
-                pdf_data = uploaded_file.getvalue()
-                pdf_reader = PyPDF2.PdfReader(io.BytesIO(pdf_data))
+            first_row = next(rows, None)
+            if first_row is None:
+                return
+            rows = itertools.chain([first_row], rows)
+            
+            # Same column choice as for CSV files
+            content_indexes = [i for i, col in enumerate(columns) if any(
+                term in col.lower() for term in ['chat', 'message', 'content', 'text', 'transcript']
+            )]
+            if not content_indexes:
+                content_indexes = [i for i, value in enumerate(first_row) if isinstance(value, str)][:1]
+            if not content_indexes:
+                print("Warning: Couldn't identify chat content columns. Using all columns.")
+                content_indexes = list(range(len(columns)))
+            
+            if len(content_indexes) == 1:
+                # One value per line
+                index = content_indexes[0]
+                lines = (cell_text(row[index]) + "\n" if index < len(row) else "\n" for row in rows)
             else:
-                # For other file-like objects
-                pdf_reader = PyPDF2.PdfReader(uploaded_file)
-                
-            content = ""
-
-            # Extract text from all pages
-            for page_num in range(len(pdf_reader.pages)):
-                content += pdf_reader.pages[page_num].extract_text() + "\n\n"
-                
-            return self._split_text_into_chats(content)
+                # Formatted as a dialogue, a blank line after each row
+                lines = (''.join(f"{columns[i]}: {cell_text(row[i]) if i < len(row) else ''}\n" for i in content_indexes) + "\n"
+                         for row in rows)
             
-        except Exception as e:
-            print(f"Error extracting from PDF: {str(e)}")
-            return []
-
-    def _extract_from_docx(self, uploaded_file):
+            def blocks():
+                while True:
+                    block = ''.join(itertools.islice(lines, CSV_CHUNK_ROWS))
+                    if not block:
+                        return
+                    yield block
+            
+            yield from self._iter_chats_from_blocks(blocks())
+        finally:
+            # Read-only workbooks keep the file open until closed
+            workbook.close()
+    
+    def _extract_from_pdf(self, uploaded_file) -> Iterator[Dict[str, Any]]:
+        """
+        Extract chats from a PDF file, page by page
+        
+        Page text is streamed into the chat splitter, which carries partial chats
+        across page boundaries. Large PDFs are read in page ranges by the
+        extraction pool (unless this already runs in a pool worker).
+        """
+        # PdfReader seeks in the (spooled) upload itself instead of a copy of its bytes
+        pdf_reader = PyPDF2.PdfReader(uploaded_file)
+        page_count = len(pdf_reader.pages)
+        if page_count > PDF_PAGES_PER_TASK and EXTRACTION_WORKERS > 1 and not _in_worker:
+            print(f"🧵 [Extraction] Reading {page_count} PDF pages in ranges of {PDF_PAGES_PER_TASK}")
+            return self._iter_chats_from_blocks(_iter_pdf_pages_parallel(uploaded_file, page_count))
+        return self._iter_chats_from_blocks(page.extract_text() + "\n\n" for page in pdf_reader.pages)
+
+    def _extract_from_docx(self, uploaded_file) -> Iterator[Dict[str, Any]]:
         """
         Extract chats from a DOCX file, now with support for tables and improved error handling.
     
         """
-        try:
-            if hasattr(uploaded_file, 'seek'):
-                uploaded_file.seek(0)
-            
-            doc = docx.Document(uploaded_file)
-            full_text = []
-
-            # Iterate through paragraphs
-            for para in doc.paragraphs:
-                if para.text:
-                    text = para.text.strip()
-                    # Normalize Unicode text to handle mixed encodings
-                    text = unicodedata.normalize('NFC', text)
-                    full_text.append(text)
-
-            # Iterate through tables to extract all text from cells
-            for table in doc.tables:
-                for row in table.rows:
-                    for cell in row.cells:
-                        # Check if the cell has text to avoid errors
-                        if cell.text:
-                            full_text.append(cell.text.strip())
-            
-            # Join all extracted text into a single block
-            content = "\n".join(full_text)
-            
-            if not content:
-                print("Warning: No text content was extracted from the DOCX file.")
-                return []
+        doc = docx.Document(uploaded_file)
+        full_text = []
+
+        # Iterate through paragraphs
+        for para in doc.paragraphs:
+            if para.text:
+                text = para.text.strip()
+                # Normalize Unicode text to handle mixed encodings
+                text = unicodedata.normalize('NFC', text)
+                full_text.append(text)
+
+        # Iterate through tables to extract all text from cells
+        for table in doc.tables:
+            for row in table.rows:
+                for cell in row.cells:
+                    # Check if the cell has text to avoid errors
+                    if cell.text:
+                        full_text.append(cell.text.strip())
+        
+        # Join all extracted text into a single block
+        content = "\n".join(full_text)
+        
+        if not content:
+            print("Warning: No text content was extracted from the DOCX file.")
+            return iter([])
 
-            return self._split_text_into_chats(content)
-            
-        except Exception as e:
-            import traceback
-            print(f"Error extracting from DOCX: {str(e)}")
-            print(traceback.format_exc())
-            return []
+        return self._iter_chats_from_blocks([content])
 
     def _extract_conversation_id_and_type(self, header_text: str) -> tuple[Optional[str], str]:
         """
@@ -234,7 +408,7 @@ class EnhancedChatProcessor:
         """
         # NEW: First, check for the specific 'PREFIX-NUMBER' format (e.g., MS-00148928)
         # The pattern captures the prefix and the number in two separate groups
-        prefix_match = re.search(r'\b([A-Z]{2,}-)(\d+)\b', header_text)
+        prefix_match = regex_guard.search(r'\b([A-Z]{2,}-)(\d+)\b', header_text)
         if prefix_match:
             prefix = prefix_match.group(1) # e.g., "MS-"
             number = prefix_match.group(2) # e.g., "00148928"
@@ -262,14 +436,14 @@ class EnhancedChatProcessor:
         
         # Check for Chat patterns
         for pattern in chat_patterns:
-            match = re.search(pattern, header_text, re.IGNORECASE)
+            match = regex_guard.search(pattern, header_text, re.IGNORECASE)
             if match:
                 chat_id = match.group(1)
                 return f"Chat_{chat_id}", "chat"
         
         # Check for Case patterns
         for pattern in case_patterns:
-            match = re.search(pattern, header_text, re.IGNORECASE)
+            match = regex_guard.search(pattern, header_text, re.IGNORECASE)
             if match:
                 case_id = match.group(1)
                 # Special handling for "CT" prefix
@@ -287,64 +461,78 @@ class EnhancedChatProcessor:
         FINAL VERSION: Flexibly finds all known header formats to reliably split chats.
     
         """
-        conversations = []
-        
-        MIN_LINES = 3
-        MIN_CHARS = 50
+        return list(self._iter_chats_from_blocks([text]))
+
+    def _iter_chats_from_blocks(self, blocks: Iterable[str]) -> Iterator[Dict[str, Any]]:
+        """
+        Split text arriving in blocks into conversations, yielding each one when complete
         
-        # This list contains all valid patterns that can start a new conversation.
-        conversation_start_patterns = [
-            r'\b[A-Z]{2,}-\d+\b', # For MS-00148928
-            r"Chat\s*#?\s*\d+",
-            r"Chat\s*:\s*\d+",
-            r"Chat\s+ID\s*:?\s*\d+",
-            r"[A-Z]{2,}\s*[:-]?\s*Chat\s*#?\s*\d+",
-            r"Case\s+ID\s+CT\d+",
-            r"Case\s+\d+",
-            r"Case\s*#\s*\d+",
-            r"Case\s*:\s*\d+",
-        ]
+        Each conversation runs from one header to the next. A header only counts
+        once text follows it (so a header cut by a block boundary is not taken
+        for a shorter one), and the last HEADER_OVERLAP characters are scanned
+        again when the next block arrives. Text before the first header is
+        dropped; text with no header at all is treated as one conversation.
+        Joined, the blocks give exactly the conversations of the whole text.
+        """
+        header_regex = regex_guard.compile(CONVERSATION_START_PATTERN, re.IGNORECASE | re.MULTILINE)
         
-        combined_pattern = '|'.join(f"(?:{p})" for p in conversation_start_patterns)
+        buffer = ""
+        scan_from = 0
+        header = None   # Header of the conversation starting at buffer[0]
+        header_index = 0
         
-        # Use re.finditer to get the start and end position of each header match.
-        # This is more robust than splitting the string.
-        matches = list(re.finditer(combined_pattern, text, re.IGNORECASE | re.MULTILINE))
+        # None marks the end of the input
+        for block in itertools.chain(blocks, [None]):
+            final = block is None
+            if not final:
+                buffer += block
+            
+            matches = header_regex.finditer(buffer, scan_from)
+            if not final:
+                # A header reaching the end of the buffer may still grow
+                matches = [match for match in matches if match.end() < len(buffer)]
+            
+            cut = 0
+            for match in matches:
+                if header is not None:
+                    yield from self._build_conversation(buffer[cut:match.start()], header, header_index - 1)
+                header = match.group(0).strip()
+                header_index += 1
+                cut = match.start()
+            
+            if final:
+                break
+            
+            scan_from = max(matches[-1].end() - cut if matches else 0, len(buffer) - cut - HEADER_OVERLAP, scan_from - cut)
+            buffer = buffer[cut:]
         
-        if not matches:
+        if header is not None:
+            yield from self._build_conversation(buffer[cut:], header, header_index - 1)
+        elif len(buffer.strip()) > MIN_CONVERSATION_CHARS:
             # Fallback for files with no recognizable headers, treat as one chat.
-            if len(text.strip()) > MIN_CHARS:
-                return [{
-                    'id': 'Conversation_Single',
-                    'type': 'unknown',
-                    'content': text,
-                    'timestamp': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                    'processed_content': self._clean_and_process_chat(text)
-                }]
-            return []
-
-        # Iterate through the matches to slice the text into individual chats.
-        for i, match in enumerate(matches):
-            start_pos = match.start()
-            # The end of the current chat is the start of the next one.
-            end_pos = matches[i + 1].start() if i + 1 < len(matches) else len(text)
-            
-            full_conversation_text = text[start_pos:end_pos].strip()
-            header = match.group(0).strip()
+            yield {
+                'id': 'Conversation_Single',
+                'type': 'unknown',
+                'content': buffer,
+                'timestamp': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                **self._chat_views(buffer)
+            }
+
+    def _build_conversation(self, text: str, header: str, index: int) -> Iterator[Dict[str, Any]]:
+        """Yield the conversation text[...] started by header, if it is long enough to analyze"""
+        full_conversation_text = text.strip()
+        
+        lines = [line for line in full_conversation_text.split('\n') if line.strip()]
+        if len(lines) >= MIN_CONVERSATION_LINES and len(full_conversation_text) >= MIN_CONVERSATION_CHARS:
+            conversation_id, conversation_type = self._extract_conversation_id_and_type(header)
             
-            lines = [line for line in full_conversation_text.split('\n') if line.strip()]
-            if len(lines) >= MIN_LINES and len(full_conversation_text) >= MIN_CHARS:
-                conversation_id, conversation_type = self._extract_conversation_id_and_type(header)
-                
-                conversations.append({
-                    'id': conversation_id or f"Unknown_{i}",
-                    'type': conversation_type,
-                    'content': full_conversation_text,
-                    'timestamp': self._extract_timestamp(full_conversation_text) or datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                    'processed_content': self._clean_and_process_chat(full_conversation_text)
-                })
-                
-        return conversations
+            yield {
+                'id': conversation_id or f"Unknown_{index}",
+                'type': conversation_type,
+                'content': full_conversation_text,
+                'timestamp': self._extract_timestamp(full_conversation_text) or datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                **self._chat_views(full_conversation_text)
+            }
 
     def _extract_chat_id(self, chat_text: str) -> Optional[str]:
         """Extract chat/case ID from text - Updated for backward compatibility."""
@@ -360,7 +548,7 @@ class EnhancedChatProcessor:
         ]
 
         for pattern in timestamp_patterns:
-            match = re.search(pattern, chat_text, re.IGNORECASE)
+            match = regex_guard.search(pattern, chat_text, re.IGNORECASE)
             if match:
                 try:
                     timestamp_str = match.group(1).strip()
@@ -381,123 +569,323 @@ class EnhancedChatProcessor:
 
     def _clean_and_process_chat(self, chat_text: str) -> str:
         """
-        Clean and format chat content for analysis - UPDATED to preserve category headers
-        This version handles inconsistent line breaks AND preserves important metadata.
+        Clean and format chat content for analysis, preserving category headers
+
+        Returns:
+            One line per message ("Customer: ...", "Agent: ...") plus category headers;
+            '' if neither a speaker nor a category header was found
         """
-        # === NEW: Pre-processing step to normalize inconsistent line breaks ===
-        original_lines = chat_text.split('\n')
-        normalized_lines = []
-        i = 0
-        while i < len(original_lines):
-            line = original_lines[i].strip()
-            
-            # IMPORTANT: Preserve category headers - don't process them as speaker lines
-            if line.startswith('**Chat reason:') or line.startswith('Chat reason:') or 'Chat reason:' in line:
-                normalized_lines.append(line)
-                i += 1
-                continue
-                
-            # Check if the NEXT line starts with the '•' timestamp marker
-            if (i + 1) < len(original_lines) and original_lines[i+1].strip().startswith('•'):
-                # This is a split speaker/timestamp. Join them.
-                speaker_name = line
-                timestamp_part = original_lines[i+1].strip()
-                # Combine them into a single, standardized line
-                normalized_lines.append(f"{speaker_name} {timestamp_part}")
-                i += 2 # Skip the next line since we've already processed it
-            else:
-                # This is a regular line
-                if line:
-                    normalized_lines.append(line)
-                i += 1
-        # =======================================================================
-
-        processed_lines = []
-        has_valid_content = False
-        
-        # UPDATED: Skip patterns that DON'T include category headers
-        skip_patterns = [
-            r'^\s*\{ChatWindowButton:',
-            r'^\s*Agent joined the conversation\.',
-            r'^\s*Automated Process\s*•',
-            r'^\s*A transfer request was sent',
-            r'^.*(left|joined) the conversation\s*•',
-            r'^\s*Preview:.*\.(jpg|png|pdf|jpeg)',
-            # REMOVED: The general asterisk pattern that was catching category headers
-            # r'^\s*[-=*_]{3,}\s*$',  # This was removing **Chat reason: ...**
-        ]
-        
-        # Patterns are now simpler because the input is normalized
-        speaker_patterns = {
-            'customer': [
-                r'^Guest\s*•',
-            ],
-            'agent': [
-                r'^[A-Za-z\s]+\s*•', # Matches any name (e.g., "Jeremy N", "Kang A") followed by '•'
-            ]
+        return transcript_tokenizer.render_processed(transcript_tokenizer.tokenize(chat_text))
+
+    def _chat_views(self, chat_text: str) -> Dict[str, str]:
+        """Rendered views of an extracted chat (see render_views), empty when they are off"""
+        return self.render_chat_views(chat_text) if self.render_views else {}
+
+    def render_chat_views(self, chat_text: str) -> Dict[str, str]:
+        """
+        Both derived views of a chat, rendered from a single tokenize() of its text
+
+        Returns:
+            {'processed_content': cleaned transcript, 'formatted_transcript': dialogue
+            for the model, as format_transcript_for_ai() renders it}
+        """
+        turns = transcript_tokenizer.tokenize(chat_text)
+        return {
+            'processed_content': transcript_tokenizer.render_processed(turns),
+            'formatted_transcript': transcript_tokenizer.render_for_ai(turns),
         }
-        
-        # For backward compatibility with old formats that use colons
-        old_format_speaker_regex = re.compile(r'^(?:Customer|Client|Visitor|User|Guest|Agent|Support|Bot|Pepper):', re.IGNORECASE)
-
-        # Compile patterns for the new format
-        customer_regex = re.compile('|'.join(speaker_patterns['customer']), re.IGNORECASE)
-        agent_regex = re.compile('|'.join(speaker_patterns['agent']), re.IGNORECASE)
-        skip_regex = re.compile('|'.join(skip_patterns), re.IGNORECASE)
-
-        current_speaker = None
-        current_message_lines = []
-
-        def commit_message():
-            nonlocal has_valid_content
-            if current_speaker and current_message_lines:
-                message_text = ' '.join(current_message_lines).strip()
-                if message_text:
-                    # For old formats, the speaker tag is already in the message, so we don't add it again.
-                    if not old_format_speaker_regex.match(message_text):
-                        processed_lines.append(f"{current_speaker}: {message_text}")
-                    else:
-                        processed_lines.append(message_text)
-                    has_valid_content = True
-            current_message_lines.clear()
-
-        # Process the NORMALIZED lines
-        for line in normalized_lines:
-            # IMPORTANT: Preserve category headers as-is
-            if 'Chat reason:' in line or 'Category:' in line or 'Issue type:' in line or 'Topic:' in line:
-                processed_lines.append(line)  # Keep category headers intact
-                has_valid_content = True
-                continue
-                
-            if skip_regex.match(line):
-                continue
-
-            is_new_speaker = False
-            if customer_regex.search(line):
-                commit_message()
-                current_speaker = "Customer"
-                is_new_speaker = True
-            elif agent_regex.search(line):
-                commit_message()
-                current_speaker = "Agent"
-                is_new_speaker = True
-            elif old_format_speaker_regex.match(line):
-                # Handle old formats
-                commit_message()
-                speaker_tag = line.split(':')[0]
-                current_speaker = "Agent" if "agent" in speaker_tag.lower() or "support" in speaker_tag.lower() else "Customer"
-                current_message_lines.append(line) # Keep the original line with the tag
-                is_new_speaker = True
-
-            if not is_new_speaker and current_speaker:
-                current_message_lines.append(line)
-
-        commit_message()
-
-        if has_valid_content:
-            return '\n'.join(processed_lines)
-        
-        return ''
+
+# ================ PROCESS POOL ================
+# PDF/DOCX parsing and chat cleaning are CPU-bound, so the files of one upload are
+# extracted in a warm process pool, one task per file (or per page range of a large
+# PDF). Each worker keeps one processor per processor class (plain or
+# auto-anonymizing) for its lifetime.
+
+_worker_processors: Dict[type, Any] = {}
+_in_worker = False
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def _init_worker():
+    # Workers never start page-range tasks of their own
+    global _in_worker
+    _in_worker = True
+
+
+def _extract_in_worker(processor_class: type, path: str, filename: str) -> List[Dict[str, Any]]:
+    """Extract every chat of one spooled upload in a pool worker"""
+    processor = _worker_processors.get(processor_class)
+    if processor is None:
+        processor = _worker_processors[processor_class] = processor_class()
+    with open(path, 'rb') as f:
+        return list(processor.iter_chats_from_file(f, filename=filename))
+
+
+def get_extraction_pool() -> ProcessPoolExecutor:
+    """The shared, lazily started extraction pool"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=EXTRACTION_WORKERS, initializer=_init_worker)
+            print(f"🧵 [Extraction] Started process pool with {EXTRACTION_WORKERS} workers")
+        return _pool
+
+
+def shutdown_extraction_pool():
+    """Stop the pool (it is restarted on next use)"""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+
+def _extract_pdf_pages_in_worker(path: str, start: int, end: int) -> List[str]:
+    """Text of pages [start, end) of a PDF, each followed by a blank line as in serial extraction"""
+    pdf_reader = PyPDF2.PdfReader(path)
+    return [pdf_reader.pages[number].extract_text() + "\n\n" for number in range(start, end)]
+
+
+def _iter_pdf_pages_parallel(uploaded_file, page_count: int) -> Iterator[str]:
+    """
+    Yield the text of every page in order, page ranges being read by the extraction pool
+    
+    At most two ranges per worker are in flight, so finished text waiting for an
+    earlier range stays bounded. If the pool breaks, the remaining pages are read here.
+    """
+    path = _spool_to_disk(uploaded_file)
+    ranges = deque((start, min(start + PDF_PAGES_PER_TASK, page_count))
+                   for start in range(0, page_count, PDF_PAGES_PER_TASK))
+    pending = deque()
+    try:
+        pool = get_extraction_pool()
+        while ranges or pending:
+            while ranges and len(pending) < EXTRACTION_WORKERS * 2:
+                start, end = ranges.popleft()
+                pending.append((start, end, pool.submit(_extract_pdf_pages_in_worker, path, start, end)))
+            start, end, future = pending[0]
+            try:
+                pages = future.result()
+            except BrokenProcessPool as pool_error:
+                print(f"⚠️ [Extraction] Process pool unavailable ({pool_error}), reading pages {start}+ serially")
+                shutdown_extraction_pool()
+                pending.clear()
+                pdf_reader = PyPDF2.PdfReader(path)
+                for number in range(start, page_count):
+                    yield pdf_reader.pages[number].extract_text() + "\n\n"
+                return
+            pending.popleft()
+            yield from pages
+    finally:
+        for _, _, future in pending:
+            future.cancel()
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def _spool_to_disk(uploaded_file) -> str:
+    """Copy an upload stream to a private temp file that pool workers can open by path"""
+    if hasattr(uploaded_file, 'seek'):
+        uploaded_file.seek(0)
+    fd, path = tempfile.mkstemp(prefix='qa_upload_')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            shutil.copyfileobj(uploaded_file, f, READ_BLOCK_SIZE)
+    except Exception:
+        os.remove(path)
+        raise
+    return path
+
+
+def is_archive(filename: Optional[str]) -> bool:
+    return bool(filename) and filename.lower().endswith(ARCHIVE_EXTENSIONS)
+
+
+def iter_archive_members(archive_file, archive_name: str) -> Iterator[Tuple[str, Any, Optional[str]]]:
+    """
+    Yield (name, stream, error) for each transcript file of a ZIP or tar archive
+    
+    Members are decompressed while they are read, one at a time; nothing is
+    extracted to disk. Each stream is closed when the next member is requested.
+    Directories, hidden files and files of unsupported types are skipped. A
+    member over ARCHIVE_MAX_MEMBER_MB, or beyond ARCHIVE_MAX_MEMBERS, comes with
+    an error message instead of a stream.
+    
+    Raises:
+        zipfile.BadZipFile, tarfile.TarError: The archive itself cannot be read
+    """
+    max_bytes = ARCHIVE_MAX_MEMBER_MB * 1024 * 1024
+    if hasattr(archive_file, 'seek'):
+        archive_file.seek(0)
+    
+    def wanted(name: str) -> bool:
+        basename = name.rsplit('/', 1)[-1]
+        if not basename or basename.startswith('.') or name.startswith('__MACOSX/'):
+            return False
+        if basename.rsplit('.', 1)[-1].lower() not in SUPPORTED_EXTENSIONS:
+            print(f"⚠️ [Extraction] Skipping {archive_name}/{name}: unsupported file type")
+            return False
+        return True
+    
+    count = 0
+    if archive_name.lower().endswith('.zip'):
+        with zipfile.ZipFile(archive_file) as archive:
+            for info in archive.infolist():
+                if info.is_dir() or not wanted(info.filename):
+                    continue
+                count += 1
+                if count > ARCHIVE_MAX_MEMBERS:
+                    yield info.filename, None, f"Archive has more than {ARCHIVE_MAX_MEMBERS} files, the rest were not read"
+                    return
+                if info.file_size > max_bytes:
+                    yield info.filename, None, f"File exceeds {ARCHIVE_MAX_MEMBER_MB}MB uncompressed"
+                    continue
+                with archive.open(info) as member:
+                    yield info.filename, member, None
+    else:
+        # 'r:*' detects the compression; members are still read in order from the stream
+        with tarfile.open(fileobj=archive_file, mode='r:*') as archive:
+            for info in archive:
+                if not info.isfile() or not wanted(info.name):
+                    continue
+                count += 1
+                if count > ARCHIVE_MAX_MEMBERS:
+                    yield info.name, None, f"Archive has more than {ARCHIVE_MAX_MEMBERS} files, the rest were not read"
+                    return
+                if info.size > max_bytes:
+                    yield info.name, None, f"File exceeds {ARCHIVE_MAX_MEMBER_MB}MB uncompressed"
+                    continue
+                with archive.extractfile(info) as member:
+                    yield info.name, member, None
+
+
+def _iter_upload_entries(uploaded_files, filenames: List[str]) -> Iterator[Tuple[str, Any, Optional[str]]]:
+    """(name, stream, error) for every plain upload and every member of an uploaded archive"""
+    for uploaded_file, filename in zip(uploaded_files, filenames):
+        if not is_archive(filename):
+            yield filename, uploaded_file, None
+            continue
+        members = 0
+        try:
+            for name, member, error in iter_archive_members(uploaded_file, filename):
+                members += 1
+                yield f"{filename}/{name}", member, error
+        except (zipfile.BadZipFile, tarfile.TarError, EOFError, OSError) as e:
+            print(f"❌ [Extraction] {filename}: {str(e)}")
+            yield filename, None, f"Could not read archive: {str(e)}"
+            continue
+        if not members:
+            yield filename, None, "Archive contains no supported transcript files"
+
+
+def extract_chats_from_files(processor, uploaded_files, parallel: Optional[bool] = None
+                             ) -> List[Tuple[str, List[Dict[str, Any]], Optional[str]]]:
+    """
+    Extract chats from several uploaded files, in parallel when worthwhile
+    
+    ZIP and tar archives (see iter_archive_members) are expanded into their
+    members, which are reported like uploaded files, named "<archive>/<member>".
+    
+    Args:
+        processor: EnhancedChatProcessor or a drop-in replacement; workers build
+            their own instance of the same class
+        uploaded_files: File-like objects with a .filename or .name
+        parallel: Use the process pool. Defaults to True for at least
+            EXTRACTION_PARALLEL_MIN_FILES files, or any archive, when more than one
+            worker is configured.
+    
+    Returns:
+        (filename, chats, error) per file, in upload order; error is None when the
+        file was read, otherwise the message of what went wrong with that file
+    """
+    filenames = [getattr(f, 'filename', None) or getattr(f, 'name', None) or f"file_{i+1}"
+                 for i, f in enumerate(uploaded_files)]
+    if parallel is None:
+        parallel = EXTRACTION_WORKERS > 1 and (len(uploaded_files) >= EXTRACTION_PARALLEL_MIN_FILES
+                                               or any(is_archive(name) for name in filenames))
+    
+    def extract(name, stream):
+        try:
+            return name, list(processor.iter_chats_from_file(stream, filename=name)), None
+        except Exception as e:
+            print(f"❌ [Extraction] {name}: {str(e)}")
+            return name, [], str(e)
+    
+    outcomes = []
+    entries = _iter_upload_entries(uploaded_files, filenames)
+    
+    if parallel:
+        # Files are spooled to disk for the workers as they are submitted; at most two
+        # per worker are waiting at a time, so an archive is never unpacked as a whole
+        pending = deque()   # (name, path, future, error), in upload order
+        try:
+            pool = get_extraction_pool()
+            entries_left = True
+            while entries_left or pending:
+                while entries_left and len(pending) < EXTRACTION_WORKERS * 2:
+                    entry = next(entries, None)
+                    if entry is None:
+                        entries_left = False
+                        break
+                    name, stream, error = entry
+                    if not error:
+                        try:
+                            path = _spool_to_disk(stream)
+                        except Exception as e:
+                            # e.g. a corrupt archive member
+                            error = str(e)
+                    if error:
+                        print(f"❌ [Extraction] {name}: {error}")
+                        pending.append((name, None, None, error))
+                        continue
+                    # Queued before submitting, so the file is read serially if the pool is broken
+                    pending.append((name, path, None, None))
+                    pending[-1] = (name, path, pool.submit(_extract_in_worker, type(processor), path, name), None)
+                if not pending:
+                    break
+                name, path, future, error = pending.popleft()
+                if future is None:
+                    outcomes.append((name, [], error))
+                    continue
+                try:
+                    outcomes.append((name, future.result(), None))
+                except BrokenProcessPool:
+                    pending.appendleft((name, path, future, error))
+                    raise
+                except Exception as e:
+                    print(f"❌ [Extraction] {name}: {str(e)}")
+                    outcomes.append((name, [], str(e)))
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        except (BrokenProcessPool, OSError) as pool_error:
+            print(f"⚠️ [Extraction] Process pool unavailable ({pool_error}), extracting the remaining files serially")
+            shutdown_extraction_pool()
+            # Files already spooled are read back from disk
+            for name, path, future, error in pending:
+                if path is None:
+                    outcomes.append((name, [], error))
+                    continue
+                with open(path, 'rb') as f:
+                    outcomes.append(extract(name, f))
+        finally:
+            for name, path, future, error in pending:
+                if future is not None:
+                    future.cancel()
+                if path is not None:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+    
+    for name, stream, error in entries:
+        outcomes.append((name, [], error) if error else extract(name, stream))
+    
+    return outcomes
 
 def cleanup_session_state():
     """Clean up old session data"""
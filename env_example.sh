@@ -65,8 +65,73 @@ APP_VERSION=2.0.0
 # Default language for analysis
 DEFAULT_LANGUAGE=en
 
+# Seconds between checks for edited rules/scoring/prompt/KB files.
+# Changes are picked up by every worker without a restart.
+CONFIG_CHECK_INTERVAL=2
+
+# Knowledge base storage: json (qa_knowledge_base.json) or sqlite.
+# The SQLite database is seeded from the JSON file on first start.
+KB_STORAGE=json
+KB_DB_PATH=qa_knowledge_base.db
+
+# Time budget (seconds) for each regex call on uploaded text. When it is hit,
+# the text is rescanned in chunks of REGEX_CHUNK_SIZE characters, each limited
+# to REGEX_CHUNK_BUDGET seconds.
+REGEX_TIME_BUDGET=2.0
+REGEX_CHUNK_SIZE=65536
+REGEX_CHUNK_BUDGET=0.25
+
+# Worker processes for anonymizing multi-chat files in parallel (default: 2 or the CPU
+# count if lower, 1 disables the pool) and the minimum number of chats before the pool
+# is used. Each gunicorn worker has its own pool: keep -w x (ANONYMIZER_WORKERS +
+# EXTRACTION_WORKERS) within the CPU count.
+ANONYMIZER_WORKERS=2
+ANONYMIZER_PARALLEL_MIN_CHATS=8
+
+# Cache of anonymization results, keyed by an HMAC of the original text. Entries hold
+# only anonymized output. Set the size to 0 to disable; without a key, a random one
+# is stored next to the database.
+ANONYMIZATION_CACHE_PATH=anonymization_cache.db
+ANONYMIZATION_CACHE_MAX_BYTES=268435456
+# ANONYMIZATION_CACHE_KEY=change-me
+
+# Server-side store for anonymization results (the session cookie only holds an id)
+# and how long results are kept (seconds)
+RESULT_STORE_DIR=temp_result_store
+RESULT_TTL=21600
+
+# Upload limit (MB) and the size (bytes) above which uploaded files are spooled to disk
+MAX_UPLOAD_MB=256
+UPLOAD_SPOOL_SIZE=1048576
+
+# Worker processes extracting batch upload files in parallel (default: 2 or the CPU
+# count if lower, 1 disables the pool; per gunicorn worker), the minimum number of files before the pool is used and
+# the page range size above which a single PDF is read in parallel.
+# EXTRACTION_WORKERS=4
+EXTRACTION_PARALLEL_MIN_FILES=2
+PDF_PAGES_PER_TASK=100
+
+# CSV uploads are read CSV_CHUNK_ROWS rows at a time. For CRM exports (CSV or XLSX) with one chat
+# per row, name the transcript column(s) and ID column: each row then becomes one
+# chat and no header splitting is done (files without those columns are split as usual).
+CSV_CHUNK_ROWS=10000
+# CSV_TRANSCRIPT_COLUMNS=transcript
+# CSV_ID_COLUMN=case_id
+
+# Batch uploads may be ZIP or tar(.gz) archives of transcript files, read member by
+# member. Limits on the number of members and their uncompressed size (MB):
+ARCHIVE_MAX_MEMBERS=1000
+ARCHIVE_MAX_MEMBER_MB=256
+
+# Batch files larger than one chunk are uploaded in resumable, checksummed chunks
+# (MB), assembled in CHUNKED_UPLOAD_DIR; unfinished uploads expire after the TTL (seconds)
+CHUNKED_UPLOAD_DIR=temp_uploads
+CHUNKED_UPLOAD_CHUNK_MB=8
+CHUNKED_UPLOAD_MAX_MB=2048
+CHUNKED_UPLOAD_TTL=86400
+
 # Supported file extensions (comma-separated)
-ALLOWED_EXTENSIONS=txt,csv,log,docx
+ALLOWED_EXTENSIONS=txt,csv,log,docx,xlsx
 
 # ================ LOGGING CONFIGURATION ================
 # Log level (DEBUG, INFO, WARNING, ERROR, CRITICAL)
@@ -0,0 +1,324 @@
+# kb_storage.py
+"""
+Pluggable storage backends for the knowledge base.
+
+JsonKBStorage keeps the original qa_knowledge_base.json format (now with a
+file lock and atomic replace so concurrent workers no longer clobber each
+other). SQLiteKBStorage stores one row per Q&A pair with a category index, an
+FTS5 full-text index and a change counter that lets every worker detect
+writes made by the others. The JSON file remains the import/export format.
+
+Pick the backend with KB_STORAGE=json|sqlite (and KB_DB_PATH for SQLite).
+"""
+
+import json
+import os
+import sqlite3
+import tempfile
+from abc import ABC, abstractmethod
+from contextlib import closing, contextmanager
+from typing import List, Dict, Any, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# Fields stored in dedicated columns; anything else (examples, related_topics...) goes to 'extra'
+_CORE_FIELDS = ("question", "answer", "category")
+
+
+class KBStorage(ABC):
+    """Interface implemented by knowledge base storage backends"""
+
+    @abstractmethod
+    def load_pairs(self) -> List[Dict[str, Any]]:
+        """Return every Q&A pair in insertion order"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def add_pair(self, qa_pair: Dict[str, Any]) -> Tuple[Any, Any]:
+        """
+        Persist a single new Q&A pair
+
+        Returns:
+            (change counter before the write, change counter after the write)
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def update_pair(self, index: int, qa_pair: Dict[str, Any]):
+        """Replace the Q&A pair at position index (0-based, insertion order)"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_pairs_by_category(self, category: str) -> List[Dict[str, Any]]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def change_counter(self) -> Any:
+        """Cheap token that changes whenever any worker writes to the store"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def replace_all(self, qa_pairs: List[Dict[str, Any]]):
+        """Overwrite the store with qa_pairs"""
+        raise NotImplementedError
+
+    def import_json(self, json_path: str):
+        """Replace the store's contents with a qa_knowledge_base.json style file"""
+        with open(json_path, "r", encoding="utf-8") as f:
+            self.replace_all(json.load(f).get("qa_pairs", []))
+
+    def export_json(self, json_path: str):
+        """Write the store's contents as a qa_knowledge_base.json style file"""
+        _atomic_write_json(json_path, {"qa_pairs": self.load_pairs()})
+
+
+def _atomic_write_json(path: str, data: Dict[str, Any]):
+    """Write JSON to a temp file in the same directory, then rename over path"""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=".kb_", suffix=".json", dir=directory)
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=2, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class JsonKBStorage(KBStorage):
+    """qa_knowledge_base.json on disk, rewritten under an exclusive lock"""
+
+    def __init__(self, kb_file_path: str = "qa_knowledge_base.json"):
+        self.kb_file_path = kb_file_path
+        self.lock_path = f"{kb_file_path}.lock"
+
+    @contextmanager
+    def _locked(self):
+        if fcntl is None:
+            yield
+            return
+        with open(self.lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read(self) -> List[Dict[str, Any]]:
+        if not os.path.exists(self.kb_file_path):
+            return []
+        with open(self.kb_file_path, "r", encoding="utf-8") as f:
+            return json.load(f).get("qa_pairs", [])
+
+    def load_pairs(self) -> List[Dict[str, Any]]:
+        return self._read()
+
+    def add_pair(self, qa_pair: Dict[str, Any]) -> Tuple[Any, Any]:
+        with self._locked():
+            before = self.change_counter()
+            # Re-read under the lock so pairs added by other workers are kept
+            qa_pairs = self._read()
+            qa_pairs.append(qa_pair)
+            _atomic_write_json(self.kb_file_path, {"qa_pairs": qa_pairs})
+            return before, self.change_counter()
+
+    def update_pair(self, index: int, qa_pair: Dict[str, Any]):
+        with self._locked():
+            qa_pairs = self._read()
+            qa_pairs[index] = qa_pair
+            _atomic_write_json(self.kb_file_path, {"qa_pairs": qa_pairs})
+
+    def get_pairs_by_category(self, category: str) -> List[Dict[str, Any]]:
+        return [qa for qa in self._read() if qa.get("category", "General") == category]
+
+    def change_counter(self) -> Any:
+        try:
+            st = os.stat(self.kb_file_path)
+            return (st.st_mtime_ns, st.st_size, st.st_ino)
+        except OSError:
+            return None
+
+    def replace_all(self, qa_pairs: List[Dict[str, Any]]):
+        with self._locked():
+            _atomic_write_json(self.kb_file_path, {"qa_pairs": list(qa_pairs)})
+
+
+class SQLiteKBStorage(KBStorage):
+    """
+    SQLite store: one row per Q&A pair, category index, FTS5 index, change counter
+
+    Every write bumps kb_meta.changes inside the same transaction (via
+    triggers), so change_counter() is a single indexed read.
+    """
+
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS qa_pairs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            question TEXT NOT NULL,
+            answer TEXT NOT NULL,
+            category TEXT NOT NULL DEFAULT 'General',
+            extra TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_qa_pairs_category ON qa_pairs(category);
+
+        CREATE TABLE IF NOT EXISTS kb_meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+        INSERT OR IGNORE INTO kb_meta (key, value) VALUES ('changes', 0);
+
+        CREATE TRIGGER IF NOT EXISTS qa_pairs_count_ai AFTER INSERT ON qa_pairs BEGIN
+            UPDATE kb_meta SET value = value + 1 WHERE key = 'changes';
+        END;
+        CREATE TRIGGER IF NOT EXISTS qa_pairs_count_ad AFTER DELETE ON qa_pairs BEGIN
+            UPDATE kb_meta SET value = value + 1 WHERE key = 'changes';
+        END;
+        CREATE TRIGGER IF NOT EXISTS qa_pairs_count_au AFTER UPDATE ON qa_pairs BEGIN
+            UPDATE kb_meta SET value = value + 1 WHERE key = 'changes';
+        END;
+    """
+
+    _FTS_SCHEMA = """
+        CREATE VIRTUAL TABLE IF NOT EXISTS qa_pairs_fts USING fts5(
+            question, answer, category,
+            content='qa_pairs', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 0'
+        );
+        CREATE TRIGGER IF NOT EXISTS qa_pairs_fts_ai AFTER INSERT ON qa_pairs BEGIN
+            INSERT INTO qa_pairs_fts (rowid, question, answer, category)
+            VALUES (new.id, new.question, new.answer, new.category);
+        END;
+        CREATE TRIGGER IF NOT EXISTS qa_pairs_fts_ad AFTER DELETE ON qa_pairs BEGIN
+            INSERT INTO qa_pairs_fts (qa_pairs_fts, rowid, question, answer, category)
+            VALUES ('delete', old.id, old.question, old.answer, old.category);
+        END;
+        CREATE TRIGGER IF NOT EXISTS qa_pairs_fts_au AFTER UPDATE ON qa_pairs BEGIN
+            INSERT INTO qa_pairs_fts (qa_pairs_fts, rowid, question, answer, category)
+            VALUES ('delete', old.id, old.question, old.answer, old.category);
+            INSERT INTO qa_pairs_fts (rowid, question, answer, category)
+            VALUES (new.id, new.question, new.answer, new.category);
+        END;
+    """
+
+    def __init__(self, db_path: str = "qa_knowledge_base.db", seed_json_path: Optional[str] = None):
+        """
+        Args:
+            db_path: SQLite database file
+            seed_json_path: JSON file imported when the database is empty
+        """
+        self.db_path = db_path
+        self.has_fts = False
+
+        with closing(self._connect()) as conn, conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(self._SCHEMA)
+            try:
+                conn.executescript(self._FTS_SCHEMA)
+                self.has_fts = True
+            except sqlite3.OperationalError as e:
+                print(f"SQLite FTS5 not available, full-text search disabled: {str(e)}")
+            is_empty = conn.execute("SELECT COUNT(*) FROM qa_pairs").fetchone()[0] == 0
+
+        if is_empty and seed_json_path and os.path.exists(seed_json_path):
+            print(f"Importing knowledge base from {seed_json_path} into {db_path}")
+            self.import_json(seed_json_path)
+
+    def _connect(self) -> sqlite3.Connection:
+        # Short-lived connections are cheap and safe across forked workers. Use as
+        # `with closing(self._connect()) as conn, conn:` - the connection's own context
+        # manager only commits or rolls back, it does not close.
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    @staticmethod
+    def _row_to_pair(row: sqlite3.Row) -> Dict[str, Any]:
+        qa_pair = json.loads(row["extra"]) if row["extra"] else {}
+        qa_pair.update(question=row["question"], answer=row["answer"], category=row["category"])
+        return qa_pair
+
+    @staticmethod
+    def _pair_to_row(qa_pair: Dict[str, Any]) -> Tuple[str, str, str, Optional[str]]:
+        extra = {k: v for k, v in qa_pair.items() if k not in _CORE_FIELDS}
+        return (
+            qa_pair.get("question", ""),
+            qa_pair.get("answer", ""),
+            qa_pair.get("category", "General"),
+            json.dumps(extra, ensure_ascii=False) if extra else None
+        )
+
+    @staticmethod
+    def _read_counter(conn: sqlite3.Connection) -> int:
+        return conn.execute("SELECT value FROM kb_meta WHERE key = 'changes'").fetchone()[0]
+
+    def load_pairs(self) -> List[Dict[str, Any]]:
+        with closing(self._connect()) as conn, conn:
+            rows = conn.execute("SELECT * FROM qa_pairs ORDER BY id").fetchall()
+        return [self._row_to_pair(row) for row in rows]
+
+    def add_pair(self, qa_pair: Dict[str, Any]) -> Tuple[Any, Any]:
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            before = self._read_counter(conn)
+            conn.execute("INSERT INTO qa_pairs (question, answer, category, extra) VALUES (?, ?, ?, ?)",
+                         self._pair_to_row(qa_pair))
+            after = self._read_counter(conn)
+            conn.commit()
+            return before, after
+        finally:
+            conn.close()
+
+    def update_pair(self, index: int, qa_pair: Dict[str, Any]):
+        with closing(self._connect()) as conn, conn:
+            row = conn.execute("SELECT id FROM qa_pairs ORDER BY id LIMIT 1 OFFSET ?", (index,)).fetchone()
+            if row is None:
+                raise IndexError(f"No Q&A pair at position {index}")
+            conn.execute("UPDATE qa_pairs SET question = ?, answer = ?, category = ?, extra = ? WHERE id = ?",
+                         self._pair_to_row(qa_pair) + (row["id"],))
+
+    def get_pairs_by_category(self, category: str) -> List[Dict[str, Any]]:
+        with closing(self._connect()) as conn, conn:
+            rows = conn.execute("SELECT * FROM qa_pairs WHERE category = ? ORDER BY id", (category,)).fetchall()
+        return [self._row_to_pair(row) for row in rows]
+
+    def change_counter(self) -> Any:
+        with closing(self._connect()) as conn, conn:
+            return self._read_counter(conn)
+
+    def replace_all(self, qa_pairs: List[Dict[str, Any]]):
+        with closing(self._connect()) as conn, conn:
+            conn.execute("DELETE FROM qa_pairs")
+            conn.executemany("INSERT INTO qa_pairs (question, answer, category, extra) VALUES (?, ?, ?, ?)",
+                             [self._pair_to_row(qa_pair) for qa_pair in qa_pairs])
+
+    def search_text(self, query: str, limit: int = 10) -> List[Dict[str, Any]]:
+        """Ad-hoc FTS5 search (bm25 ranked); returns [] if FTS5 is unavailable"""
+        terms = [term.replace('"', '') for term in query.split()]
+        terms = [f'"{term}"' for term in terms if term]
+        if not self.has_fts or not terms:
+            return []
+        with closing(self._connect()) as conn, conn:
+            rows = conn.execute(
+                "SELECT qa_pairs.* FROM qa_pairs_fts JOIN qa_pairs ON qa_pairs.id = qa_pairs_fts.rowid "
+                "WHERE qa_pairs_fts MATCH ? ORDER BY bm25(qa_pairs_fts, 2.0, 1.0, 0.5) LIMIT ?",
+                (" OR ".join(terms), limit)
+            ).fetchall()
+        return [self._row_to_pair(row) for row in rows]
+
+
+def create_storage(kb_file_path: str = "qa_knowledge_base.json") -> KBStorage:
+    """
+    Build the storage backend selected by the KB_STORAGE environment variable
+
+    json (default): kb_file_path itself
+    sqlite: KB_DB_PATH (default: kb_file_path with a .db extension), seeded from kb_file_path
+    """
+    backend = os.environ.get("KB_STORAGE", "json").lower()
+    if backend == "sqlite":
+        db_path = os.environ.get("KB_DB_PATH") or os.path.splitext(kb_file_path)[0] + ".db"
+        return SQLiteKBStorage(db_path, seed_json_path=kb_file_path)
+    if backend != "json":
+        print(f"Unknown KB_STORAGE '{backend}', using json")
+    return JsonKBStorage(kb_file_path)
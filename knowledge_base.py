@@ -1,30 +1,385 @@
 # knowledge_base.py
+import hashlib
+import heapq
 import json
+import math
 import re
 import os
-from typing import List, Dict, Any, Optional
+import unicodedata
+from collections import Counter
+from typing import List, Dict, Any, Optional, Tuple
+
+from kb_storage import KBStorage, create_storage
+
+# Optional: vectorized BM25F scoring for batch queries, TF-IDF similarity for duplicate reports
+try:
+    import numpy as np
+    from scipy import sparse
+except ImportError:
+    np = None
+    sparse = None
+
+# Scripts written without spaces between words (Thai, Lao, Khmer, Myanmar, CJK, Kana)
+# are indexed as overlapping character bigrams; everything else as \w+ words.
+_NO_SPACE_SCRIPT = r'\u0e00-\u0eff\u1000-\u109f\u1780-\u17ff\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff'
+_TOKEN_REGEX = re.compile(rf'[{_NO_SPACE_SCRIPT}]+|[^\W_]+')
+_NO_SPACE_REGEX = re.compile(rf'[{_NO_SPACE_SCRIPT}]')
+
+# BM25 parameters and per-field boosts (question > answer > category)
+BM25_K1 = 1.2
+BM25_B = 0.75
+FIELD_BOOSTS = {'question': 2.0, 'answer': 1.0, 'category': 0.5}
+_FIELDS = tuple(FIELD_BOOSTS)
+
+# Terms found in more than ~37% of entries (idf < 1) behave like stop words. Queries with more
+# than LONG_QUERY_TERMS known terms (a chat's customer text) skip them to stay fast, unless no
+# other term is left; short queries keep every term, so small KBs and focused KBs still match.
+MIN_TERM_IDF = 1.0
+LONG_QUERY_TERMS = 16
+
+# Where precomputed TF-IDF matrices are cached, keyed by KB content hash
+KB_VECTOR_CACHE_DIR = os.environ.get('KB_VECTOR_CACHE_DIR', '.kb_cache')
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Multilingual tokenizer used by the search index
+
+    Lowercases and NFKC-normalizes the text, splits on word characters and
+    turns runs of space-less scripts into character bigrams.
+    """
+    if not text:
+        return []
+    text = unicodedata.normalize('NFKC', text).casefold()
+    tokens = []
+    for run in _TOKEN_REGEX.findall(text):
+        if _NO_SPACE_REGEX.match(run):
+            if len(run) == 1:
+                tokens.append(run)
+            else:
+                tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+        else:
+            tokens.append(run)
+    return tokens
+
+
+class TfidfMatrix:
+    """
+    Sparse TF-IDF matrix over the knowledge base (one L2-normalized row per Q&A pair)
+
+    Uses the same tokenizer and field boosts as the BM25 index, so a row is the
+    boosted, sublinear term frequency of question + answer + category.
+    """
+
+    def __init__(self, vocabulary: Dict[str, int], idf, matrix):
+        self.vocabulary = vocabulary
+        self.idf = idf
+        self.matrix = matrix
+
+    @staticmethod
+    def _weighted_counts(qa_pair: Dict[str, Any]) -> Dict[str, float]:
+        counts: Dict[str, float] = {}
+        for field, boost in FIELD_BOOSTS.items():
+            for term in tokenize(qa_pair.get(field, "")):
+                counts[term] = counts.get(term, 0.0) + boost
+        return counts
+
+    @classmethod
+    def build(cls, qa_pairs: List[Dict[str, Any]]) -> "TfidfMatrix":
+        vocabulary: Dict[str, int] = {}
+        rows, cols, values = [], [], []
+        for row, qa_pair in enumerate(qa_pairs):
+            for term, count in cls._weighted_counts(qa_pair).items():
+                rows.append(row)
+                cols.append(vocabulary.setdefault(term, len(vocabulary)))
+                values.append(1.0 + math.log(count) if count >= 1 else count)
+
+        shape = (len(qa_pairs), max(len(vocabulary), 1))
+        tf = sparse.csr_matrix((values, (rows, cols)), shape=shape, dtype=np.float64)
+        df = np.bincount(tf.indices, minlength=shape[1])
+        idf = np.log((1.0 + shape[0]) / (1.0 + df)) + 1.0
+        return cls(vocabulary, idf, cls._normalize(tf @ sparse.diags(idf)))
+
+    @staticmethod
+    def _normalize(matrix):
+        norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+        norms[norms == 0] = 1.0
+        return sparse.csr_matrix(sparse.diags(1.0 / norms) @ matrix)
+
+    def transform(self, texts: List[str]):
+        """Vectorize query texts into the KB's term space (unknown terms are dropped)"""
+        rows, cols, values = [], [], []
+        for row, text in enumerate(texts):
+            for term, count in Counter(tokenize(text)).items():
+                col = self.vocabulary.get(term)
+                if col is not None:
+                    rows.append(row)
+                    cols.append(col)
+                    values.append((1.0 + math.log(count)) * self.idf[col])
+        queries = sparse.csr_matrix((values, (rows, cols)), shape=(len(texts), self.matrix.shape[1]))
+        return self._normalize(queries)
+
+    def save(self, path: str):
+        terms = np.array(sorted(self.vocabulary, key=self.vocabulary.get))
+        np.savez_compressed(path, data=self.matrix.data, indices=self.matrix.indices,
+                            indptr=self.matrix.indptr, shape=np.array(self.matrix.shape),
+                            idf=self.idf, terms=terms)
+
+    @classmethod
+    def load(cls, path: str) -> "TfidfMatrix":
+        with np.load(path, allow_pickle=False) as data:
+            matrix = sparse.csr_matrix((data['data'], data['indices'], data['indptr']),
+                                       shape=tuple(data['shape']))
+            vocabulary = {term: i for i, term in enumerate(data['terms'].tolist())}
+            return cls(vocabulary, data['idf'], matrix)
+
 
 class KnowledgeBase:
     """Knowledge Base for the QA Engine"""
     
-    def __init__(self, kb_file_path="qa_knowledge_base.json"):
-        """Initialize Knowledge Base with path to JSON file"""
+    def __init__(self, kb_file_path="qa_knowledge_base.json", storage: Optional[KBStorage] = None):
+        """
+        Initialize Knowledge Base
+
+        Args:
+            kb_file_path: JSON knowledge base file (also the seed for the SQLite backend)
+            storage: Storage backend; defaults to the one selected by KB_STORAGE
+        """
         self.kb_file_path = kb_file_path
+        self.storage = storage if storage is not None else create_storage(kb_file_path)
+        self._seen_changes = self.storage.change_counter()
+        self.qa_pairs = self._load_kb()
+        self._build_index()
+        self._tfidf = self._load_tfidf() if np is not None else None
+
+    def refreshed(self) -> "KnowledgeBase":
+        """
+        This knowledge base, or a new one if another worker wrote to the storage since it was read
+
+        A knowledge base held by a ConfigSnapshot is shared by concurrent requests, so
+        it is never rebuilt in place: the caller swaps the returned instance in instead.
+        """
+        if self.storage.change_counter() == self._seen_changes:
+            return self
+        return KnowledgeBase(self.kb_file_path, storage=self.storage)
+
+    def _reload(self):
+        """Re-read the storage into this instance (only for instances that are not shared)"""
+        self._seen_changes = self.storage.change_counter()
         self.qa_pairs = self._load_kb()
+        self._build_index()
+        self._tfidf = self._load_tfidf() if np is not None else None
+
+    def _build_index(self):
+        """Build the inverted index over all loaded Q&A pairs"""
+        # term -> {doc_id: (tf_question, tf_answer, tf_category)}
+        self._postings: Dict[str, Dict[int, Tuple[int, int, int]]] = {}
+        # doc_id -> (len_question, len_answer, len_category)
+        self._doc_lengths: List[Tuple[int, int, int]] = []
+        self._total_lengths = [0, 0, 0]
+        # category -> doc_ids in insertion order
+        self._category_index: Dict[str, List[int]] = {}
+        # term -> ({doc_id: saturated BM25F weight}, max weight), valid until the next insert
+        self._impact_cache: Dict[str, Tuple[Dict[int, float], float]] = {}
+        # (term -> column, docs x terms sparse matrix of the same weights), built on first batch query
+        self._bm25_matrix = None
+        for qa_pair in self.qa_pairs.get("qa_pairs", []):
+            self._index_pair(qa_pair)
+
+    def _index_pair(self, qa_pair: Dict[str, Any]):
+        """Add one Q&A pair to the inverted index (doc id = position in qa_pairs)"""
+        doc_id = len(self._doc_lengths)
+        field_counts = [Counter(tokenize(qa_pair.get(field, ""))) for field in _FIELDS]
+        lengths = tuple(sum(counts.values()) for counts in field_counts)
+
+        self._doc_lengths.append(lengths)
+        self._category_index.setdefault(qa_pair.get("category", "General"), []).append(doc_id)
+        for i, length in enumerate(lengths):
+            self._total_lengths[i] += length
+
+        for term in set().union(*field_counts):
+            self._postings.setdefault(term, {})[doc_id] = tuple(counts[term] for counts in field_counts)
+
+        # Average field lengths changed, so cached impacts and both matrices are stale
+        self._impact_cache.clear()
+        self._bm25_matrix = None
+        self._tfidf = None
+
+    def _term_impacts(self, term: str) -> Tuple[Dict[int, float], float]:
+        """Per-document BM25F weight of a term (without idf) and its maximum, cached per term"""
+        cached = self._impact_cache.get(term)
+        if cached is None:
+            doc_count = len(self._doc_lengths)
+            avg_lengths = [max(total / doc_count, 1e-9) for total in self._total_lengths]
+            boosts = [FIELD_BOOSTS[field] for field in _FIELDS]
+            impacts = {}
+            for doc_id, tfs in self._postings[term].items():
+                lengths = self._doc_lengths[doc_id]
+                weighted_tf = 0.0
+                for i in range(3):
+                    if tfs[i]:
+                        norm = 1 - BM25_B + BM25_B * lengths[i] / avg_lengths[i]
+                        weighted_tf += boosts[i] * tfs[i] / norm
+                impacts[doc_id] = weighted_tf * (BM25_K1 + 1) / (BM25_K1 + weighted_tf)
+            cached = (impacts, max(impacts.values()))
+            self._impact_cache[term] = cached
+        return cached
         
     def _load_kb(self) -> Dict[str, List]:
-        """Load knowledge base from JSON file"""
+        """Load knowledge base from the storage backend"""
         try:
-            if os.path.exists(self.kb_file_path):
-                with open(self.kb_file_path, "r", encoding="utf-8") as f:
-                    return json.load(f)
-            else:
-                # Create empty knowledge base if file doesn't exist
-                return {"qa_pairs": []}
+            return {"qa_pairs": self.storage.load_pairs()}
         except Exception as e:
             print(f"Error loading knowledge base: {str(e)}")
             return {"qa_pairs": []}
     
+    def content_hash(self) -> str:
+        """Stable hash of the KB contents (used to key on-disk caches)"""
+        payload = json.dumps(self.qa_pairs.get("qa_pairs", []), sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+    def _load_tfidf(self) -> Optional[TfidfMatrix]:
+        """Load the TF-IDF matrix from the disk cache, building and caching it on a miss"""
+        all_pairs = self.qa_pairs.get("qa_pairs", [])
+        if not all_pairs:
+            return None
+
+        cache_path = os.path.join(KB_VECTOR_CACHE_DIR, f"kb_tfidf_{self.content_hash()}.npz")
+        if os.path.exists(cache_path):
+            try:
+                return TfidfMatrix.load(cache_path)
+            except Exception as e:
+                print(f"Error loading cached KB vectors, rebuilding: {str(e)}")
+
+        tfidf = TfidfMatrix.build(all_pairs)
+        try:
+            os.makedirs(KB_VECTOR_CACHE_DIR, exist_ok=True)
+            tmp_path = f"{cache_path}.{os.getpid()}.tmp.npz"
+            tfidf.save(tmp_path)
+            os.replace(tmp_path, cache_path)
+            self._prune_vector_cache(keep=cache_path)
+        except Exception as e:
+            print(f"Error caching KB vectors: {str(e)}")
+        return tfidf
+
+    @staticmethod
+    def _prune_vector_cache(keep: str):
+        """Remove cached matrices of earlier KB contents (a worker still on one rebuilds it on demand)"""
+        for name in os.listdir(KB_VECTOR_CACHE_DIR):
+            path = os.path.join(KB_VECTOR_CACHE_DIR, name)
+            if (name.startswith("kb_tfidf_") and name.endswith(".npz") and not name.endswith(".tmp.npz")
+                    and path != keep):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def _bm25_weights(self):
+        """(term -> column, docs x terms matrix of saturated BM25F weights), the impacts of _term_impacts()"""
+        if self._bm25_matrix is None:
+            columns: Dict[str, int] = {}
+            rows, cols, values = [], [], []
+            for term in self._postings:
+                column = columns.setdefault(term, len(columns))
+                for doc_id, impact in self._term_impacts(term)[0].items():
+                    rows.append(doc_id)
+                    cols.append(column)
+                    values.append(impact)
+            shape = (len(self._doc_lengths), max(len(columns), 1))
+            self._bm25_matrix = (columns, sparse.csr_matrix((values, (rows, cols)), shape=shape, dtype=np.float64))
+        return self._bm25_matrix
+
+    def search_many(self, queries: List[str], top_k: int = 3) -> List[List[Dict[str, Any]]]:
+        """
+        Match many queries against the knowledge base at once
+
+        Same BM25F ranking as search() (same query terms, weights and tie order),
+        with every score computed in a single sparse matrix product against the
+        precomputed weight matrix. Falls back to one search() per query when
+        numpy/scipy are not installed.
+
+        Args:
+            queries: Query texts (e.g. the customer messages of each chat)
+            top_k: Number of results per query
+
+        Returns:
+            One list of matching QA pairs per query, best match first
+        """
+        if np is None:
+            return [self.search(query, top_k) for query in queries]
+        if not self._doc_lengths or not queries or top_k <= 0:
+            return [[] for _ in queries]
+
+        columns, weights = self._bm25_weights()
+        rows, cols, values = [], [], []
+        for row, query in enumerate(queries):
+            for idf, term in self._query_terms(query):
+                rows.append(row)
+                cols.append(columns[term])
+                values.append(idf)
+        query_matrix = sparse.csr_matrix((values, (rows, cols)), shape=(len(queries), weights.shape[1]))
+        scores = sparse.csr_matrix(query_matrix @ weights.T)
+
+        all_pairs = self.qa_pairs.get("qa_pairs", [])
+        results = []
+        for row in range(scores.shape[0]):
+            start, end = scores.indptr[row], scores.indptr[row + 1]
+            values = scores.data[start:end]
+            doc_ids = scores.indices[start:end]
+            # Highest score first, ties by position in the KB (as in search())
+            best = np.lexsort((doc_ids, -values))[:top_k]
+            results.append([all_pairs[doc_ids[i]] for i in best if values[i] > 0])
+        return results
+
+    def near_duplicate_report(self, threshold: float = 0.85) -> List[Dict[str, Any]]:
+        """
+        Find pairs of KB entries whose TF-IDF cosine similarity is at least threshold
+
+        Returns:
+            List of duplicate candidates, most similar first
+        """
+        if np is None:
+            raise ImportError("numpy and scipy are required for the near-duplicate report. Install with: pip install numpy scipy")
+        if self._tfidf is None:
+            self._tfidf = self._load_tfidf()
+        if self._tfidf is None:
+            return []
+
+        all_pairs = self.qa_pairs.get("qa_pairs", [])
+        matrix = self._tfidf.matrix
+        similarities = sparse.triu(matrix @ matrix.T, k=1).tocoo()
+        keep = similarities.data >= threshold
+
+        report = []
+        for i, j, score in zip(similarities.row[keep], similarities.col[keep], similarities.data[keep]):
+            report.append({
+                "index_a": int(i),
+                "index_b": int(j),
+                "question_a": all_pairs[i].get("question", ""),
+                "question_b": all_pairs[j].get("question", ""),
+                "category_a": all_pairs[i].get("category", "General"),
+                "category_b": all_pairs[j].get("category", "General"),
+                "similarity": round(float(score), 4)
+            })
+        report.sort(key=lambda entry: entry["similarity"], reverse=True)
+        return report
+
+    def _query_terms(self, query: str) -> List[Tuple[float, str]]:
+        """(idf, term) of every indexed query term, without common terms in long queries"""
+        doc_count = len(self._doc_lengths)
+        query_terms = []
+        for term in set(tokenize(query)):
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            df = len(postings)
+            query_terms.append((math.log(1 + (doc_count - df + 0.5) / (df + 0.5)), term))
+        if len(query_terms) > LONG_QUERY_TERMS:
+            selective_terms = [(idf, term) for idf, term in query_terms if idf >= MIN_TERM_IDF]
+            if selective_terms:
+                query_terms = selective_terms
+        return query_terms
+
     def search(self, query: str, top_k: int = 3) -> List[Dict[str, Any]]:
         """
         Search knowledge base for relevant Q&A pairs
@@ -36,34 +391,46 @@ class KnowledgeBase:
         Returns:
             List of matching QA pairs
         """
-        # Simple keyword matching
-        matches = []
-        query_terms = re.sub(r'[^\w\s]', '', query.lower()).split()
-        
-        for qa_pair in self.qa_pairs.get("qa_pairs", []):
-            score = 0
-            q_text = qa_pair.get("question", "").lower()
-            a_text = qa_pair.get("answer", "").lower()
-            category = qa_pair.get("category", "").lower()
-            
-            # Count matching terms in question (higher weight)
-            for term in query_terms:
-                if term in q_text:
-                    score += 2  # Higher weight for question matches
-                elif term in a_text:
-                    score += 1  # Lower weight for answer matches
-                elif term in category:
-                    score += 0.5  # Even lower weight for category matches
-            
-            if score > 0:
-                matches.append({
-                    "qa_pair": qa_pair,
-                    "score": score
-                })
-        
-        # Sort by score and return top_k results
-        matches.sort(key=lambda x: x["score"], reverse=True)
-        return [m["qa_pair"] for m in matches[:top_k]]
+        all_pairs = self.qa_pairs.get("qa_pairs", [])
+        doc_count = len(self._doc_lengths)
+        if not doc_count or top_k <= 0:
+            return []
+
+        # BM25F: per-field length normalization, boosted and summed before saturation
+        query_terms = self._query_terms(query)
+
+        # MaxScore-style evaluation: highest-bound terms first; once the remaining terms
+        # can no longer lift an unseen document into the top-k, only existing candidates
+        # are updated
+        bounded_terms = []
+        for idf, term in query_terms:
+            impacts, max_impact = self._term_impacts(term)
+            bounded_terms.append((idf * max_impact, idf, impacts))
+        bounded_terms.sort(key=lambda item: item[0], reverse=True)
+        remaining_bound = sum(bound for bound, _, _ in bounded_terms)
+        scores: Dict[int, float] = {}
+
+        for bound, idf, impacts in bounded_terms:
+            # Clamped: rounding drift below zero would prune the k-th candidate itself
+            remaining_bound = max(remaining_bound - bound, 0.0)
+            threshold = heapq.nlargest(top_k, scores.values())[-1] if len(scores) >= top_k else None
+
+            if threshold is not None and bound + remaining_bound < threshold:
+                # Drop candidates that can no longer reach the top-k, update the rest
+                for doc_id in list(scores):
+                    score = scores[doc_id] + idf * impacts.get(doc_id, 0.0)
+                    if score + remaining_bound < threshold:
+                        del scores[doc_id]
+                    else:
+                        scores[doc_id] = score
+            else:
+                get_score = scores.get
+                for doc_id, impact in impacts.items():
+                    scores[doc_id] = get_score(doc_id, 0.0) + idf * impact
+
+        # Heap-based top-k instead of sorting every match; ties go to the earlier entry
+        best = heapq.nlargest(top_k, scores.items(), key=lambda item: (item[1], -item[0]))
+        return [all_pairs[doc_id] for doc_id, _ in best]
     
     def add_qa_pair(self, question: str, answer: str, category: str = "general"):
         """
@@ -77,31 +444,99 @@ class KnowledgeBase:
         if "qa_pairs" not in self.qa_pairs:
             self.qa_pairs["qa_pairs"] = []
             
-        self.qa_pairs["qa_pairs"].append({
+        qa_pair = {
             "question": question,
             "answer": answer,
             "category": category
-        })
-        
-        # Save to file
-        self._save_kb()
+        }
+
+        # Single-row write; the storage keeps pairs added by other workers
+        try:
+            before, after = self.storage.add_pair(qa_pair)
+        except Exception as e:
+            print(f"Error saving knowledge base: {str(e)}")
+            return
+
+        if before == self._seen_changes:
+            # Nobody else wrote in between: extend the index incrementally
+            self.qa_pairs["qa_pairs"].append(qa_pair)
+            self._index_pair(qa_pair)
+            self._seen_changes = after
+        else:
+            self._reload()
     
     def _save_kb(self):
-        """Save knowledge base to JSON file"""
+        """Overwrite the storage with the in-memory knowledge base"""
         try:
-            with open(self.kb_file_path, "w", encoding="utf-8") as f:
-                json.dump(self.qa_pairs, f, indent=2, ensure_ascii=False)
+            self.storage.replace_all(self.qa_pairs.get("qa_pairs", []))
+            self._seen_changes = self.storage.change_counter()
         except Exception as e:
             print(f"Error saving knowledge base: {str(e)}")
+
+    def export_json(self, json_path: Optional[str] = None):
+        """Export the knowledge base in the qa_knowledge_base.json format"""
+        self.storage.export_json(json_path or self.kb_file_path)
             
     def get_all_categories(self):
         """Get all unique categories in the knowledge base"""
-        categories = set()
-        for qa_pair in self.qa_pairs.get("qa_pairs", []):
-            categories.add(qa_pair.get("category", "General"))
-        return sorted(list(categories))
+        return sorted(self._category_index)
     
     def get_qa_pairs_by_category(self, category):
         """Get all Q&A pairs for a specific category"""
-        return [qa for qa in self.qa_pairs.get("qa_pairs", []) 
-                if qa.get("category", "General") == category]
\ No newline at end of file
+        all_pairs = self.qa_pairs.get("qa_pairs", [])
+        return [all_pairs[doc_id] for doc_id in self._category_index.get(category, [])]
+
+    def _matching_doc_ids(self, query: str) -> set:
+        """
+        Documents containing every query term (the last term also matches as a prefix,
+        so results follow the user while they type)
+        """
+        terms = tokenize(query)
+        if not terms:
+            return set(range(len(self._doc_lengths)))
+
+        *full_terms, last_term = terms
+        prefix_docs = set()
+        for term, postings in self._postings.items():
+            if term.startswith(last_term):
+                prefix_docs.update(postings)
+
+        matches = prefix_docs
+        for term in full_terms:
+            matches = matches.intersection(self._postings.get(term, ()))
+            if not matches:
+                break
+        return matches
+
+    def browse(self, offset: int = 0, limit: int = 50, query: Optional[str] = None,
+               category: Optional[str] = None) -> Dict[str, Any]:
+        """
+        One page of Q&A pairs, optionally filtered by category and search text
+        
+        Args:
+            offset: Index of the first entry to return
+            limit: Maximum number of entries to return
+            query: Search text (all terms must appear in the question, answer or category)
+            category: Only return entries of this category
+            
+        Returns:
+            Dict with total (matching entries), offset, limit and entries (each with its id)
+        """
+        all_pairs = self.qa_pairs.get("qa_pairs", [])
+        if category:
+            doc_ids = self._category_index.get(category, [])
+        else:
+            doc_ids = range(len(all_pairs))
+
+        if query and query.strip():
+            matches = self._matching_doc_ids(query)
+            doc_ids = [doc_id for doc_id in doc_ids if doc_id in matches]
+
+        offset = max(offset, 0)
+        page = doc_ids[offset:offset + max(limit, 0)]
+        return {
+            "total": len(doc_ids),
+            "offset": offset,
+            "limit": limit,
+            "entries": [dict(all_pairs[doc_id], id=doc_id) for doc_id in page]
+        }
\ No newline at end of file
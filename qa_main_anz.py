@@ -1,7 +1,8 @@
-from flask import Flask, render_template, request, redirect, url_for, session, jsonify, flash, Response, make_response
+from flask import Flask, Request, render_template, request, redirect, url_for, session, jsonify, flash, Response, make_response, send_file
 import os
 import tempfile
 import json
+from werkzeug.datastructures import FileStorage
 from werkzeug.utils import secure_filename
 import time
 from datetime import datetime
@@ -10,7 +11,7 @@ import uuid
 from pathlib import Path
 
 # Import your existing modules
-from knowledge_base import KnowledgeBase
+from config_registry import ConfigRegistry
 
 # UPDATED: Import the new anonymization-enabled modules instead of originals
 try:
@@ -30,10 +31,26 @@ except ImportError as e:
 
 import utils
 from utils import detect_language_smart
-from chat_anonymizer import ChatAnonymizer
+from chat_anonymizer import ChatAnonymizer, STREAM_READ_SIZE
+from result_store import ResultStore
+from chunked_upload import UploadStore, UploadError
+import regex_guard
+import anonymization_cache
+
+# Uploads above this size (bytes) are spooled to a temporary file instead of memory
+UPLOAD_SPOOL_SIZE = int(os.environ.get('UPLOAD_SPOOL_SIZE', str(1024 * 1024)))
+# Largest request accepted; uploads are streamed, so this is bounded by disk, not RAM
+MAX_UPLOAD_MB = int(os.environ.get('MAX_UPLOAD_MB', '256'))
+
+class SpooledUploadRequest(Request):
+    """Request whose uploaded files are SpooledTemporaryFiles (memory up to UPLOAD_SPOOL_SIZE, then disk)"""
+    
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_SIZE, mode='rb+')
 
 # Initialize Flask app
 app = Flask(__name__)
+app.request_class = SpooledUploadRequest
 app.secret_key = os.environ.get('FLASK_SECRET_KEY', 'bulletproof-dev-key')
 
 app.config['JSON_AS_ASCII'] = False
@@ -42,13 +59,21 @@ app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 0
 # Set up upload folder for temporary files
 UPLOAD_FOLDER = tempfile.mkdtemp()
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max upload
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_MB * 1024 * 1024
 
-# Initialize Knowledge Base
-kb = KnowledgeBase("qa_knowledge_base.json")
+# Versioned configuration (rules, scoring, prompt, knowledge base).
+# Each worker re-stats the files cheaply and swaps in a new snapshot when they change,
+# so edits take effect without restarting gunicorn.
+config_registry = ConfigRegistry(
+    rules_path="evaluation_rules.json",
+    scoring_path="scoring_system.json",
+    prompt_path="QA_prompt.md",
+    kb_path="qa_knowledge_base.json"
+)
 
-# Load evaluation rules
-chat_rules = utils.load_evaluation_rules("evaluation_rules.json", "scoring_system.json")
+# Knowledge base browser page sizes
+KB_PAGE_SIZE = 25
+KB_MAX_PAGE_SIZE = 200
 
 # ================ BULLETPROOF FILE STORAGE SYSTEM ================
 RESULTS_DIR = Path("temp_results")
@@ -88,6 +113,35 @@ def load_results_simple(filename):
         print(f"❌ Error loading results: {e}")
         return None
 
+# Anonymization results are kept server-side; the session only holds their id
+result_store = ResultStore()
+
+def remember_anonymization(result):
+    """Store an anonymization result for download and keep only its id in the session"""
+    result_store.delete(session.get('last_anonymization_id'))
+    # Sessions from before the result store carried the whole result
+    session.pop('last_anonymization', None)
+    session['last_anonymization_id'] = result_store.save(
+        result, 'anonymization', sidecars={'txt': result.get('anonymized_transcript', '')}
+    )
+    session['last_anonymization_chats'] = result.get('chat_count', 1)
+
+def forget_anonymization():
+    """Drop the stored anonymization result of this session"""
+    result_store.delete(session.pop('last_anonymization_id', None))
+    session.pop('last_anonymization_chats', None)
+    session.pop('last_anonymization', None)
+
+# Large exports are uploaded in resumable chunks (see chunked_upload.py) and
+# then referenced by id from the batch analysis form
+upload_store = UploadStore()
+
+def upload_owner():
+    """Token that this session's chunked uploads are bound to"""
+    if 'upload_owner' not in session:
+        session['upload_owner'] = uuid.uuid4().hex
+    return session['upload_owner']
+
 # Global variables for current results
 current_batch_file = None
 current_single_file = None
@@ -126,6 +180,7 @@ def login():
 
 @app.route('/logout')
 def logout():
+    forget_anonymization()
     session.clear()
     return redirect(url_for('login'))
 
@@ -135,6 +190,56 @@ def index():
     return render_template('index.html')
 
 # ================ ANONYMIZATION ROUTES (Keep existing for manual use) ================
+# Streamed anonymization output is kept in memory up to this size, then spooled to disk
+ANONYMIZATION_SPOOL_SIZE = 1024 * 1024
+
+def stream_anonymized_upload(upload, anonymizer):
+    """
+    Anonymize an uploaded export chat by chat into a spooled file and stream it back
+    
+    The upload is read and decoded incrementally, and only a summary report is kept,
+    so memory stays flat however large the export is. Counts are returned in
+    X-Anonymization-* headers.
+    """
+    output = tempfile.SpooledTemporaryFile(max_size=ANONYMIZATION_SPOOL_SIZE, mode='w+', encoding='utf-8')
+    try:
+        summary = anonymizer.anonymize_binary_stream(upload.stream, output)
+    except Exception:
+        output.close()
+        raise
+    
+    if 'error' in summary:
+        output.close()
+        flash(f'Error: {summary["error"]}')
+        return render_template('anonymization.html')
+    
+    # The previous stored result no longer matches what the user just anonymized
+    forget_anonymization()
+    
+    replacements = summary['anonymization_report']['total_replacements']
+    print(f"✅ Streamed anonymized file: {replacements} replacements across {summary['chat_count']} chat(s)")
+    
+    output.seek(0)
+    
+    def generate():
+        try:
+            while True:
+                text = output.read(STREAM_READ_SIZE)
+                if not text:
+                    break
+                yield text.encode('utf-8')
+        finally:
+            output.close()
+    
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    filename = f'anonymized_chats_{summary["chat_count"]}_{timestamp}.txt'
+    response = Response(generate(), mimetype='text/plain')
+    response.headers['Content-Type'] = 'text/plain; charset=utf-8'
+    response.headers['Content-Disposition'] = f'attachment; filename={filename}'
+    response.headers['X-Anonymization-Chats'] = str(summary['chat_count'])
+    response.headers['X-Anonymization-Replacements'] = str(replacements)
+    return response
+
 @app.route('/anonymization', methods=['GET', 'POST'])
 def anonymization():
     """Chat anonymization tab - remove sensitive information locally"""
@@ -167,8 +272,8 @@ def anonymization():
                 
                 anonymization_summary = anonymizer.get_anonymization_summary(result)
                 
-                # Store in session for download
-                session['last_anonymization'] = result
+                # Store server-side for download
+                remember_anonymization(result)
                 
                 replacements = result.get('anonymization_report', {}).get('total_replacements', 0)
                 chat_count = result.get('chat_count', 1)
@@ -189,8 +294,11 @@ def anonymization():
                         file.seek(0)  # Reset to beginning
                         print(f"File size: {file_size} bytes")
                         
-                        if file_size > 10 * 1024 * 1024:  # 10MB limit for documents
-                            flash('Error: File too large. Maximum size is 10MB.')
+                        # Streaming mode: anonymize chat by chat straight into a download
+                        stream_output = request.form.get('stream_output') == '1'
+                        
+                        if file_size > 10 * 1024 * 1024 and not stream_output:  # 10MB limit for documents
+                            flash('Error: File too large. Maximum size is 10MB (use streaming mode for larger text exports).')
                             return render_template('anonymization.html')
                         
                         if file_size == 0:
@@ -201,6 +309,12 @@ def anonymization():
                         file_extension = file.filename.lower().split('.')[-1] if '.' in file.filename else ''
                         print(f"File extension: {file_extension}")
                         
+                        if stream_output:
+                            if file_extension not in ['txt', 'csv', 'log', '']:
+                                flash(f'Error: Streaming mode supports .txt, .csv and .log files, not ".{file_extension}".')
+                                return render_template('anonymization.html')
+                            return stream_anonymized_upload(file, anonymizer)
+                        
                         # Extract text based on file type
                         file_content = None
                         
@@ -271,8 +385,8 @@ def anonymization():
                         
                         anonymization_summary = anonymizer.get_anonymization_summary(result)
                         
-                        # Store in session for download
-                        session['last_anonymization'] = result
+                        # Store server-side for download
+                        remember_anonymization(result)
                         
                         replacements = result.get('anonymization_report', {}).get('total_replacements', 0)
                         chat_count = result.get('chat_count', 1)
@@ -316,48 +430,37 @@ def download_anonymized(format):
     """Download anonymized results - FIXED for UTF-8 Excel compatibility"""
     print(f"=== DOWNLOAD ANONYMIZED: {format} ===")
     
-    if 'last_anonymization' not in session:
+    if format not in ('txt', 'json'):
+        return f"Unsupported format: {format}. Supported: txt, json", 400
+    
+    # Streamed from the result store, never loaded into memory
+    result_path = result_store.path(session.get('last_anonymization_id'), format)
+    if result_path is None:
         return "No anonymization data available. Please anonymize some content first.", 400
     
     try:
-        result = session['last_anonymization']
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         
+        # Better filename based on whether it's single or multiple chats
+        chat_count = session.get('last_anonymization_chats', 1)
+        
         if format == 'txt':
             # Download as plain text file with all chats
-            response = make_response(result['anonymized_transcript'])
-            response.headers['Content-Type'] = 'text/plain; charset=utf-8'
-            
-            # Better filename based on whether it's single or multiple chats
-            chat_count = result.get('chat_count', 1)
             if chat_count > 1:
                 filename = f'anonymized_chats_{chat_count}_{timestamp}.txt'
             else:
                 filename = f'anonymized_chat_{timestamp}.txt'
-                
-            response.headers['Content-Disposition'] = f'attachment; filename={filename}'
-            print(f"✅ Returning TXT file: {filename}")
-            return response
-            
-        elif format == 'json':
+            mimetype = 'text/plain'  # charset=utf-8 is added for text/* types
+        else:
             # Download as JSON with full report
-            json_content = json.dumps(result, indent=2, ensure_ascii=False)
-            response = make_response(json_content)
-            response.headers['Content-Type'] = 'application/json; charset=utf-8'
-            
-            # Better filename based on whether it's single or multiple chats
-            chat_count = result.get('chat_count', 1)
             if chat_count > 1:
                 filename = f'anonymized_report_{chat_count}_chats_{timestamp}.json'
             else:
                 filename = f'anonymized_report_{timestamp}.json'
-                
-            response.headers['Content-Disposition'] = f'attachment; filename={filename}'
-            print(f"✅ Returning JSON file: {filename}")
-            return response
-            
-        else:
-            return f"Unsupported format: {format}. Supported: txt, json", 400
+            mimetype = 'application/json; charset=utf-8'
+        
+        print(f"✅ Returning {format.upper()} file: {filename}")
+        return send_file(result_path, mimetype=mimetype, as_attachment=True, download_name=filename)
             
     except Exception as e:
         print(f"❌ Download error: {e}")
@@ -383,6 +486,7 @@ def single_analysis():
         if transcript:
             provider, model_name = get_api_provider()
             target_language = request.form.get('target_language', 'en')
+            config = config_registry.current()
             
             print("=== SINGLE ANALYSIS WITH ANONYMIZATION PREVIEW STARTED ===")
             
@@ -390,7 +494,7 @@ def single_analysis():
                 # Step 1: Create anonymizer and get anonymized version for display
                 from chat_anonymizer import ChatAnonymizer
                 anonymizer = ChatAnonymizer()
-                anonymized_transcript, anonymization_report = anonymizer.anonymize_text(transcript)
+                anonymized_transcript, anonymization_report, _ = anonymizer.anonymize_cached(transcript)
                 
                 # Create anonymization stats for display
                 anonymization_stats = {
@@ -407,20 +511,26 @@ def single_analysis():
                 # Step 2: Perform analysis - FIXED to use correct function
                 print("🤖 Starting QA analysis...")
                 
+                # The preview above is the one anonymization pass; the wrapper reuses it
+                analysis_kwargs = {'already_anonymized': True} if ANONYMIZATION_ENABLED else {}
                 result = analyze_chat_transcript(
-                    transcript,  # Use original transcript - function will handle anonymization if enabled
-                    chat_rules,
-                    kb,
+                    anonymized_transcript if ANONYMIZATION_ENABLED else transcript,
+                    config.rules,
+                    config.kb,
                     target_language=target_language,
                     prompt_template_path="QA_prompt.md",
                     model_provider=provider,
-                    model_name=model_name
+                    model_name=model_name,
+                    prompt_template=config.prompt_template,
+                    **analysis_kwargs
                 )
                 
                 print("✅ QA analysis completed")
                 
                 # Store result in file
                 if result:
+                    result['config_version'] = config.version
+                    
                     # Add anonymization info to result for potential future use
                     result['anonymization_info'] = {
                         'was_anonymized': True,
@@ -465,7 +575,7 @@ def single_analysis():
         anonymized_transcript=anonymized_transcript,
         anonymization_stats=anonymization_stats,
         detected_language=detected_language,
-        categories=chat_rules.get('categories', [])
+        categories=config_registry.current().rules.get('categories', [])
     )
     
 # ================ BATCH ANALYSIS (UPDATED with auto-anonymization) ================
@@ -475,6 +585,8 @@ def batch_analysis():
     global current_batch_file
     results = []
     processor = EnhancedChatProcessor()  # This may auto-anonymize if enabled
+    config = config_registry.current()
+    chat_rules = config.rules
     
     if request.method == 'POST':
         if ANONYMIZATION_ENABLED:
@@ -482,49 +594,60 @@ def batch_analysis():
         else:
             print("=== BATCH ANALYSIS (NO ANONYMIZATION) STARTED ===")
         
-        # Check if files were uploaded
-        if 'batch_files' not in request.files:
+        # Check if files were uploaded (directly, or beforehand in chunks)
+        upload_ids = request.form.getlist('upload_ids')
+        if 'batch_files' not in request.files and not upload_ids:
             print("❌ No 'batch_files' in request.files")
             flash('No files selected')
             return redirect(request.url)
         
         files = request.files.getlist('batch_files')
-        print(f"✅ Found {len(files)} files in request")
+        print(f"✅ Found {len(files)} files and {len(upload_ids)} chunked uploads in request")
         
         # Filter out empty file selections
         valid_files = [f for f in files if f and f.filename != '']
         
+        # Completed chunked uploads are read from their assembled files on disk
+        # (and deleted once extracted; incomplete ones are kept to be resumed)
+        opened_uploads = []
+        for upload_id in upload_ids:
+            try:
+                filename, stream = upload_store.open(upload_id, upload_owner())
+                valid_files.append(FileStorage(stream=stream, filename=filename))
+                opened_uploads.append(upload_id)
+            except UploadError as e:
+                print(f"❌ Chunked upload {upload_id}: {str(e)}")
+                flash(f"Error: {str(e)}")
+        
         if not valid_files:
             flash('No valid files selected')
             return redirect(request.url)
         
         print(f"✅ Processing {len(valid_files)} valid files")
         
-        # Process each file (anonymization happens automatically if enabled)
+        # Process each file (anonymization happens automatically if enabled).
+        # Files are extracted in parallel worker processes, straight from their
+        # spooled streams, and come back in upload order with per-file errors.
         all_chats = []
         
-        for file in valid_files:
-            try:
-                print(f"Processing file: {file.filename}")
-                
-                file_bytes = file.read()
-                file_obj = io.BytesIO(file_bytes)
-                file_obj.name = file.filename
-                file_obj.seek(0)
-                
-                # This automatically anonymizes if the enhanced processor supports it
-                chats = processor.extract_chats_from_file(file_obj)
-                
-                if chats:
-                    print(f"✅ Extracted {len(chats)} chats from {file.filename}")
-                    all_chats.extend(chats)
-                else:
-                    print(f"❌ No chats found in {file.filename}")
-                    flash(f"No valid chat transcripts found in {file.filename}")
-                    
-            except Exception as e:
-                print(f"❌ Error processing {file.filename}: {str(e)}")
-                flash(f"Error processing {file.filename}: {str(e)}")
+        try:
+            extracted = processor.extract_chats_from_files(valid_files)
+        finally:
+            for upload_id in opened_uploads:
+                upload_store.delete(upload_id, upload_owner())
+            for f in valid_files:
+                f.close()
+        
+        for filename, chats, error in extracted:
+            if error:
+                print(f"❌ Error processing {filename}: {error}")
+                flash(f"Error processing {filename}: {error}")
+            elif chats:
+                print(f"✅ Extracted {len(chats)} chats from {filename}")
+                all_chats.extend(chats)
+            else:
+                print(f"❌ No chats found in {filename}")
+                flash(f"No valid chat transcripts found in {filename}")
         
         # Process batch analysis if chats were found
         if all_chats:
@@ -537,11 +660,12 @@ def batch_analysis():
                 results = analyze_multiple_chats_with_anonymization(
                     all_chats,
                     chat_rules,
-                    kb,
+                    config.kb,
                     target_language=target_language,
                     prompt_template_path="QA_prompt.md",
                     model_provider=provider,
-                    model_name=model_name
+                    model_name=model_name,
+                    prompt_template=config.prompt_template
                 )
             else:
                 # Use regular batch processing
@@ -562,11 +686,13 @@ def batch_analysis():
                         result = analyze_chat_transcript(
                             chat['processed_content'],
                             chat_rules,
-                            kb,
+                            config.kb,
                             target_language=target_language,
                             prompt_template_path="QA_prompt.md",
                             model_provider=provider,
-                            model_name=model_name
+                            model_name=model_name,
+                            prompt_template=config.prompt_template,
+                            formatted_transcript=chat.get('formatted_transcript')
                         )
                         
                         if result:
@@ -613,8 +739,9 @@ def batch_analysis():
                         print(f"❌ Error analyzing chat {chat.get('id')}: {str(e)}")
                         failed_analyses += 1
             
-            # Add language detection to results
+            # Add language detection and config version to results
             for result in results:
+                result['config_version'] = config.version
                 try:
                     # Find the original chat for language detection
                     original_chat = next((chat for chat in all_chats if chat.get('id') == result.get('chat_id')), None)
@@ -650,27 +777,94 @@ def batch_analysis():
         'batch_analysis.html',
         results=results,
         categories=chat_rules.get('categories', []),
-        anonymization_enabled=ANONYMIZATION_ENABLED
+        anonymization_enabled=ANONYMIZATION_ENABLED,
+        upload_chunk_size=upload_store.chunk_size
     )
 
+# ================ CHUNKED UPLOADS ================
+@app.route('/api/uploads', methods=['POST'])
+def create_upload():
+    """Start a chunked upload: JSON {"filename": ..., "size": bytes}"""
+    data = request.get_json(silent=True) or {}
+    try:
+        status = upload_store.create(secure_filename(str(data.get('filename') or '')), data.get('size'), upload_owner())
+    except UploadError as e:
+        return jsonify({'error': str(e)}), e.status
+    return jsonify(status), 201
+
+@app.route('/api/uploads/<upload_id>', methods=['GET', 'DELETE'])
+def upload_status(upload_id):
+    """Where an upload stands (to resume it), or cancel it"""
+    if request.method == 'DELETE':
+        upload_store.delete(upload_id, upload_owner())
+        return '', 204
+    try:
+        return jsonify(upload_store.status(upload_id, upload_owner()))
+    except UploadError as e:
+        return jsonify({'error': str(e)}), e.status
+
+@app.route('/api/uploads/<upload_id>/chunks/<int:index>', methods=['PUT'])
+def upload_chunk(upload_id, index):
+    """One chunk as the raw request body, its checksum in X-Chunk-Checksum ("sha256:<hex>")"""
+    try:
+        status = upload_store.write_chunk(upload_id, upload_owner(), index, request.get_data(cache=False),
+                                          request.headers.get('X-Chunk-Checksum', ''))
+    except UploadError as e:
+        return jsonify({'error': str(e)}), e.status
+    return jsonify(status)
+
 # ================ KNOWLEDGE BASE ================
 @app.route('/knowledge-base', methods=['GET', 'POST'])
 def knowledge_base():
+    # Entries are lazy-loaded page by page from /api/knowledge-base
+    kb = config_registry.current().kb
     categories = kb.get_all_categories()
     selected_category = request.args.get('category', 'All Categories')
     
-    if selected_category == 'All Categories':
-        qa_pairs = kb.qa_pairs.get('qa_pairs', [])
-    else:
-        qa_pairs = kb.get_qa_pairs_by_category(selected_category)
-    
     return render_template(
         'knowledge_base.html', 
-        qa_pairs=qa_pairs,
         categories=categories,
-        selected_category=selected_category
+        selected_category=selected_category,
+        page_size=KB_PAGE_SIZE
     )
 
+@app.route('/api/knowledge-base')
+def knowledge_base_api():
+    """Paginated, filtered KB entries: ?offset=&limit=&q=&category="""
+    try:
+        offset = int(request.args.get('offset', 0))
+        limit = min(int(request.args.get('limit', KB_PAGE_SIZE)), KB_MAX_PAGE_SIZE)
+    except ValueError:
+        return jsonify({'error': 'offset and limit must be integers'}), 400
+    
+    category = request.args.get('category')
+    if category == 'All Categories':
+        category = None
+    
+    kb = config_registry.current().kb
+    return jsonify(kb.browse(offset=offset, limit=limit, query=request.args.get('q'), category=category))
+
+@app.route('/knowledge-base/duplicates')
+def knowledge_base_duplicates():
+    """Near-duplicate KB entries (TF-IDF cosine similarity) for KB maintenance"""
+    try:
+        threshold = float(request.args.get('threshold', 0.85))
+    except ValueError:
+        return jsonify({'error': 'threshold must be a number'}), 400
+    
+    try:
+        kb = config_registry.current().kb
+        duplicates = kb.near_duplicate_report(threshold)
+    except ImportError as e:
+        return jsonify({'error': str(e)}), 501
+    
+    return jsonify({
+        'threshold': threshold,
+        'total_entries': len(kb.qa_pairs.get('qa_pairs', [])),
+        'duplicate_count': len(duplicates),
+        'duplicates': duplicates
+    })
+
 # ================ SETTINGS ================
 @app.route('/settings', methods=['GET', 'POST'])
 def settings():
@@ -711,6 +905,7 @@ def download_report(type, format):
     
     try:
         global current_batch_file, current_single_file
+        chat_rules = config_registry.current().rules
         
         if type == 'batch' and format == 'csv':
             print(f"Current batch file: {current_batch_file}")
@@ -857,7 +1052,8 @@ def debug_files():
         'single_file_exists': current_single_file and (RESULTS_DIR / current_single_file).exists() if current_single_file else False,
         'total_result_files': len(list(RESULTS_DIR.glob('*.json'))),
         'result_files': [f.name for f in RESULTS_DIR.glob('*.json')],
-        'anonymization_enabled': ANONYMIZATION_ENABLED
+        'anonymization_enabled': ANONYMIZATION_ENABLED,
+        'config_version': config_registry.current().version
     }
     
     return jsonify(file_info)
@@ -906,6 +1102,8 @@ def anonymization_status():
             'Case references',
             'Order numbers'
         ] if ANONYMIZATION_ENABLED else [],
+        'regex_guard': regex_guard.stats(),
+        'anonymization_cache': anonymization_cache.stats(),
         'process': [
             '1. User uploads chat files',
             '2. System extracts individual chats',
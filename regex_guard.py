@@ -0,0 +1,259 @@
+"""
+regex_guard.py
+
+Time-budgeted regular expressions for uploaded text.
+
+Transcripts arrive from users as arbitrary text, and one pattern that
+backtracks badly on a malformed 10 MB upload can pin a gunicorn worker's CPU.
+Patterns compiled here use the `regex` package, whose matching functions take
+a timeout, and every call runs under a time budget:
+
+1. The whole text is scanned once with REGEX_TIME_BUDGET seconds.
+2. If the budget is hit, the scan resumes line-aligned chunk by chunk
+   (REGEX_CHUNK_SIZE characters, REGEX_CHUNK_BUDGET seconds each, at most
+   REGEX_TIME_BUDGET seconds in total). Chunks that still time out are
+   skipped, and anchored calls (match/fullmatch) are treated as no match.
+3. Every budget hit and skipped chunk is counted per pattern (see stats()).
+
+The fallback can miss a match that spans a chunk boundary, and a skipped
+chunk loses its matches; that is the price of a bounded worst case. It is
+fine for parsing (chat splitting, speaker detection) but not for redaction:
+the anonymizer's replacement patterns use plain `re`, which never gives up
+on part of a text. Without the `regex` package, patterns fall back to the
+standard `re` module and run without a budget.
+"""
+
+import os
+import re
+import threading
+import time
+from collections import Counter
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Optional, Union
+
+try:
+    import regex as _regex
+except ImportError:
+    _regex = None
+
+# Seconds a single call may spend on the whole text before falling back to chunks
+REGEX_TIME_BUDGET = float(os.environ.get('REGEX_TIME_BUDGET', '2.0'))
+# Chunk size (characters) and per-chunk budget (seconds) of the fallback scan
+REGEX_CHUNK_SIZE = int(os.environ.get('REGEX_CHUNK_SIZE', str(64 * 1024)))
+REGEX_CHUNK_BUDGET = float(os.environ.get('REGEX_CHUNK_BUDGET', '0.25'))
+
+_stats_lock = threading.Lock()
+_budget_hits: Counter = Counter()
+_chunks_skipped: Counter = Counter()
+
+
+def stats() -> Dict[str, Any]:
+    """Budget hits and skipped chunks since the process started, per pattern"""
+    with _stats_lock:
+        return {
+            'engine': 'regex' if _regex is not None else 're',
+            'time_budget': REGEX_TIME_BUDGET,
+            'chunk_size': REGEX_CHUNK_SIZE,
+            'chunk_budget': REGEX_CHUNK_BUDGET,
+            'budget_hits': sum(_budget_hits.values()),
+            'chunks_skipped': sum(_chunks_skipped.values()),
+            'by_pattern': {
+                label: {'budget_hits': _budget_hits[label], 'chunks_skipped': _chunks_skipped[label]}
+                for label in _budget_hits
+            },
+        }
+
+
+class GuardedPattern:
+    """
+    Compiled pattern with the `re.Pattern` interface whose calls run under a time budget
+
+    finditer() returns a list rather than a lazy iterator, so that the budget
+    covers the scan only and not the caller's work between matches.
+    """
+
+    def __init__(self, pattern: str, flags: int = 0):
+        self.pattern = pattern
+        self.flags = flags
+        self.label = pattern if len(pattern) <= 80 else pattern[:77] + '...'
+        self._compiled = (_regex or re).compile(pattern, flags)
+
+    # ---------------------------------------------------------------- budget
+
+    def _record(self, counter: Counter, message: Optional[str] = None):
+        with _stats_lock:
+            counter[self.label] += 1
+        if message:
+            print(f"⏱️ [RegexGuard] {message}: {self.label}")
+
+    def _chunks(self, string: str, pos: int, endpos: int):
+        """Line-aligned (start, end) spans of at most REGEX_CHUNK_SIZE characters"""
+        start = pos
+        while start < endpos:
+            end = min(start + REGEX_CHUNK_SIZE, endpos)
+            if end < endpos:
+                newline = string.rfind('\n', start, end)
+                if newline > start:
+                    end = newline + 1
+            yield start, end
+            start = end
+
+    def _chunked_matches(self, string: str, pos: int, endpos: int) -> List[Any]:
+        """Fallback scan: every chunk under its own budget, all of them under REGEX_TIME_BUDGET"""
+        deadline = time.monotonic() + REGEX_TIME_BUDGET
+        matches = []
+        for start, end in self._chunks(string, pos, endpos):
+            if time.monotonic() > deadline:
+                self._record(_chunks_skipped, f"Fallback budget exhausted at offset {start} of {len(string)}")
+                break
+            try:
+                matches.extend(self._compiled.finditer(string, start, end, timeout=REGEX_CHUNK_BUDGET))
+            except TimeoutError:
+                self._record(_chunks_skipped, f"Skipped the rest of chunk {start}-{end}")
+        return matches
+
+    def _scan(self, string: str, pos: int = 0, endpos: Optional[int] = None) -> List[Any]:
+        endpos = len(string) if endpos is None else min(endpos, len(string))
+        if _regex is None:
+            return list(self._compiled.finditer(string, pos, endpos))
+
+        matches = []
+        deadline = time.monotonic() + REGEX_TIME_BUDGET
+        try:
+            for match in self._compiled.finditer(string, pos, endpos, timeout=REGEX_TIME_BUDGET):
+                matches.append(match)
+                if time.monotonic() > deadline:
+                    raise TimeoutError
+            return matches
+        except TimeoutError:
+            self._record(_budget_hits, f"Budget of {REGEX_TIME_BUDGET}s hit on {len(string)} chars, scanning in chunks")
+
+        # Keep what was found and resume after it
+        resume = pos
+        if matches:
+            last = matches[-1]
+            resume = last.end() if last.end() > last.start() else last.end() + 1
+        return matches + self._chunked_matches(string, resume, endpos)
+
+    def _anchored(self, method: str, string: str, pos: int, endpos: Optional[int]):
+        endpos = len(string) if endpos is None else endpos
+        if _regex is None:
+            return getattr(self._compiled, method)(string, pos, endpos)
+        try:
+            return getattr(self._compiled, method)(string, pos, endpos, timeout=REGEX_TIME_BUDGET)
+        except TimeoutError:
+            self._record(_budget_hits, f"Budget of {REGEX_TIME_BUDGET}s hit on {len(string)} chars, treating as no match")
+            return None
+
+    # ------------------------------------------------------- re.Pattern API
+
+    def match(self, string: str, pos: int = 0, endpos: Optional[int] = None):
+        return self._anchored('match', string, pos, endpos)
+
+    def fullmatch(self, string: str, pos: int = 0, endpos: Optional[int] = None):
+        return self._anchored('fullmatch', string, pos, endpos)
+
+    def search(self, string: str, pos: int = 0, endpos: Optional[int] = None):
+        endpos = len(string) if endpos is None else endpos
+        if _regex is None:
+            return self._compiled.search(string, pos, endpos)
+        try:
+            return self._compiled.search(string, pos, endpos, timeout=REGEX_TIME_BUDGET)
+        except TimeoutError:
+            self._record(_budget_hits, f"Budget of {REGEX_TIME_BUDGET}s hit on {len(string)} chars, searching in chunks")
+        deadline = time.monotonic() + REGEX_TIME_BUDGET
+        for start, end in self._chunks(string, pos, endpos):
+            if time.monotonic() > deadline:
+                self._record(_chunks_skipped, f"Fallback budget exhausted at offset {start} of {len(string)}")
+                return None
+            try:
+                match = self._compiled.search(string, start, end, timeout=REGEX_CHUNK_BUDGET)
+            except TimeoutError:
+                self._record(_chunks_skipped, f"Skipped the rest of chunk {start}-{end}")
+                continue
+            if match:
+                return match
+        return None
+
+    def finditer(self, string: str, pos: int = 0, endpos: Optional[int] = None) -> List[Any]:
+        return self._scan(string, pos, endpos)
+
+    def findall(self, string: str, pos: int = 0, endpos: Optional[int] = None) -> List[Any]:
+        groups = self._compiled.groups
+        return [
+            match.group(0) if groups == 0 else match.group(1) if groups == 1 else match.groups()
+            for match in self._scan(string, pos, endpos)
+        ]
+
+    def sub(self, repl: Union[str, Callable], string: str, count: int = 0) -> str:
+        if _regex is None:
+            return self._compiled.sub(repl, string, count)
+        try:
+            return self._compiled.sub(repl, string, count, timeout=REGEX_TIME_BUDGET)
+        except TimeoutError:
+            self._record(_budget_hits, f"Budget of {REGEX_TIME_BUDGET}s hit on {len(string)} chars, substituting in chunks")
+
+        pieces = []
+        position = 0
+        for match in self._chunked_matches(string, 0, len(string))[:count or None]:
+            pieces.append(string[position:match.start()])
+            pieces.append(repl(match) if callable(repl) else match.expand(repl))
+            position = match.end()
+        pieces.append(string[position:])
+        return ''.join(pieces)
+
+    def split(self, string: str, maxsplit: int = 0) -> List[str]:
+        if _regex is None:
+            return self._compiled.split(string, maxsplit)
+        try:
+            return self._compiled.split(string, maxsplit, timeout=REGEX_TIME_BUDGET)
+        except TimeoutError:
+            self._record(_budget_hits, f"Budget of {REGEX_TIME_BUDGET}s hit on {len(string)} chars, splitting in chunks")
+
+        pieces = []
+        position = 0
+        for match in self._chunked_matches(string, 0, len(string))[:maxsplit or None]:
+            pieces.append(string[position:match.start()])
+            pieces.extend(match.groups())
+            position = match.end()
+        pieces.append(string[position:])
+        return pieces
+
+    def __repr__(self):
+        return f"GuardedPattern({self.pattern!r}, flags={self.flags})"
+
+
+@lru_cache(maxsize=1024)
+def compile(pattern: str, flags: int = 0) -> GuardedPattern:
+    """Compile (and cache) a time-budgeted pattern; flags are the usual re.* flags"""
+    return GuardedPattern(pattern, flags)
+
+
+# Module-level shortcuts mirroring the `re` functions
+
+def search(pattern: str, string: str, flags: int = 0):
+    return compile(pattern, flags).search(string)
+
+
+def match(pattern: str, string: str, flags: int = 0):
+    return compile(pattern, flags).match(string)
+
+
+def fullmatch(pattern: str, string: str, flags: int = 0):
+    return compile(pattern, flags).fullmatch(string)
+
+
+def finditer(pattern: str, string: str, flags: int = 0) -> List[Any]:
+    return compile(pattern, flags).finditer(string)
+
+
+def findall(pattern: str, string: str, flags: int = 0) -> List[Any]:
+    return compile(pattern, flags).findall(string)
+
+
+def sub(pattern: str, repl: Union[str, Callable], string: str, count: int = 0, flags: int = 0) -> str:
+    return compile(pattern, flags).sub(repl, string, count)
+
+
+def split(pattern: str, string: str, maxsplit: int = 0, flags: int = 0) -> List[str]:
+    return compile(pattern, flags).split(string, maxsplit)
@@ -0,0 +1,138 @@
+# result_store.py
+"""
+Server-side storage for large per-user results (anonymization results first of all).
+
+Flask's default session is a signed cookie: whatever is put in it is
+serialized, signed and sent back with every request, and browsers drop
+cookies above ~4 KB. Results are therefore written to RESULT_STORE_DIR as
+<id>.json (plus optional sidecar files such as <id>.txt for downloads) and the
+session only keeps the id. Entries older than RESULT_TTL seconds are treated as
+missing and deleted by purge_expired(), which save() runs at most once a minute.
+"""
+
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+RESULT_STORE_DIR = os.environ.get('RESULT_STORE_DIR', 'temp_result_store')
+RESULT_TTL = int(os.environ.get('RESULT_TTL', str(6 * 3600)))
+
+# Ids are generated here; anything else (e.g. a tampered or stale session value) is rejected.
+# The prefix keeps other files out of purge_expired() even if the directory is shared
+# (the report files in temp_results are also named <kind>_<date>_<time>_<hex>.json).
+_ID_PREFIX = 'rs_'
+_ID_PATTERN = re.compile(r'^rs_[a-z_]+_\d{8}_\d{6}_[0-9a-f]{8}$')
+_PURGE_INTERVAL = 60
+
+
+class ResultStore:
+    """
+    Directory of JSON results with TTL eviction, addressed by opaque ids
+    """
+
+    def __init__(self, directory: str = RESULT_STORE_DIR, ttl: int = RESULT_TTL):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._last_purge = 0.0
+
+    def _write_atomic(self, path: Path, text: str):
+        """Write to a private temp file in the same directory, then rename over path"""
+        fd, tmp_path = tempfile.mkstemp(prefix='.result_', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(text)
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def save(self, payload: Any, kind: str, sidecars: Optional[Dict[str, str]] = None) -> str:
+        """
+        Store a result and return its id
+
+        Args:
+            payload: JSON-serializable result, written as <id>.json
+            kind: Short lowercase label, part of the id (e.g. 'anonymization')
+            sidecars: Extra text files to store with it, {suffix: text} -> <id>.<suffix>
+
+        Returns:
+            The id to keep in the session
+        """
+        self._maybe_purge()
+        result_id = f"{_ID_PREFIX}{kind}_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}"
+        for suffix, text in (sidecars or {}).items():
+            self._write_atomic(self.directory / f"{result_id}.{suffix}", text)
+        # The JSON file is written last: its presence means the entry is complete
+        self._write_atomic(self.directory / f"{result_id}.json",
+                           json.dumps(payload, indent=2, ensure_ascii=False))
+        return result_id
+
+    def path(self, result_id: Optional[str], suffix: str = 'json') -> Optional[Path]:
+        """File of a stored result (or of one of its sidecars), None if missing or expired"""
+        if not result_id or not _ID_PATTERN.match(result_id) or not suffix.isalnum():
+            return None
+        main = self.directory / f"{result_id}.json"
+        try:
+            if time.time() - main.stat().st_mtime > self.ttl:
+                return None
+        except OSError:
+            return None
+        path = self.directory / f"{result_id}.{suffix}"
+        return path if path.exists() else None
+
+    def load(self, result_id: Optional[str]) -> Optional[Any]:
+        """Stored payload, None if missing or expired"""
+        path = self.path(result_id)
+        if path is None:
+            return None
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"❌ [ResultStore] Could not read {path}: {e}")
+            return None
+
+    def delete(self, result_id: Optional[str]):
+        """Remove a result and its sidecars"""
+        if not result_id or not _ID_PATTERN.match(result_id):
+            return
+        for path in self.directory.glob(f"{result_id}.*"):
+            try:
+                path.unlink()
+            except OSError:
+                pass
+
+    def purge_expired(self) -> int:
+        """Delete every result older than the TTL; returns the number of files removed"""
+        cutoff = time.time() - self.ttl
+        removed = 0
+        for path in self.directory.iterdir():
+            stem = path.name.split('.', 1)[0]
+            if not _ID_PATTERN.match(stem):
+                continue
+            try:
+                if path.stat().st_mtime < cutoff:
+                    path.unlink()
+                    removed += 1
+            except OSError:
+                pass
+        if removed:
+            print(f"🧹 [ResultStore] Purged {removed} expired file(s)")
+        return removed
+
+    def _maybe_purge(self):
+        with self._lock:
+            if time.monotonic() - self._last_purge < _PURGE_INTERVAL:
+                return
+            self._last_purge = time.monotonic()
+        self.purge_expired()
@@ -0,0 +1,231 @@
+# transcript_tokenizer.py
+"""
+Single-pass tokenizer of chat transcripts into speaker turns.
+
+The batch processor, the anonymizer and the AI formatter used to re-scan
+every chat with their own speaker and system-line rules. tokenize() now
+parses a chat once into Turns (speaker, timestamp, text, source offsets,
+system/bot flags), and each output format is a rendering of those turns:
+
+- render_processed(): the cleaned transcript stored as 'processed_content',
+  one line per message ("Customer: ...", "Agent: ...").
+- render_for_ai(): the dialogue sent to the model, one line per source line.
+
+Recognized formats:
+- Speaker and timestamp split by a bullet ("Kang A • 10:32 AM", also when
+  the bullet part is on the next line); "Guest" is the customer, any other
+  name an agent.
+- Colon tags ("Visitor: ...", "Support: ..."), optionally after an elapsed
+  time ("( 0m 12s ) Visitor: ...").
+Category headers ("Chat reason: ...") are kept as metadata. Lines before
+the first speaker (chat header, start time) are preamble.
+"""
+
+import re
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import List, Optional, Tuple
+
+import regex_guard
+
+# Lines kept verbatim as metadata (checked by substring, before anything else)
+METADATA_MARKERS = ('Chat reason:', 'Category:', 'Issue type:', 'Topic:')
+
+# System lines (joins, transfers, attachment previews, page footers) are dropped
+SYSTEM_PATTERNS = [
+    r'\s*\{ChatWindowButton:',
+    r'\s*Agent joined the conversation',
+    r'\s*Automated Process\b',
+    r'\s*A transfer request was sent',
+    r'.*(?:left|joined) the conversation\s*•',
+    r'\s*Preview:',
+    r'\s*Auto-response component',
+    r'\s*Live chat experience',
+    r'\s*Page \d+ of \d+',
+    r'\s*Report generated',
+]
+
+CUSTOMER_TAGS = ('Customer', 'Client', 'Visitor', 'User', 'Guest')
+AGENT_TAGS = ('Agent', 'Support', 'Assistant', 'Representative')
+BOT_TAGS = ('Bot', 'Chatbot', 'Pepper')
+
+# One pattern classifies a line; the first alternative that matches wins
+_LINE_PATTERN = regex_guard.compile(
+    '|'.join([
+        f"(?P<system>{'|'.join(f'(?:{pattern})' for pattern in SYSTEM_PATTERNS)})",
+        # Bullet format: "Guest • 10:32 AM" is the customer, any other name an agent
+        r'(?P<customer>Guest)\s*•\s*(?P<customer_time>.*)',
+        r'(?P<agent>[A-Za-z\s]+?)\s*•\s*(?P<agent_time>.*)',
+        # Colon format, optionally after an elapsed time: "( 0m 12s ) Visitor: ..."
+        r'(?:\(\s*(?P<elapsed>(?:\d+\s*[hms]\s*)+)\))?\s*'
+        rf"(?P<label>(?P<tag>{'|'.join(CUSTOMER_TAGS + AGENT_TAGS + BOT_TAGS)}):)",
+    ]),
+    re.IGNORECASE
+)
+_BOT_NAME_PATTERN = regex_guard.compile(rf"(?:{'|'.join(BOT_TAGS)})\b", re.IGNORECASE)
+
+
+@dataclass(frozen=True)
+class Turn:
+    """
+    One element of a transcript: a speaker's message, or a line outside the dialogue
+
+    kind is 'message', 'metadata' (category headers), 'system' (joins,
+    transfers, previews, page footers) or 'preamble' (before the first speaker).
+    """
+    kind: str
+    speaker: Optional[str]     # 'Customer' or 'Agent' for messages
+    name: Optional[str]        # As written: "Kang A", "Guest", "Visitor"
+    label: str                 # Colon tag as written ("Visitor:"), '' for bullet speakers
+    timestamp: Optional[str]   # Bullet time ("10:32 AM") or elapsed time ("0m 12s")
+    lines: Tuple[str, ...]     # Message lines, stripped (after a colon tag: the rest of its line); the text of other kinds
+    start: int                 # Source offsets of the turn, speaker line included
+    end: int
+    is_bot: bool = False
+
+    @property
+    def is_system(self) -> bool:
+        return self.kind == 'system'
+
+    @property
+    def text(self) -> str:
+        return ' '.join(self.lines).strip()
+
+
+def _speaker_of_tag(tag: str) -> Tuple[str, bool]:
+    """(speaker, is_bot) of a colon tag"""
+    tag = tag.lower()
+    if tag in (t.lower() for t in BOT_TAGS):
+        return 'Agent', True
+    if tag in (t.lower() for t in AGENT_TAGS):
+        return 'Agent', False
+    return 'Customer', False
+
+
+@lru_cache(maxsize=256)
+def tokenize(text: str) -> Tuple[Turn, ...]:
+    """
+    Parse a transcript into turns, in source order
+
+    Every line is stripped and classified once. A line followed by one that
+    starts with '•' is joined with it first (speaker and timestamp exported on
+    two lines). A message runs from its speaker line to the next speaker line;
+    metadata and system lines inside it do not end it. Results are cached for
+    the last few transcripts, which are usually tokenized more than once
+    (cleaning, KB selection, prompt formatting).
+    """
+    raw_lines = text.split('\n')
+    offsets = []
+    position = 0
+    for raw in raw_lines:
+        offsets.append(position)
+        position += len(raw) + 1
+
+    turns: List[Turn] = []
+    current = None   # [speaker, name, label, timestamp, lines, start, end, is_bot]
+    preamble = []
+    preamble_start = preamble_end = 0
+
+    def close_message():
+        nonlocal current
+        if current is not None:
+            speaker, name, label, timestamp, lines, start, end, is_bot = current
+            turns.append(Turn('message', speaker, name, label, timestamp, tuple(lines), start, end, is_bot))
+            current = None
+
+    i = 0
+    while i < len(raw_lines):
+        line = raw_lines[i].strip()
+        start = offsets[i]
+        end = start + len(raw_lines[i])
+
+        if any(marker in line for marker in METADATA_MARKERS):
+            turns.append(Turn('metadata', None, None, '', None, (line,), start, end))
+            i += 1
+            continue
+
+        if i + 1 < len(raw_lines) and raw_lines[i + 1].strip().startswith('•'):
+            line = f"{line} {raw_lines[i + 1].strip()}"
+            end = offsets[i + 1] + len(raw_lines[i + 1])
+            i += 2
+        else:
+            i += 1
+            if not line:
+                continue
+
+        match = _LINE_PATTERN.match(line)
+
+        if match is not None and match.group('system') is not None:
+            turns.append(Turn('system', None, None, '', None, (line,), start, end))
+        elif match is not None and match.group('label') is None:
+            close_message()
+            speaker = 'Customer' if match.group('customer') is not None else 'Agent'
+            name = (match.group('customer') or match.group('agent')).strip()
+            timestamp = (match.group('customer_time') or match.group('agent_time') or '').strip()
+            current = [speaker, name, '', timestamp or None, [], start, end, bool(_BOT_NAME_PATTERN.match(name))]
+        elif match is not None:
+            close_message()
+            speaker, is_bot = _speaker_of_tag(match.group('tag'))
+            elapsed = match.group('elapsed')
+            current = [speaker, match.group('tag'), match.group('label'),
+                       ' '.join(elapsed.split()) if elapsed else None,
+                       [line[match.end():]], start, end, is_bot]
+        elif current is not None:
+            current[4].append(line)
+            current[6] = end
+        else:
+            # Text before the first speaker
+            if not preamble:
+                preamble_start = start
+            preamble.append(line)
+            preamble_end = end
+
+    close_message()
+    if preamble:
+        turns.append(Turn('preamble', None, None, '', None, tuple(preamble), preamble_start, preamble_end))
+    # Metadata and system lines inside a message were appended before it
+    turns.sort(key=lambda turn: turn.start)
+    return tuple(turns)
+
+
+def render_processed(turns: Tuple[Turn, ...]) -> str:
+    """
+    Cleaned transcript: one line per message and metadata verbatim
+
+    Bullet-format messages are prefixed with their speaker ("Agent: ..."),
+    colon-format messages keep their own tag. Empty when nothing was recognized.
+    """
+    lines = []
+    for turn in turns:
+        if turn.kind == 'metadata':
+            lines.append(turn.lines[0])
+        elif turn.kind == 'message':
+            if turn.label:
+                lines.append((turn.label + ' '.join(turn.lines)).strip())
+            elif turn.text:
+                lines.append(f"{turn.speaker}: {turn.text}")
+    return '\n'.join(lines)
+
+
+def render_for_ai(turns: Tuple[Turn, ...]) -> str:
+    """
+    Dialogue for the model: every message line prefixed with a generic speaker
+
+    Agents' names are not passed on. A colon-format message keeps its own tag
+    on its first line. Metadata is kept verbatim; system lines and preamble are left out.
+    """
+    lines = []
+    for turn in turns:
+        if turn.kind == 'metadata':
+            lines.append(turn.lines[0])
+        elif turn.kind == 'message':
+            message_lines = list(turn.lines)
+            if turn.label:
+                lines.append((turn.label + message_lines.pop(0)).strip())
+            lines.extend(f"{turn.speaker}: {line}" for line in message_lines if line)
+    return '\n'.join(lines)
+
+
+def has_dialogue(turns: Tuple[Turn, ...]) -> bool:
+    """Whether any speaker was recognized"""
+    return any(turn.kind == 'message' for turn in turns)